@@ -1,54 +1,24 @@
 import streamlit as st
-from stages.stage_select_scenario import run as stage_select_scenario
-from stages.stage_select_patient import run as stage_select_patient
-from stages.stage_generate_json import run as stage_generate_json
-from stages.stage_choose_lens import run as stage_choose_lens
-from stages.stage_patient_summary import run as stage_patient_summary
-from stages.stage_generate_reasoning_chains import run as stage_generate_reasoning_chains
-from stages.stage_generate_propositions import run as stage_generate_propositions
-from stages.stage_validate_propositions import run as stage_validate_propositions
-from stages.stage_proposition_driven_reasoning_chains import run as stage_proposition_driven_reasoning_chains
-from stages.stage_validate import run as stage_validate
-from stages.stage_brainstorm import run as stage_brainstorm
-
-from components.session_utils import initialize_session_state, reset_session_state, display_stage_navigation_with_progress, go_to_previous_stage, go_to_next_stage, is_current_stage_completed
-from components.stage_template import stage_template
+from components.session_utils import initialize_session_state, reset_session_state, display_stage_navigation_with_progress, go_to_previous_stage, go_to_next_stage, is_current_stage_completed, display_session_telemetry, display_snapshot_controls
+from components.pipeline_utils import get_pipeline, stage_view
+from components.db_utils import db_query_scope, get_query_stats
+from components.telemetry_utils import telemetry_scope, timed
+from config import stages
 
 # Initialize session state
 initialize_session_state()
 
-# Define stages
-stages = [
-    "Select Scenario",
-    "Select Patient",
-    "Generate JSON",
-    "Choose Lens",
-    "Patient Summary",
-    "Generate Reasoning Chains",
-    "Generate Propositions",
-    "Validate Propositions",
-    "Proposition-Driven Reasoning Chains",
-    "Validate Reasoning Chains",
-    "Brainstorm"
-]
+# Stages and their views, as declared in config.STAGE_GRAPH
+stages_dict = {stage: stage_view(stage) for stage in stages}
 
-# Apply the template to stages that don't have their own navigation
-stages_dict = {
-    "Select Scenario": stage_select_scenario,
-    "Select Patient": stage_select_patient,
-    "Generate JSON": stage_generate_json,
-    "Choose Lens": stage_choose_lens,
-    "Patient Summary": stage_patient_summary,  # Remove the stage_template wrapper
-    "Generate Reasoning Chains": stage_generate_reasoning_chains,
-    "Generate Propositions": stage_template(stage_generate_propositions),
-    "Validate Propositions": stage_template(stage_validate_propositions),
-    "Proposition-Driven Reasoning Chains": stage_template(stage_proposition_driven_reasoning_chains),
-    "Validate Reasoning Chains": stage_validate,
-    "Brainstorm": stage_brainstorm
-}
+# Start the background stages whose inputs are ready
+pipeline = get_pipeline()
 
 # Display the combined stage navigation and progress in the sidebar
-display_stage_navigation_with_progress(stages)
+display_stage_navigation_with_progress(stages, pipeline.status, pipeline.job_progress)
+
+# Filled once the current stage has run, so it includes this run's operations
+telemetry_panel = st.sidebar.container()
 
 # Auto-Selection Mode
 st.sidebar.markdown("## Auto-Selection Mode")
@@ -56,7 +26,11 @@ st.sidebar.markdown("Auto-selection randomly chooses options in applicable stage
 
 # Run the current stage
 stage_name = stages[st.session_state.stage_index]
-stages_dict[stage_name]()
+with db_query_scope(stage_name), telemetry_scope(st.session_state.session_id, stage_name), timed('stage', stage_name):
+    stages_dict[stage_name]()
+# Values the stage just chose (e.g. the lenses) may make more stages ready
+get_pipeline()
+display_session_telemetry(telemetry_panel)
 
 # Centralized navigation
 col1, col2 = st.columns([1, 1])
@@ -74,6 +48,18 @@ with col2:
             else:
                 st.warning("Please complete the current stage before proceeding.")
 
+# Database time per stage, slowest queries first
+with st.sidebar.expander("Database Query Timing"):
+    query_stats = get_query_stats()
+    if query_stats.empty:
+        st.write("No queries recorded yet.")
+    else:
+        st.dataframe(query_stats.groupby('scope')[['count', 'total_seconds']].sum().sort_values('total_seconds', ascending=False))
+        st.dataframe(query_stats.head(10))
+
+# Save or restore the whole session under a name
+display_snapshot_controls()
+
 # Display reset button
 st.sidebar.markdown("---")
 if st.sidebar.button("Reset All Data"):
@@ -0,0 +1,212 @@
+"""
+Headless cohort batch runner.
+
+Runs the non-UI logic of every stage (patient JSON, progress and patient summaries,
+clinical questions and reasoning chains, propositions and validation) for many patients
+without the Streamlit UI. Patients are spread over a process pool, each result is appended
+to <output>/results.jsonl as soon as the patient finishes, and rerunning the same command
+skips the patients already in that file.
+
+Usage:
+    python batch_runner.py --scenario-id 3 --output runs/scenario3
+    python batch_runner.py --patients 8222157,55629189 --output runs/adhoc
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config import LLM_MAX_CONCURRENCY
+
+
+def _init_worker(llm_concurrency, rate_limit_share):
+    from components.api_utils import set_max_concurrency, set_rate_limit_share, set_default_lane
+    set_max_concurrency(llm_concurrency)
+    set_rate_limit_share(rate_limit_share)
+    set_default_lane('bulk')
+
+
+def process_patient(patient_id, scenario_group, scenario, lenses, stage=None):
+    """
+    Runs the whole pipeline for one patient.
+
+    stage, if given, is called with each app stage name and must return a context manager
+    wrapping that stage's work (benchmark.py uses it to measure every stage).
+
+    Returns:
+    dict: JSON-serializable result for the patient.
+    """
+    from components.api_utils import run_async, gather_in_order, generate_propositions_async, validate_reasoning_chain_async
+    from stages.stage_generate_json import generate_patient_json
+    from stages.stage_patient_summary import generate_patient_progress_summary, create_patient_summary
+    from stages.stage_generate_reasoning_chains import generate_questions_and_chains
+    from stages.stage_generate_propositions import generate_propositions_prompt
+    from stages.stage_validate_propositions import PropositionValidationModule, CLINICAL_GUIDELINES
+    from stages.stage_validate import prepare_chain_for_validation
+
+    stage = stage or (lambda name: contextlib.nullcontext())
+
+    started = time.time()
+    with stage("Generate JSON"):
+        encounters = generate_patient_json(patient_id)
+    if not len(encounters):
+        raise ValueError(f"No data found for patient {patient_id}")
+
+    with stage("Patient Summary"):
+        progress_summary, total_visits, key_insights = generate_patient_progress_summary(encounters)
+        patient_summary = create_patient_summary(encounters)
+
+    with stage("Generate Reasoning Chains"):
+        clinical_questions, reasoning_chains = run_async(
+            generate_questions_and_chains(patient_summary, progress_summary, lenses)
+        )
+
+    with stage("Generate Propositions"):
+        prompt = generate_propositions_prompt(scenario_group, scenario, encounters, lenses)
+        propositions = run_async(generate_propositions_async(prompt))
+
+    with stage("Validate Propositions"):
+        validator = PropositionValidationModule({**patient_summary, **progress_summary}, CLINICAL_GUIDELINES)
+        proposition_validation = validator.validate_all_propositions(propositions)
+
+    with stage("Validate Reasoning Chains"):
+        chain_validation = run_async(gather_in_order([
+            validate_reasoning_chain_async(*prepare_chain_for_validation(chain, patient_summary, progress_summary, lenses))
+            for chain in reasoning_chains
+        ]))
+
+    return {
+        "patient_nbr": str(patient_id),
+        "scenario_group": scenario_group,
+        "scenario": scenario,
+        "lenses": list(lenses),
+        "total_visits": total_visits,
+        "patient_summary": patient_summary,
+        "progress_summary": progress_summary,
+        "key_insights": key_insights,
+        "clinical_questions": clinical_questions,
+        "reasoning_chains": reasoning_chains,
+        "propositions": propositions,
+        "proposition_validation": proposition_validation,
+        "chain_validation": chain_validation,
+        "elapsed_seconds": round(time.time() - started, 3),
+    }
+
+
+def load_completed_patients(results_path):
+    """Returns the patient_nbrs already written to a results file."""
+    completed = set()
+    if not os.path.exists(results_path):
+        return completed
+    with open(results_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                completed.add(json.loads(line)["patient_nbr"])
+            except (ValueError, KeyError):
+                # A line cut short by a killed run; that patient is simply redone
+                continue
+    return completed
+
+
+def resolve_cohort(args):
+    """Returns (patient_ids, scenario_group, scenario) for the command-line arguments."""
+    from components.db_utils import load_scenario, load_patient_data
+
+    scenario_group, scenario = "Ad hoc cohort", "Selected patients"
+    patient_ids = []
+    if args.scenario_id is not None:
+        scenarios = load_scenario(args.scenario_id)
+        if scenarios.empty:
+            raise SystemExit(f"Unknown scenario ID: {args.scenario_id}")
+        row = scenarios.iloc[0]
+        scenario_group, scenario = row['group_name'], row['scenario_name']
+        patient_data = load_patient_data(row['sql_query'])
+        patient_ids = list(dict.fromkeys(patient_data['patient_nbr'].astype(str)))
+    if args.patients:
+        patient_ids = [patient_id.strip() for patient_id in args.patients.split(',') if patient_id.strip()]
+    if args.patients_file:
+        with open(args.patients_file, encoding='utf-8') as f:
+            patient_ids = [line.strip() for line in f if line.strip()]
+    if args.limit:
+        patient_ids = patient_ids[:args.limit]
+    return patient_ids, scenario_group, scenario
+
+
+def _append_jsonl(path, record):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def main(argv=None):
+    from stages.stage_choose_lens import LENSES
+
+    parser = argparse.ArgumentParser(description="Run the readmission reasoning pipeline over a cohort of patients.")
+    cohort = parser.add_mutually_exclusive_group(required=True)
+    cohort.add_argument('--scenario-id', type=int, help="Scenario whose SQL query selects the cohort")
+    cohort.add_argument('--patients', help="Comma-separated patient_nbr list")
+    cohort.add_argument('--patients-file', help="File with one patient_nbr per line")
+    parser.add_argument('--output', required=True, help="Output directory for results.jsonl and errors.jsonl")
+    parser.add_argument('--lenses', default=','.join(LENSES), help="Comma-separated lenses (default: all)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument('--llm-concurrency', type=int, default=LLM_MAX_CONCURRENCY * 2,
+                        help="Maximum LLM requests in flight across all workers")
+    parser.add_argument('--limit', type=int, help="Only process the first N patients of the cohort")
+    args = parser.parse_args(argv)
+
+    lenses = tuple(lens.strip() for lens in args.lenses.split(',') if lens.strip())
+    os.makedirs(args.output, exist_ok=True)
+    results_path = os.path.join(args.output, 'results.jsonl')
+    errors_path = os.path.join(args.output, 'errors.jsonl')
+
+    patient_ids, scenario_group, scenario = resolve_cohort(args)
+    completed = load_completed_patients(results_path)
+    pending = [patient_id for patient_id in patient_ids if patient_id not in completed]
+    print(f"{len(patient_ids)} patients in cohort, {len(completed & set(patient_ids))} already done, "
+          f"{len(pending)} to run", file=sys.stderr)
+    if not pending:
+        return 0
+
+    workers = max(1, min(args.workers, len(pending)))
+    per_worker_concurrency = max(1, args.llm_concurrency // workers)
+    failures = 0
+
+    # spawn: workers must not inherit the parent's SQLite connections or background threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(per_worker_concurrency, 1 / workers)) as executor:
+        futures = {
+            executor.submit(process_patient, patient_id, scenario_group, scenario, lenses): patient_id
+            for patient_id in pending
+        }
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                patient_id = futures[future]
+                try:
+                    result = future.result()
+                except Exception as error:
+                    failures += 1
+                    _append_jsonl(errors_path, {
+                        "patient_nbr": patient_id,
+                        "error": repr(error),
+                        "traceback": traceback.format_exc(),
+                    })
+                    print(f"[{done}/{len(pending)}] {patient_id} failed: {error!r}", file=sys.stderr)
+                    continue
+                _append_jsonl(results_path, result)
+                print(f"[{done}/{len(pending)}] {patient_id} done in {result['elapsed_seconds']}s", file=sys.stderr)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            print("Interrupted; rerun the same command to resume.", file=sys.stderr)
+            return 130
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""
+End-to-end pipeline benchmark.
+
+Runs the non-UI logic of the app's stages (the same pipeline as batch_runner.py) for a sample
+of patients from a synthetic readmission database, against a local fake LLM client instead of
+the OpenAI API, and reports per stage: wall time, LLM calls and errors, tokens, cache hit rate,
+database time and peak Python memory. The LLM cache of the run is kept in a temporary
+directory, so the real cache is neither used nor modified.
+
+The fake client draws latencies from a configurable distribution and injects API errors at
+configurable rates. To benchmark with realistic answers without paying for every run, record
+a cassette once against the real API (--llm record) and replay it (--llm replay).
+
+Results are written as JSON (--output); --compare prints the per-stage differences between
+two result files. As for the app, components.api_utils reads OPENAI_API_KEY from the Streamlit
+secrets; any value works unless recording from the real API.
+
+Usage:
+    python benchmark.py --output bench/baseline.json
+    python benchmark.py --sample 20 --latency lognormal:0.8,0.6 --errors rate_limit:0.02 --output bench/errors.json
+    python benchmark.py --llm record --cassette bench/cassette.jsonl --sample 5
+    python benchmark.py --llm replay --cassette bench/cassette.jsonl --sample 5 --output bench/replay.json
+    python benchmark.py --compare bench/baseline.json bench/replay.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+STAGE_METRICS = (
+    'wall_seconds', 'llm_calls', 'llm_errors', 'prompt_tokens', 'completion_tokens',
+    'cache_hits', 'cache_misses', 'db_seconds', 'peak_memory_bytes'
+)
+
+
+class StageMeter:
+    """Measures the stages of one patient run; pass its stage method to process_patient."""
+
+    def __init__(self, client):
+        self.client = client
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        from components.cache_utils import get_cache_stats
+        from components.db_utils import db_query_scope, get_query_stats
+        from components.telemetry_utils import telemetry_scope
+
+        def cache_totals():
+            stats = get_cache_stats().values()
+            return sum(entry['hits'] for entry in stats), sum(entry['misses'] for entry in stats)
+
+        def db_seconds():
+            stats = get_query_stats()
+            return float(stats.loc[stats['scope'] == name, 'total_seconds'].sum())
+
+        llm_before = self.client.log.snapshot()
+        hits_before, misses_before = cache_totals()
+        db_before = db_seconds()
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        try:
+            with db_query_scope(name), telemetry_scope(stage=name):
+                yield
+        finally:
+            wall = time.perf_counter() - started
+            llm_after = self.client.log.snapshot()
+            hits_after, misses_after = cache_totals()
+            self.stages[name] = {
+                'wall_seconds': round(wall, 4),
+                'llm_calls': llm_after['calls'] - llm_before['calls'],
+                'llm_errors': llm_after['errors'] - llm_before['errors'],
+                'prompt_tokens': llm_after['prompt_tokens'] - llm_before['prompt_tokens'],
+                'completion_tokens': llm_after['completion_tokens'] - llm_before['completion_tokens'],
+                'cache_hits': hits_after - hits_before,
+                'cache_misses': misses_after - misses_before,
+                'db_seconds': round(db_seconds() - db_before, 4),
+                'peak_memory_bytes': max(0, tracemalloc.get_traced_memory()[1] - memory_before),
+            }
+
+
+def summarize_stages(patient_runs):
+    """
+    Aggregates the per-patient stage measurements of a run.
+
+    Returns:
+    dict: Stage name -> runs, wall time statistics (total, mean, p50, p95, max), summed LLM,
+    cache and database counters, cache_hit_rate and the largest peak_memory_bytes.
+    """
+    per_stage = {}
+    for run in patient_runs:
+        for name, measured in run['stages'].items():
+            per_stage.setdefault(name, []).append(measured)
+
+    summary = {}
+    for name, runs in per_stage.items():
+        walls = sorted(run['wall_seconds'] for run in runs)
+        totals = {metric: sum(run[metric] for run in runs) for metric in STAGE_METRICS if metric != 'peak_memory_bytes'}
+        lookups = totals['cache_hits'] + totals['cache_misses']
+        summary[name] = {
+            'runs': len(runs),
+            'wall_seconds': {
+                'total': round(sum(walls), 4),
+                'mean': round(statistics.fmean(walls), 4),
+                'p50': round(statistics.median(walls), 4),
+                'p95': round(walls[min(len(walls) - 1, int(0.95 * len(walls)))], 4),
+                'max': round(walls[-1], 4),
+            },
+            **{metric: value for metric, value in totals.items() if metric != 'wall_seconds'},
+            'db_seconds': round(totals['db_seconds'], 4),
+            'cache_hit_rate': round(totals['cache_hits'] / lookups, 4) if lookups else None,
+            'peak_memory_bytes': max(run['peak_memory_bytes'] for run in runs),
+        }
+    return summary
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _max_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _make_client(args):
+    from components.benchmark_utils import FakeAsyncOpenAI, CassetteClient
+
+    if args.llm == 'fake':
+        return FakeAsyncOpenAI(args.latency, args.errors, seed=args.seed)
+    if not args.cassette:
+        raise SystemExit(f"--llm {args.llm} needs --cassette")
+    if args.llm == 'replay':
+        return CassetteClient(args.cassette, 'replay', latency_scale=args.latency_scale)
+    if args.record_from == 'fake':
+        inner = FakeAsyncOpenAI(args.latency, args.errors, seed=args.seed)
+    else:
+        from openai import AsyncOpenAI
+        from components.api_utils import api_key
+        inner = AsyncOpenAI(api_key=api_key, max_retries=0)
+    return CassetteClient(args.cassette, 'record', inner=inner)
+
+
+def _sample_patients(size, seed):
+    from components.db_utils import get_db_connection
+
+    conn = get_db_connection(read_only=True)
+    try:
+        patient_ids = [str(row[0]) for row in conn.execute(
+            'SELECT DISTINCT patient_nbr FROM Diabetic_Data ORDER BY patient_nbr'
+        ).fetchall()]
+    finally:
+        conn.close()
+    return random.Random(seed).sample(patient_ids, min(size, len(patient_ids)))
+
+
+def run_benchmark(args):
+    """Runs the benchmark described by the command-line arguments and returns its JSON report."""
+    from components.benchmark_utils import build_synthetic_db
+    from components.cache_utils import set_cache_dir, clear_cache, reset_cache_stats
+    from components.db_utils import set_db_path, reset_query_stats
+
+    workdir = tempfile.mkdtemp(prefix='readmission-benchmark-')
+    db_path = args.db
+    if db_path is None:
+        db_path = os.path.join(workdir, 'Readmissionv2.db')
+        encounters = build_synthetic_db(db_path, args.db_patients, seed=args.seed)
+        print(f"Synthetic database: {args.db_patients} patients, {encounters} encounters", file=sys.stderr)
+    set_db_path(db_path)
+    set_cache_dir(os.path.join(workdir, 'cache'))
+
+    client = _make_client(args)
+    from components.api_utils import set_client, set_max_concurrency
+    from batch_runner import process_patient
+    from stages.stage_choose_lens import LENSES
+    set_client(client)
+    if args.llm_concurrency:
+        set_max_concurrency(args.llm_concurrency)
+
+    lenses = tuple(lens.strip() for lens in (args.lenses or ','.join(LENSES)).split(',') if lens.strip())
+    patient_ids = _sample_patients(args.sample, args.seed)
+
+    tracemalloc.start()
+    patient_runs = []
+    started = time.perf_counter()
+    for repeat in range(args.repeat):
+        if not args.warm:
+            clear_cache('disk')
+            clear_cache('database')
+        reset_cache_stats()
+        reset_query_stats()
+        for index, patient_id in enumerate(patient_ids, 1):
+            meter = StageMeter(client)
+            run = {'patient_nbr': patient_id, 'repeat': repeat, 'error': None}
+            try:
+                process_patient(patient_id, "Benchmark", "Synthetic cohort", lenses, stage=meter.stage)
+            except Exception as error:
+                run['error'] = repr(error)
+            run['stages'] = meter.stages
+            patient_runs.append(run)
+            wall = sum(stage['wall_seconds'] for stage in meter.stages.values())
+            print(f"[repeat {repeat + 1}/{args.repeat}] [{index}/{len(patient_ids)}] {patient_id}: "
+                  f"{wall:.2f}s{' FAILED ' + run['error'] if run['error'] else ''}", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+
+    import config
+    llm = client.log.snapshot()
+    return {
+        'benchmark': {
+            'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+            'config': {
+                name: getattr(config, name) for name in (
+                    'LLM_MAX_CONCURRENCY', 'LLM_CACHE_BACKEND', 'REASONING_CHAIN_BATCH_SIZE',
+                    'LLM_REQUESTS_PER_MINUTE', 'LLM_TOKENS_PER_MINUTE', 'PROMPT_TOKEN_BUDGETS'
+                )
+            },
+        },
+        'totals': {
+            'patients': len(patient_ids),
+            'patient_runs': len(patient_runs),
+            'failed_runs': sum(1 for run in patient_runs if run['error']),
+            'wall_seconds': round(elapsed, 4),
+            'llm_calls': llm['calls'],
+            'llm_errors': llm['errors'],
+            'prompt_tokens': llm['prompt_tokens'],
+            'completion_tokens': llm['completion_tokens'],
+            'max_rss_bytes': _max_rss_bytes(),
+        },
+        'stages': summarize_stages(patient_runs),
+        'patients': patient_runs,
+    }
+
+
+def compare_reports(baseline, candidate):
+    """Returns a text table of per-stage totals in two reports and their relative change."""
+    def row_values(report):
+        values = {}
+        for name, stage in report['stages'].items():
+            values[(name, 'wall_seconds')] = stage['wall_seconds']['total']
+            for metric in ('llm_calls', 'prompt_tokens', 'completion_tokens', 'cache_hit_rate', 'db_seconds', 'peak_memory_bytes'):
+                values[(name, metric)] = stage[metric]
+        values[('TOTAL', 'wall_seconds')] = report['totals']['wall_seconds']
+        return values
+
+    def show(value):
+        return '-' if value is None else f"{value:.4g}"
+
+    before, after = row_values(baseline), row_values(candidate)
+    lines = [f"{'stage':<36} {'metric':<18} {'baseline':>14} {'candidate':>14} {'change':>9}"]
+    for key in list(dict.fromkeys([*before, *after])):
+        old, new = before.get(key), after.get(key)
+        change = f"{(new - old) / old:+.1%}" if old and new is not None else ''
+        lines.append(f"{key[0]:<36} {key[1]:<18} {show(old):>14} {show(new):>14} {change:>9}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the readmission reasoning pipeline against a fake LLM.")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'),
+                        help="Print the per-stage differences between two result files and exit")
+    parser.add_argument('--output', help="Write the JSON report to this file (default: stdout)")
+    parser.add_argument('--db', help="Existing readmission database to use instead of a synthetic one")
+    parser.add_argument('--db-patients', type=int, default=500, help="Patients in the synthetic database")
+    parser.add_argument('--sample', type=int, default=10, help="Number of patients to run the pipeline for")
+    parser.add_argument('--lenses', help="Comma-separated lenses (default: all)")
+    parser.add_argument('--repeat', type=int, default=1, help="Run the sample this many times")
+    parser.add_argument('--warm', action='store_true',
+                        help="Keep the LLM cache between repeats instead of starting every repeat cold")
+    parser.add_argument('--llm', choices=('fake', 'record', 'replay'), default='fake',
+                        help="fake: synthetic answers; record: record a cassette; replay: replay a cassette")
+    parser.add_argument('--cassette', help="Cassette file for --llm record / replay")
+    parser.add_argument('--record-from', choices=('openai', 'fake'), default='openai',
+                        help="Client recorded by --llm record (openai spends real API credits)")
+    parser.add_argument('--latency', default='lognormal:0.5,0.4',
+                        help="Fake LLM latency: fixed:S, uniform:LOW,HIGH, lognormal:MEDIAN,SIGMA or exponential:MEAN")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="Multiplier of replayed latencies")
+    parser.add_argument('--errors', default='',
+                        help="Fake LLM error rates, e.g. rate_limit:0.02,server_error:0.01,timeout:0.01,connection:0.01")
+    parser.add_argument('--llm-concurrency', type=int, help="Override config.LLM_MAX_CONCURRENCY")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic data, patient sample and fake LLM")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path, encoding='utf-8') as f:
+                reports.append(json.load(f))
+        print(compare_reports(*reports))
+        return 0
+
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2, default=str)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    for name, stage in report['stages'].items():
+        hit_rate = '-' if stage['cache_hit_rate'] is None else f"{stage['cache_hit_rate']:.0%}"
+        print(f"{name:<36} {stage['wall_seconds']['total']:>9.2f}s  {stage['llm_calls']:>5} calls  "
+              f"{stage['prompt_tokens'] + stage['completion_tokens']:>8} tokens  cache {hit_rate:>4}  "
+              f"peak {stage['peak_memory_bytes'] / 2**20:.1f} MiB", file=sys.stderr)
+    return 1 if report['totals']['failed_runs'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,75 +1,598 @@
 import os
-from openai import OpenAI
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import itertools
+import queue
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
 import streamlit as st
 import json
-from functools import lru_cache
 from components.cache_utils import flexible_cache
+from components.prompt_utils import compile_prompt, drop_atomic_data, estimate_tokens
+from components.question_utils import QuestionClusters, clean_questions, normalize_question
+from components.scheduler_utils import RequestScheduler, LANES, backoff_delay, parse_duration
+from components.resilience_utils import CircuitBreaker, CircuitOpenError, LatencyTracker, hedged
+from components.telemetry_utils import timed
+from config import (
+    LLM_MAX_CONCURRENCY, LLM_CACHE_BACKEND, PROMPT_TOKEN_BUDGETS,
+    REASONING_CHAIN_BATCH_SIZE, REASONING_CHAIN_BATCH_ATTEMPTS,
+    LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_EXPECTED_COMPLETION_TOKENS,
+    LLM_MAX_RETRIES, LLM_BACKOFF_BASE_SECONDS, LLM_BACKOFF_MAX_SECONDS,
+    LLM_CALL_POLICIES, LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_MAX_FRACTION,
+    LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_SECONDS
+)
 
 # Securely access API key
 os.environ["OPENAI_API_KEY"] = api_key = st.secrets["global"]["OPENAI_API_KEY"]
 
-# Initialize the OpenAI client with API key
-client = OpenAI(api_key=api_key)
+# The async client, its request scheduler and the event loop they live on are created lazily
+# on a dedicated background thread, so Streamlit script threads can submit coroutines to it.
+# Every request, sync or async, goes through the scheduler.
+_async_loop = None
+_async_client = None
+_scheduler = None
+_async_lock = threading.Lock()
 
-@flexible_cache(backend='disk', ttl=3600)
-def generate_clinical_questions(combined_summary, lenses):
-    # Convert lenses to a tuple to make it hashable
-    lenses = tuple(lenses) if isinstance(lenses, list) else lenses
-    
+# Priority lane of the requests made in the current context (see llm_lane)
+_lane = contextvars.ContextVar('llm_lane', default=None)
+_default_lane = LANES[0]
+
+# Event abandoning the coroutines run from the current context once set (see cancellation_scope)
+_cancelled = contextvars.ContextVar('llm_cancelled', default=None)
+
+# Fraction of the account rate limits this process may use
+_rate_limit_share = 1.0
+
+# Errors retried with backoff; the client's own retries are disabled so the scheduler sees them
+_RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# Failures that count against the backend's circuit breaker and allow a degraded answer
+_BACKEND_FAILURES = (CircuitOpenError, TimeoutError, *_RETRYABLE_ERRORS)
+
+# Shared by every call, since they all reach the same backend; only used on the async loop
+_circuit_breaker = CircuitBreaker(LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_SECONDS)
+
+# api_utils function name -> LatencyTracker of its successful completions
+_latency_trackers = {}
+
+def _get_async_loop():
+    global _async_loop
+    with _async_lock:
+        if _async_loop is None:
+            _async_loop = asyncio.new_event_loop()
+            threading.Thread(target=_async_loop.run_forever, name="api-utils-async-loop", daemon=True).start()
+    return _async_loop
+
+def _get_async_client():
+    global _async_client, _scheduler
+    if _scheduler is None:
+        if _async_client is None:
+            _async_client = AsyncOpenAI(api_key=api_key, max_retries=0)
+        _scheduler = RequestScheduler(LLM_MAX_CONCURRENCY, LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, _rate_limit_share)
+    return _async_client, _scheduler
+
+def set_max_concurrency(limit):
+    """
+    Override config.LLM_MAX_CONCURRENCY for this process. Must be called before the first async request.
+    """
+    global LLM_MAX_CONCURRENCY
+    if _scheduler is not None:
+        raise RuntimeError("set_max_concurrency must be called before the async client is created")
+    LLM_MAX_CONCURRENCY = limit
+
+def set_rate_limit_share(share):
+    """
+    Limits this process to a fraction of config.LLM_REQUESTS_PER_MINUTE / LLM_TOKENS_PER_MINUTE
+    (and of the limits reported by the API), for processes sharing one API key. Must be called
+    before the first async request.
+    """
+    global _rate_limit_share
+    if _scheduler is not None:
+        raise RuntimeError("set_rate_limit_share must be called before the async client is created")
+    _rate_limit_share = share
+
+def set_client(client):
+    """
+    Sends this process's requests to client instead of the OpenAI API, e.g. one of the fake or
+    cassette clients of components.benchmark_utils. It must provide
+    chat.completions.with_raw_response.create like AsyncOpenAI. Must be called before the first
+    async request.
+    """
+    global _async_client
+    if _scheduler is not None:
+        raise RuntimeError("set_client must be called before the async client is created")
+    _async_client = client
+
+def set_default_lane(lane):
+    """
+    Sets the priority lane of requests made outside any llm_lane block in this process,
+    e.g. 'bulk' in batch workers.
+    """
+    global _default_lane
+    if lane not in LANES:
+        raise ValueError(f"Unknown lane {lane!r}; expected one of {LANES}")
+    _default_lane = lane
+
+@contextmanager
+def llm_lane(lane):
+    """
+    Runs the requests made inside the block, including those of coroutines passed to
+    run_async from it, in the given priority lane ('interactive' or 'bulk').
+    """
+    if lane not in LANES:
+        raise ValueError(f"Unknown lane {lane!r}; expected one of {LANES}")
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+def _current_lane():
+    return _lane.get() or _default_lane
+
+@contextmanager
+def cancellation_scope(cancelled):
+    """
+    Cancels the coroutines run with run_async or run_async_with_updates from the block, and so
+    their outstanding requests, once the threading.Event cancelled is set; those calls then raise
+    concurrent.futures.CancelledError. A thread cannot be stopped, so this is how a stage computed
+    on a worker thread (see pipeline_utils) stops spending once its result is no longer wanted.
+    """
+    token = _cancelled.set(cancelled)
+    try:
+        yield
+    finally:
+        _cancelled.reset(token)
+
+def _raise_if_cancelled(future):
+    cancelled = _cancelled.get()
+    if cancelled is not None and cancelled.is_set():
+        future.cancel()
+        raise concurrent.futures.CancelledError()
+
+async def _in_context(coro, context):
+    # Tasks on the loop thread do not inherit the submitting thread's context (priority lane,
+    # telemetry session and stage), so carry it over
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+def run_async(coro):
+    """
+    Run a coroutine on the shared api_utils event loop and block until it completes.
+
+    Args:
+    coro (coroutine): The coroutine to run, e.g. generate_reasoning_chain_async(...).
+
+    Returns:
+    The coroutine's result.
+    """
+    future = asyncio.run_coroutine_threadsafe(_in_context(coro, contextvars.copy_context()), _get_async_loop())
+    if _cancelled.get() is None:
+        return future.result()
+    while True:
+        _raise_if_cancelled(future)
+        try:
+            return future.result(timeout=0.1)
+        except concurrent.futures.TimeoutError:
+            continue
+
+def submit_async(coro):
+    """
+    Schedule a coroutine on the shared api_utils event loop without waiting for it.
+
+    Args:
+    coro (coroutine): The coroutine to run.
+
+    Returns:
+    concurrent.futures.Future: The coroutine's eventual result; cancel() cancels the coroutine.
+    """
+    return asyncio.run_coroutine_threadsafe(_in_context(coro, contextvars.copy_context()), _get_async_loop())
+
+def run_async_with_updates(make_coro, on_update):
+    """
+    Run a coroutine on the shared api_utils event loop, relaying the updates it emits to the
+    calling thread while it runs. This lets a Streamlit stage render partial results, since
+    Streamlit elements can only be updated from the script thread.
+
+    Args:
+    make_coro (callable): Called with an emit(update) callback; returns the coroutine to run.
+    on_update (callable): Called in the calling thread with each emitted update, in order.
+
+    Returns:
+    The coroutine's result.
+    """
+    updates = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(_in_context(make_coro(updates.put), contextvars.copy_context()), _get_async_loop())
+    while True:
+        _raise_if_cancelled(future)
+        finished = future.done()
+        try:
+            update = updates.get(timeout=0.1)
+        except queue.Empty:
+            if finished:
+                break
+            continue
+        on_update(update)
+    return future.result()
+
+async def gather_in_order(aws, on_result=None):
+    """
+    Await a list of awaitables concurrently and return their results in input order.
+    If given, on_result is called with each result as soon as it completes.
+    """
+    if on_result is None:
+        return await asyncio.gather(*aws)
+
+    async def reported(aw):
+        result = await aw
+        on_result(result)
+        return result
+
+    return await asyncio.gather(*[reported(aw) for aw in aws])
+
+def _prompt_tokens(kwargs):
+    return estimate_tokens(''.join(str(message.get('content', '')) for message in kwargs.get('messages', ())))
+
+def _request_tokens(kwargs):
+    # Estimated prompt tokens plus the expected completion, reserved from the tokens-per-minute budget
+    return _prompt_tokens(kwargs) + kwargs.get('max_tokens', LLM_EXPECTED_COMPLETION_TOKENS)
+
+def _retry_delay(scheduler, error, attempt):
+    # Delay before retrying a failed request; a 429 also holds back every other request
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    retry_after = parse_duration(headers.get('retry-after'))
+    delay = backoff_delay(attempt, LLM_BACKOFF_BASE_SECONDS, LLM_BACKOFF_MAX_SECONDS, retry_after)
+    if isinstance(error, RateLimitError):
+        scheduler.update_limits(headers)
+        scheduler.pause(delay)
+    return delay
+
+async def _start_request_async(scheduler, tokens, create):
+    """
+    Admits a request through the scheduler and starts it with create(), retrying retryable
+    errors with jittered exponential backoff. Returns the raw response while still holding the
+    scheduler slot, which the caller must release.
+    """
+    lane = _current_lane()
+    for attempt in itertools.count():
+        await scheduler.acquire(tokens, lane)
+        try:
+            raw = await create()
+        except _RETRYABLE_ERRORS as error:
+            scheduler.release(tokens)
+            if attempt >= LLM_MAX_RETRIES:
+                raise
+            await asyncio.sleep(_retry_delay(scheduler, error, attempt))
+            continue
+        except BaseException:
+            scheduler.release(tokens)
+            raise
+        scheduler.update_limits(raw.headers)
+        return raw
+
+async def _create_completion_async(**kwargs):
+    async_client, scheduler = _get_async_client()
+    tokens = _request_tokens(kwargs)
+    raw = await _start_request_async(
+        scheduler, tokens, lambda: async_client.chat.completions.with_raw_response.create(**kwargs)
+    )
+    used = None
+    try:
+        response = raw.parse()
+        used = response.usage.total_tokens if getattr(response, 'usage', None) else None
+        return response
+    finally:
+        scheduler.release(tokens, used)
+
+async def _stream_chunks_async(**kwargs):
+    # Chunks of a streamed chat completion; the scheduler slot is held until the stream ends
+    async_client, scheduler = _get_async_client()
+    tokens = _request_tokens(kwargs)
+    raw = await _start_request_async(
+        scheduler, tokens, lambda: async_client.chat.completions.with_raw_response.create(stream=True, **kwargs)
+    )
+    try:
+        async for chunk in raw.parse():
+            yield chunk
+    finally:
+        scheduler.release(tokens)
+
+def _call_policy(call):
+    # LLM_CALL_POLICIES entry of an api_utils function, on top of the defaults
+    return {**LLM_CALL_POLICIES['default'], **LLM_CALL_POLICIES.get(call, {})}
+
+@asynccontextmanager
+async def _guarded(call, model):
+    """
+    Applies the call's deadline and the circuit breaker to the requests made inside the block:
+    fails fast with CircuitOpenError while the circuit is open, and records the outcome. The
+    block is recorded as one LLM call in the telemetry; it yields the telemetry fields, to
+    which the caller adds tokens_in and tokens_out.
+    """
+    with timed('llm', call, model) as telemetry:
+        _circuit_breaker.before_call()
+        try:
+            async with asyncio.timeout(_call_policy(call)['timeout']):
+                yield telemetry
+        except (TimeoutError, *_RETRYABLE_ERRORS):
+            _circuit_breaker.record_failure()
+            raise
+        except BaseException:
+            _circuit_breaker.cancel_probe()
+            raise
+        else:
+            _circuit_breaker.record_success()
+
+async def _complete_async(call, **kwargs):
+    """
+    Chat completion for the api_utils function named call, under its LLM_CALL_POLICIES entry:
+    a deadline, the circuit breaker and, when enabled, a hedged duplicate request once the call
+    runs past the observed latency percentile.
+    """
+    policy = _call_policy(call)
+    tracker = _latency_trackers.setdefault(call, LatencyTracker())
+    hedge_after = None
+    if policy['hedge'] and tracker.hedges < LLM_HEDGE_MAX_FRACTION * tracker.calls:
+        hedge_after = tracker.percentile(policy['hedge_percentile'], LLM_HEDGE_MIN_SAMPLES)
+    tracker.calls += 1
+    started = time.monotonic()
+    async with _guarded(call, kwargs.get('model')) as telemetry:
+        response, was_hedged = await hedged(lambda: _create_completion_async(**kwargs), hedge_after)
+        usage = getattr(response, 'usage', None)
+        telemetry['tokens_in'] = usage.prompt_tokens if usage else _prompt_tokens(kwargs)
+        telemetry['tokens_out'] = usage.completion_tokens if usage else estimate_tokens(response.choices[0].message.content or '')
+    tracker.hedges += was_hedged
+    tracker.record(time.monotonic() - started)
+    return response
+
+def _complete(call, **kwargs):
+    # Blocking variant of _complete_async for the sync functions, on the same scheduler
+    return run_async(_complete_async(call, **kwargs))
+
+def _degrade_on_failure(call, degraded):
+    """
+    Decorator returning degraded(*args, **kwargs) instead of raising when the backend fails or
+    the circuit is open, if the call's policy enables 'degrade'; degraded must also accept the
+    keyword arguments of the variants it wraps (e.g. on_text). Apply it outside flexible_cache
+    so degraded answers are never cached; cached answers are still served first.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                try:
+                    return await func(*args, **kwargs)
+                except _BACKEND_FAILURES:
+                    if not _call_policy(call)['degrade']:
+                        raise
+                    return degraded(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                try:
+                    return func(*args, **kwargs)
+                except _BACKEND_FAILURES:
+                    if not _call_policy(call)['degrade']:
+                        raise
+                    return degraded(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def stream_completion(call='stream_completion', **kwargs):
+    """
+    Stream a chat completion and yield its content tokens as they arrive, under the deadline
+    and circuit breaker of the api_utils function named call.
+    """
+    tokens = queue.Queue()
+    finished = object()
+
+    async def relay():
+        try:
+            async with _guarded(call, kwargs.get('model')) as telemetry:
+                telemetry['tokens_in'] = _prompt_tokens(kwargs)
+                telemetry['tokens_out'] = 0
+                async for chunk in _stream_chunks_async(**kwargs):
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        tokens.put(chunk.choices[0].delta.content)
+                        telemetry['tokens_out'] += estimate_tokens(chunk.choices[0].delta.content)
+        finally:
+            tokens.put(finished)
+
+    future = asyncio.run_coroutine_threadsafe(_in_context(relay(), contextvars.copy_context()), _get_async_loop())
+    while True:
+        _raise_if_cancelled(future)
+        try:
+            token = tokens.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if token is finished:
+            break
+        yield token
+    future.result()
+
+def _stream_text(call, on_text, **kwargs):
+    # Report the text received so far after every token and return the full content
+    content = ''
+    for token in stream_completion(call, **kwargs):
+        content += token
+        on_text(content)
+    return content
+
+async def _stream_lines_async(call, **kwargs):
+    """
+    Stream a chat completion and yield each line of its content as soon as the line is complete.
+    The yielded lines are exactly those of splitting the full response content on newlines.
+    The stream runs under the deadline and circuit breaker of the api_utils function named call.
+    """
+    buffer = ''
+    async with _guarded(call, kwargs.get('model')) as telemetry:
+        telemetry['tokens_in'] = _prompt_tokens(kwargs)
+        telemetry['tokens_out'] = 0
+        async for chunk in _stream_chunks_async(**kwargs):
+            if not chunk.choices:
+                continue
+            buffer += chunk.choices[0].delta.content or ''
+            telemetry['tokens_out'] += estimate_tokens(chunk.choices[0].delta.content or '')
+            while '\n' in buffer:
+                line, buffer = buffer.split('\n', 1)
+                yield line
+    yield buffer
+
+def _summary_strings(combined_summary):
     combined_summary_dict = json.loads(combined_summary)
     patient_summary = combined_summary_dict["Patient Summary"]
     progress_summary = combined_summary_dict["Progress Summary"]
 
     patient_summary_str = "\n".join([f"{key}: {value}" for key, value in patient_summary.items()])
     progress_summary_str = "\n".join([f"{key}: {value}" for key, value in progress_summary.items()])
+    return patient_summary_str, progress_summary_str
+
+def _clinical_questions_messages(patient_summary_str, progress_summary_str, lens):
+    # Per-visit atomic data is the first thing to go for patients with long histories
+    prompt = compile_prompt('clinical_questions', [
+        {'text': f"Patient Summary:\n{patient_summary_str}", 'priority': 2},
+        {'text': f"Progress Summary:\n{progress_summary_str}", 'priority': 1,
+         'compact': [f"Progress Summary:\n{drop_atomic_data(progress_summary_str)}"]},
+        {'text': (
+            f"Generate key clinical questions to assess the patient's risk of readmission through the lens of '{lens}'. "
+            "Each question should be concise and focused on a specific aspect of the patient's condition or care."
+        )}
+    ], PROMPT_TOKEN_BUDGETS['clinical_questions'])
+    return [
+        {
+            "role": "system",
+            "content": (
+                "You are a clinical decision support system designed to analyze complex patient data and generate key clinical questions "
+                f"with a focus on '{lens}'. Your task is to create focused, relevant questions that will help assess the patient's risk of readmission."
+            )
+        },
+        {"role": "user", "content": prompt}
+    ]
+
+@flexible_cache(backend=LLM_CACHE_BACKEND, ttl=3600, unordered_args=('lenses',))
+def generate_clinical_questions(combined_summary, lenses):
+    # Convert lenses to a tuple to make it hashable
+    lenses = tuple(lenses) if isinstance(lenses, list) else lenses
+    if len(lenses) > 1:
+        # Assembled from the entries of the individual lenses, so any selection reuses them
+        return [question for lens in lenses for question in generate_clinical_questions(combined_summary, (lens,))]
+    
+    patient_summary_str, progress_summary_str = _summary_strings(combined_summary)
     
     all_questions = []
     for lens in lenses:
-        prompt = (
-            f"Patient Summary:\n{patient_summary_str}\n"
-            f"Progress Summary:\n{progress_summary_str}\n"
-            f"Generate key clinical questions to assess the patient's risk of readmission through the lens of '{lens}'. "
-            "Each question should be concise and focused on a specific aspect of the patient's condition or care."
-        )
-        response = client.chat.completions.create(
+        response = _complete(
+            'generate_clinical_questions',
             model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a clinical decision support system designed to analyze complex patient data and generate key clinical questions "
-                        f"with a focus on '{lens}'. Your task is to create focused, relevant questions that will help assess the patient's risk of readmission."
-                    )
-                },
-                {"role": "user", "content": prompt}
-            ]
+            messages=_clinical_questions_messages(patient_summary_str, progress_summary_str, lens)
         )
-        questions = response.choices[0].message.content.split('\n')
+        # Blank lines, headers and numbering would each become a reasoning chain request
+        questions = clean_questions(response.choices[0].message.content.split('\n'))
         all_questions.extend(questions)
     return all_questions
 
-@flexible_cache(backend='disk', ttl=3600)
-def generate_reasoning_chain(question, relevant_data, guidelines, lenses):
-    prompt = f"""
-    Clinical Question: {question}
-    Relevant Patient Data: {relevant_data}
-    Clinical Guidelines: {guidelines}
-    Lenses: {', '.join(lenses)}
+@flexible_cache(backend=LLM_CACHE_BACKEND, ttl=3600, namespace='generate_clinical_questions', unordered_args=('lenses',))
+async def generate_clinical_questions_async(combined_summary, lenses):
+    """
+    Async variant of generate_clinical_questions. One request per lens is issued concurrently;
+    questions are returned in lens order and share cache entries with the sync function.
+    """
+    lenses = tuple(lenses) if isinstance(lenses, list) else lenses
+    if len(lenses) > 1:
+        # Assembled from the entries of the individual lenses, so any selection reuses them
+        questions_per_lens = await gather_in_order([generate_clinical_questions_async(combined_summary, (lens,)) for lens in lenses])
+        return [question for questions in questions_per_lens for question in questions]
+
+    patient_summary_str, progress_summary_str = _summary_strings(combined_summary)
+
+    responses = await gather_in_order([
+        _complete_async(
+            'generate_clinical_questions',
+            model="gpt-4o-mini",
+            messages=_clinical_questions_messages(patient_summary_str, progress_summary_str, lens)
+        )
+        for lens in lenses
+    ])
+
+    all_questions = []
+    for response in responses:
+        all_questions.extend(clean_questions(response.choices[0].message.content.split('\n')))
+    return all_questions
+
+async def prefetch_clinical_questions(combined_summary, lenses, budget):
+    """
+    Speculatively generates the clinical questions of each lens on its own, in the 'bulk' lane,
+    so that generating questions for any selection of these lenses later is a cache hit.
+
+    Args:
+    combined_summary (str): JSON with "Patient Summary" and "Progress Summary", as for generate_clinical_questions.
+    lenses (list): Every lens that might be selected.
+    budget (TokenBucket): Caps the speculative spend; lenses whose estimated request tokens
+        are not available are skipped.
+
+    Returns:
+    list: The lenses whose questions were requested (already cached or skipped lenses excluded).
+    """
+    patient_summary_str, progress_summary_str = _summary_strings(combined_summary)
+
+    async def prefetch(lens):
+        hit, _ = generate_clinical_questions_async.cache_get(combined_summary, (lens,))
+        tokens = _request_tokens({'messages': _clinical_questions_messages(patient_summary_str, progress_summary_str, lens)})
+        if hit or budget.wait_time(tokens) > 0:
+            return False
+        budget.take(tokens)
+        try:
+            await generate_clinical_questions_async(combined_summary, (lens,))
+        except Exception:
+            # Speculative: the stage requests the lens itself if it is selected
+            return False
+        return True
+
+    with llm_lane('bulk'):
+        prefetched = await gather_in_order([prefetch(lens) for lens in lenses])
+    return [lens for lens, requested in zip(lenses, prefetched) if requested]
+
+def _reasoning_chain_messages(question, relevant_data, guidelines, lenses):
+    prompt = compile_prompt('reasoning_chain', [
+        {'text': f"\n    Clinical Question: {question}"},
+        {'text': f"    Relevant Patient Data: {relevant_data}", 'priority': 2,
+         'compact': [f"    Relevant Patient Data: {drop_atomic_data(str(relevant_data))}"]},
+        {'text': f"    Clinical Guidelines: {guidelines}", 'priority': 1},
+        {'text': f"""    Lenses: {', '.join(lenses)}
 
     Generate a detailed reasoning chain to address the clinical question. 
     Consider the relevant patient data and clinical guidelines.
     Provide a step-by-step logical progression that leads to a conclusion or recommendation.
-    """
+    """}
+    ], PROMPT_TOKEN_BUDGETS['reasoning_chain'])
+    return [
+        {
+            "role": "system",
+            "content": "You are a clinical decision support system designed to generate detailed reasoning chains based on clinical questions, patient data, and guidelines."
+        },
+        {"role": "user", "content": prompt}
+    ]
+
+def _degraded_reasoning_chain(question, relevant_data, guidelines, lenses, *_, **__):
+    # Placeholder chain shown while the LLM backend is unavailable; never cached
+    return {
+        'question': question,
+        'steps': ["Reasoning chain unavailable: the language model did not respond in time. Rerun this stage to retry."],
+        'degraded': True
+    }
 
-    response = client.chat.completions.create(
+@_degrade_on_failure('generate_reasoning_chain', _degraded_reasoning_chain)
+@flexible_cache(backend=LLM_CACHE_BACKEND, ttl=3600, unordered_args=('lenses',))
+def generate_reasoning_chain(question, relevant_data, guidelines, lenses):
+    response = _complete(
+        'generate_reasoning_chain',
         model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a clinical decision support system designed to generate detailed reasoning chains based on clinical questions, patient data, and guidelines."
-            },
-            {"role": "user", "content": prompt}
-        ]
+        messages=_reasoning_chain_messages(question, relevant_data, guidelines, lenses)
     )
 
     reasoning_chain = response.choices[0].message.content.split('\n')
@@ -78,21 +601,253 @@ def generate_reasoning_chain(question, relevant_data, guidelines, lenses):
         'steps': reasoning_chain
     }
 
-@flexible_cache(backend='disk', ttl=3600)
-def validate_reasoning_chain(chain, patient_summary, progress_summary):
-    prompt = f"""
-    Validate the following reasoning chain:
+@_degrade_on_failure('generate_reasoning_chain', _degraded_reasoning_chain)
+@flexible_cache(backend=LLM_CACHE_BACKEND, ttl=3600, namespace='generate_reasoning_chain', unordered_args=('lenses',))
+async def generate_reasoning_chain_async(question, relevant_data, guidelines, lenses):
+    """
+    Async variant of generate_reasoning_chain, sharing its cache entries.
+    """
+    response = await _complete_async(
+        'generate_reasoning_chain',
+        model="gpt-4o-mini",
+        messages=_reasoning_chain_messages(question, relevant_data, guidelines, lenses)
+    )
 
-    Reasoning Chain:
-    {chain}
+    reasoning_chain = response.choices[0].message.content.split('\n')
+    return {
+        'question': question,
+        'steps': reasoning_chain
+    }
+
+# Structured response for batched reasoning chains; ids are the 1-based question numbers in the prompt
+_REASONING_CHAIN_BATCH_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "reasoning_chains",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "chains": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "steps": {"type": "array", "items": {"type": "string"}}
+                        },
+                        "required": ["id", "steps"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["chains"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def _reasoning_chain_batch_messages(items, lenses):
+    # Patient data and guidelines shared by every question are sent once rather than per question
+    shared_data = len({relevant_data for _, relevant_data, _ in items}) == 1
+    shared_guidelines = len({guidelines for _, _, guidelines in items}) == 1
+    sections = []
+    if shared_data:
+        sections.append({'text': f"Relevant Patient Data: {items[0][1]}", 'priority': 2,
+                         'compact': [f"Relevant Patient Data: {drop_atomic_data(str(items[0][1]))}"]})
+    if shared_guidelines:
+        sections.append({'text': f"Clinical Guidelines: {items[0][2]}", 'priority': 1})
+    sections.append({'text': f"Lenses: {', '.join(lenses)}\n"})
+    for number, (question, relevant_data, guidelines) in enumerate(items, 1):
+        lines = [f"Question {number}: {question}"]
+        if not shared_data:
+            lines.append(f"  Relevant Patient Data: {relevant_data}")
+        if not shared_guidelines:
+            lines.append(f"  Clinical Guidelines: {guidelines}")
+        sections.append({'text': "\n".join(lines)})
+    sections.append({'text': (
+        "\nFor each question, generate a detailed reasoning chain to address it. "
+        "Consider the relevant patient data and clinical guidelines. "
+        "Provide a step-by-step logical progression that leads to a conclusion or recommendation. "
+        "Return one entry per question in 'chains', with the question number as 'id' and the reasoning steps in order as 'steps'."
+    )})
+    return [
+        {
+            "role": "system",
+            "content": "You are a clinical decision support system designed to generate detailed reasoning chains based on clinical questions, patient data, and guidelines."
+        },
+        {"role": "user", "content": compile_prompt('reasoning_chain_batch', sections, PROMPT_TOKEN_BUDGETS['reasoning_chain_batch'])}
+    ]
+
+def _parse_reasoning_chain_batch(content, count):
+    # Maps question number -> steps, skipping malformed entries so only those questions are retried
+    try:
+        chains = json.loads(content)["chains"]
+    except (ValueError, KeyError, TypeError):
+        return {}
+    steps_by_number = {}
+    for chain in chains if isinstance(chains, list) else []:
+        if not isinstance(chain, dict):
+            continue
+        number, steps = chain.get("id"), chain.get("steps")
+        if isinstance(number, int) and 1 <= number <= count and isinstance(steps, list) and steps:
+            steps_by_number.setdefault(number, [str(step) for step in steps])
+    return steps_by_number
+
+async def generate_reasoning_chains_batched_async(items, lenses, on_chain=None):
+    """
+    Generate reasoning chains for several questions with REASONING_CHAIN_BATCH_SIZE questions per request.
+
+    Each request asks for a JSON response holding one chain per question. Chains are cached
+    per question in generate_reasoning_chain's cache, so cached questions are never sent and
+    batched and single-question calls share results. Questions missing from a response are
+    re-batched up to REASONING_CHAIN_BATCH_ATTEMPTS times, then requested one at a time.
+
+    Args:
+    items (list): (question, relevant_data, guidelines) tuples.
+    lenses (tuple): The selected lenses.
+    on_chain (callable, optional): Called with each reasoning chain as soon as it is available.
 
-    Patient Summary:
-    {patient_summary}
+    Returns:
+    list: {'question', 'steps'} reasoning chains, in the order of items.
+    """
+    lenses = tuple(lenses) if isinstance(lenses, list) else lenses
+    chains = [None] * len(items)
+
+    def resolved(index, chain):
+        chains[index] = chain
+        if on_chain is not None:
+            on_chain(chain)
+
+    pending = []
+    for index, item in enumerate(items):
+        hit, chain = generate_reasoning_chain_async.cache_get(*item, lenses)
+        if hit:
+            resolved(index, chain)
+        else:
+            pending.append(index)
+
+    async def run_batch(indices):
+        for _ in range(REASONING_CHAIN_BATCH_ATTEMPTS):
+            if not indices:
+                return
+            try:
+                response = await _complete_async(
+                    'generate_reasoning_chains_batched',
+                    model="gpt-4o-mini",
+                    messages=_reasoning_chain_batch_messages([items[index] for index in indices], lenses),
+                    response_format=_REASONING_CHAIN_BATCH_FORMAT
+                )
+            except _BACKEND_FAILURES:
+                # Leave the remaining questions to the single-question path and its policy
+                break
+            steps_by_number = _parse_reasoning_chain_batch(response.choices[0].message.content, len(indices))
+            missing = []
+            for number, index in enumerate(indices, 1):
+                if number not in steps_by_number:
+                    missing.append(index)
+                    continue
+                chain = {'question': items[index][0], 'steps': steps_by_number[number]}
+                generate_reasoning_chain_async.cache_set(chain, *items[index], lenses)
+                resolved(index, chain)
+            indices = missing
+        for index, chain in zip(indices, await gather_in_order(
+            [generate_reasoning_chain_async(*items[index], lenses) for index in indices]
+        )):
+            resolved(index, chain)
+
+    batch_size = max(1, REASONING_CHAIN_BATCH_SIZE)
+    await gather_in_order([run_batch(pending[start:start + batch_size]) for start in range(0, len(pending), batch_size)])
+    return chains
+
+async def generate_reasoning_chains_pipelined(combined_summary, lenses, chain_inputs, on_chain=None):
+    """
+    Generate clinical questions and their reasoning chains with the two phases overlapped.
+
+    Question responses are streamed per lens, and questions are handed to chain requests as soon
+    as their lines are complete (in groups of REASONING_CHAIN_BATCH_SIZE), instead of waiting for
+    all lenses to finish. A question close to one seen before, from any lens, is not sent: its
+    cluster's chain answers it (see question_utils.QuestionClusters).
+
+    Args:
+    combined_summary (str): JSON with "Patient Summary" and "Progress Summary", as for generate_clinical_questions.
+    lenses (tuple): The selected lenses.
+    chain_inputs (callable): Maps a question to its (relevant_data, guidelines).
+    on_chain (callable, optional): Called with each reasoning chain as soon as it completes.
+
+    Returns:
+    tuple: (questions, reasoning_chains): the questions in lens and question order, and one chain
+    per cluster of questions, listing the lenses and similar questions it answers.
+    """
+    lenses = tuple(lenses) if isinstance(lenses, list) else lenses
 
-    Progress Summary:
-    {progress_summary}
+    batch_size = max(1, REASONING_CHAIN_BATCH_SIZE)
 
-    Provide:
+    async def chains_for(questions):
+        items = [(question, *chain_inputs(question)) for question in questions]
+        if batch_size > 1:
+            return await generate_reasoning_chains_batched_async(items, lenses, on_chain=on_chain)
+        return await gather_in_order([generate_reasoning_chain_async(*item, lenses) for item in items], on_result=on_chain)
+
+    patient_summary_str, progress_summary_str = _summary_strings(combined_summary)
+    questions_per_lens = [[] for _ in lenses]
+    clusters = QuestionClusters()
+    # (questions, task generating their chains) in the order the batches were started
+    chain_batches = []
+
+    async def stream_lens(index, lens):
+        batch = []
+
+        def add(question):
+            questions_per_lens[index].append(question)
+            if clusters.add(question, lens)[1]:
+                batch.append(question)
+                if len(batch) == batch_size:
+                    chain_batches.append((batch[:], asyncio.ensure_future(chains_for(batch[:]))))
+                    batch.clear()
+
+        # Questions of a single lens may already be cached, e.g. by prefetch_clinical_questions
+        hit, cached_questions = generate_clinical_questions_async.cache_get(combined_summary, (lens,))
+        if hit:
+            for question in cached_questions:
+                add(question)
+        else:
+            async for line in _stream_lines_async(
+                'generate_clinical_questions',
+                model="gpt-4o-mini",
+                messages=_clinical_questions_messages(patient_summary_str, progress_summary_str, lens)
+            ):
+                question = normalize_question(line)
+                if question is not None and question not in questions_per_lens[index]:
+                    add(question)
+            generate_clinical_questions_async.cache_set(questions_per_lens[index], combined_summary, (lens,))
+        if batch:
+            chain_batches.append((batch, asyncio.ensure_future(chains_for(batch))))
+
+    try:
+        await gather_in_order([stream_lens(index, lens) for index, lens in enumerate(lenses)])
+    except BaseException:
+        for _, task in chain_batches:
+            task.cancel()
+        raise
+
+    questions = [question for lens_questions in questions_per_lens for question in lens_questions]
+    generate_clinical_questions_async.cache_set(questions, combined_summary, lenses)
+
+    chains_per_batch = await gather_in_order([task for _, task in chain_batches])
+    chains_by_question = {
+        question: chain for (batch, _), chains in zip(chain_batches, chains_per_batch) for question, chain in zip(batch, chains)
+    }
+    return questions, clusters.cluster_chains(chains_by_question, questions, lenses)
+
+def _validation_messages(chain, patient_summary, progress_summary):
+    prompt = compile_prompt('validation', [
+        {'text': f"\n    Validate the following reasoning chain:\n\n    Reasoning Chain:\n    {chain}\n", 'priority': 3},
+        {'text': f"    Patient Summary:\n    {patient_summary}\n", 'priority': 2,
+         'compact': [f"    Patient Summary:\n    {drop_atomic_data(str(patient_summary))}\n"]},
+        {'text': f"    Progress Summary:\n    {progress_summary}\n", 'priority': 1,
+         'compact': [f"    Progress Summary:\n    {drop_atomic_data(str(progress_summary))}\n"]},
+        {'text': """    Provide:
     1. The clinical question this reasoning chain addresses
     2. Validation points (including references to patient data and clinical guidelines)
     3. Validation status (Validated, Needs Review, or Rejected)
@@ -103,21 +858,17 @@ def validate_reasoning_chain(chain, patient_summary, progress_summary):
     Validation Points: [Your answer here]
     Validation Status: [Your answer here]
     Recommendation: [Your answer here]
-    """
-
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a clinical decision support system designed to validate reasoning chains based on patient data and medical knowledge."
-            },
-            {"role": "user", "content": prompt}
-        ]
-    )
+    """}
+    ], PROMPT_TOKEN_BUDGETS['validation'])
+    return [
+        {
+            "role": "system",
+            "content": "You are a clinical decision support system designed to validate reasoning chains based on patient data and medical knowledge."
+        },
+        {"role": "user", "content": prompt}
+    ]
 
-    content = response.choices[0].message.content
-    
+def _parse_validation(content):
     # Parse the response
     lines = content.split('\n')
     result = {
@@ -145,7 +896,79 @@ def validate_reasoning_chain(chain, patient_summary, progress_summary):
 
     return result
 
-@lru_cache(maxsize=32)
+def _degraded_validation(chain, patient_summary, progress_summary, *_, **__):
+    # Validation result shown while the LLM backend is unavailable; never cached
+    return {
+        'clinical_question': chain.get('question', 'Not provided') if isinstance(chain, dict) else 'Not provided',
+        'validation_points': "Not validated: the language model did not respond in time. Rerun this stage to retry.",
+        'validation_status': 'Needs Review',
+        'recommendation': 'Not provided',
+        'degraded': True
+    }
+
+@_degrade_on_failure('validate_reasoning_chain', _degraded_validation)
+@flexible_cache(backend=LLM_CACHE_BACKEND, ttl=3600)
+def validate_reasoning_chain(chain, patient_summary, progress_summary):
+    response = _complete(
+        'validate_reasoning_chain',
+        model="gpt-4o-mini",
+        messages=_validation_messages(chain, patient_summary, progress_summary)
+    )
+    return _parse_validation(response.choices[0].message.content)
+
+@_degrade_on_failure('validate_reasoning_chain', _degraded_validation)
+@flexible_cache(backend=LLM_CACHE_BACKEND, ttl=3600, namespace='validate_reasoning_chain')
+async def validate_reasoning_chain_async(chain, patient_summary, progress_summary):
+    """
+    Async variant of validate_reasoning_chain, sharing its cache entries.
+    """
+    response = await _complete_async(
+        'validate_reasoning_chain',
+        model="gpt-4o-mini",
+        messages=_validation_messages(chain, patient_summary, progress_summary)
+    )
+    return _parse_validation(response.choices[0].message.content)
+
+@_degrade_on_failure('validate_reasoning_chain', _degraded_validation)
+def validate_reasoning_chain_streaming(chain, patient_summary, progress_summary, on_text):
+    """
+    Streaming variant of validate_reasoning_chain: on_text is called with the raw validation
+    text received so far. The parsed result is stored in validate_reasoning_chain's cache.
+    """
+    hit, result = validate_reasoning_chain.cache_get(chain, patient_summary, progress_summary)
+    if hit:
+        return result
+
+    content = _stream_text(
+        'validate_reasoning_chain',
+        on_text,
+        model="gpt-4o-mini",
+        messages=_validation_messages(chain, patient_summary, progress_summary)
+    )
+    result = _parse_validation(content)
+    validate_reasoning_chain.cache_set(result, chain, patient_summary, progress_summary)
+    return result
+
+def _propositions_messages(prompt):
+    # The prompt is built by the caller; this only guarantees the request stays within budget
+    prompt = compile_prompt('propositions', [{'text': prompt, 'priority': 0}], PROMPT_TOKEN_BUDGETS['propositions'])
+    return [
+        {
+            "role": "system",
+            "content": "You are a clinical decision support system designed to generate concise, actionable propositions based on patient data and clinical scenarios."
+        },
+        {"role": "user", "content": prompt}
+    ]
+
+def _parse_propositions(content):
+    propositions = content.split('\n')
+    
+    # Clean up the propositions (remove empty lines and numbering)
+    propositions = [prop.strip() for prop in propositions if prop.strip()]
+    propositions = [prop[prop.find('.') + 1:].strip() if prop[0].isdigit() else prop for prop in propositions]
+    return propositions
+
+@flexible_cache(backend=LLM_CACHE_BACKEND, ttl=3600)
 def generate_propositions(prompt):
     """
     Generate propositions based on the given prompt using the OpenAI API.
@@ -156,23 +979,38 @@ def generate_propositions(prompt):
     Returns:
     list: A list of generated propositions.
     """
-    response = client.chat.completions.create(
+    response = _complete(
+        'generate_propositions',
         model="gpt-4",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a clinical decision support system designed to generate concise, actionable propositions based on patient data and clinical scenarios."
-            },
-            {"role": "user", "content": prompt}
-        ]
+        messages=_propositions_messages(prompt)
     )
 
     # Extract the generated propositions from the API response
-    propositions = response.choices[0].message.content.split('\n')
-    
-    # Clean up the propositions (remove empty lines and numbering)
-    propositions = [prop.strip() for prop in propositions if prop.strip()]
-    propositions = [prop[prop.find('.') + 1:].strip() if prop[0].isdigit() else prop for prop in propositions]
+    return _parse_propositions(response.choices[0].message.content)
 
+def generate_propositions_streaming(prompt, on_text):
+    """
+    Streaming variant of generate_propositions: on_text is called with the text received so far.
+    The cleaned-up propositions are stored in generate_propositions' cache.
+    """
+    hit, propositions = generate_propositions.cache_get(prompt)
+    if hit:
+        return propositions
+
+    content = _stream_text('generate_propositions', on_text, model="gpt-4", messages=_propositions_messages(prompt))
+    propositions = _parse_propositions(content)
+    generate_propositions.cache_set(propositions, prompt)
     return propositions
 
+@flexible_cache(backend=LLM_CACHE_BACKEND, ttl=3600, namespace='generate_propositions')
+async def generate_propositions_async(prompt):
+    """
+    Async variant of generate_propositions.
+    """
+    response = await _complete_async(
+        'generate_propositions',
+        model="gpt-4",
+        messages=_propositions_messages(prompt)
+    )
+    return _parse_propositions(response.choices[0].message.content)
+
@@ -0,0 +1,384 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
+import httpx
+import openai
+from components.prompt_utils import estimate_tokens
+
+# Kinds of injected API errors, as accepted by parse_error_rates
+ERROR_KINDS = ('rate_limit', 'server_error', 'timeout', 'connection')
+
+_QUESTION_PATTERN = re.compile(r"^Question (\d+): (.*)$", re.M)
+_LENS_PATTERN = re.compile(r"through the lens of '([^']*)'")
+_FILLER_WORDS = (
+    "patient", "readmission", "risk", "glycemic", "control", "medication", "adherence", "follow-up",
+    "discharge", "inpatient", "visits", "A1C", "insulin", "metformin", "comorbidities", "outpatient",
+    "emergency", "monitoring", "education", "trend", "recent", "elevated", "stable", "care", "plan"
+)
+
+# Clinical questions the fake client asks, each in two phrasings; lenses draw from the same topics, so
+# like real responses they partly ask the same questions in different words
+_QUESTION_TOPICS = (
+    ("How many times has the patient been readmitted within 30 days?", "How often was the patient readmitted within 30 days?"),
+    ("What is the trend of the patient's A1C levels?", "How have A1C levels trended over recent visits?"),
+    ("Is the patient adherent to the prescribed insulin regimen?", "Does the patient adhere to the insulin regimen as prescribed?"),
+    ("Was the number of medications changed at discharge?", "Did the number of medications change at discharge?"),
+    ("Is the length of stay longer than expected for the diagnoses?", "Was the length of stay longer than expected given the diagnoses?"),
+    ("Did the patient receive diabetes education before discharge?", "Was diabetes education provided before discharge?"),
+    ("How many emergency visits preceded the admission?", "How many emergency visits did the patient have before admission?"),
+    ("Are comorbidities complicating glycemic control?", "Do comorbidities complicate the patient's glycemic control?"),
+    ("Was an outpatient follow-up scheduled after discharge?", "Has outpatient follow-up been scheduled after discharge?"),
+    ("Is metformin appropriate given the patient's renal function?", "Given renal function, is metformin appropriate for the patient?"),
+    ("Were lab procedures repeated without a change in management?", "Were lab procedures repeated with no change in management?"),
+    ("Does the discharge disposition support safe recovery at home?", "Is the discharge disposition safe for recovery at home?"),
+)
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution for the fake client.
+
+    Args:
+    spec (str): 'fixed:SECONDS', 'uniform:LOW,HIGH', 'lognormal:MEDIAN,SIGMA' or 'exponential:MEAN'.
+
+    Returns:
+    callable: Draws a latency in seconds from a random.Random.
+    """
+    kind, _, params = spec.partition(':')
+    try:
+        values = [float(value) for value in params.split(',')] if params else []
+        if kind == 'fixed' and len(values) == 1:
+            return lambda rng: values[0]
+        if kind == 'uniform' and len(values) == 2:
+            return lambda rng: rng.uniform(*values)
+        if kind == 'lognormal' and len(values) == 2:
+            return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+        if kind == 'exponential' and len(values) == 1:
+            return lambda rng: rng.expovariate(1 / values[0])
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid latency distribution {spec!r}")
+
+def parse_error_rates(spec):
+    """
+    Parses injected error rates such as 'rate_limit:0.02,server_error:0.01' into {kind: probability}.
+    """
+    rates = {}
+    for part in filter(None, (part.strip() for part in (spec or '').split(','))):
+        kind, _, rate = part.partition(':')
+        if kind not in ERROR_KINDS:
+            raise ValueError(f"Unknown error kind {kind!r}; expected one of {ERROR_KINDS}")
+        rates[kind] = float(rate)
+    return rates
+
+class RequestLog:
+    """
+    Counts the requests a benchmark client served: calls, injected or real errors and the tokens
+    of completed responses (a request cancelled midway, e.g. the loser of a hedge, uses none).
+    """
+
+    def __init__(self):
+        self._counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self._counts[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {name: self._counts[name] for name in ('calls', 'errors', 'prompt_tokens', 'completion_tokens')}
+
+class _RawResponse:
+    # What chat.completions.with_raw_response.create returns, as far as api_utils uses it
+    def __init__(self, value, headers=None):
+        self.value = value
+        self.headers = headers or {}
+
+    def parse(self):
+        return self.value
+
+def _completion(model, content, prompt_tokens, completion_tokens):
+    return SimpleNamespace(
+        model=model,
+        choices=[SimpleNamespace(index=0, message=SimpleNamespace(role='assistant', content=content), finish_reason='stop')],
+        usage=SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+    )
+
+def _chunk(model, content):
+    return SimpleNamespace(model=model, choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=content), finish_reason=None)])
+
+async def _stream(model, content, seconds, on_done):
+    # Yields content in small chunks spread over seconds, the first after a third of it
+    pieces = re.findall(r"\S*\s*", content)[:-1] or [content]
+    await asyncio.sleep(seconds / 3)
+    for piece in pieces:
+        await asyncio.sleep(2 * seconds / 3 / len(pieces))
+        yield _chunk(model, piece)
+    on_done()
+
+def _prompt_tokens(messages):
+    return estimate_tokens(''.join(str(message.get('content', '')) for message in messages))
+
+def _client_shape(create):
+    # client.chat.completions.with_raw_response.create, as on AsyncOpenAI
+    return SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=create)))
+
+def _api_error(kind):
+    request = httpx.Request('POST', 'https://fake-llm.invalid/v1/chat/completions')
+    if kind == 'timeout':
+        return openai.APITimeoutError(request=request)
+    if kind == 'connection':
+        return openai.APIConnectionError(request=request)
+    if kind == 'rate_limit':
+        response = httpx.Response(429, request=request, headers={'retry-after': '1'})
+        return openai.RateLimitError("Injected rate limit", response=response, body=None)
+    response = httpx.Response(500, request=request)
+    return openai.InternalServerError("Injected server error", response=response, body=None)
+
+class FakeAsyncOpenAI:
+    """
+    Stand-in for AsyncOpenAI that answers every prompt of api_utils with plausible synthetic
+    content after a random latency, and injects API errors at the given rates.
+
+    Answers depend only on the request, so repeated runs send identical follow-up prompts and
+    hit identical cache keys; latencies and errors come from a generator seeded with seed.
+    """
+
+    def __init__(self, latency='lognormal:0.5,0.4', error_rates=None, seed=0, questions_per_lens=5):
+        self.latency = parse_latency(latency) if isinstance(latency, str) else latency
+        self.error_rates = parse_error_rates(error_rates) if isinstance(error_rates, str) else dict(error_rates or {})
+        self.questions_per_lens = questions_per_lens
+        self.log = RequestLog()
+        self.chat = _client_shape(self._create)
+        self._rng = random.Random(seed)
+
+    async def _create(self, model, messages, stream=False, response_format=None, **kwargs):
+        self.log.add(calls=1)
+        seconds = self.latency(self._rng)
+        roll = self._rng.random()
+        for kind, rate in self.error_rates.items():
+            if roll < rate:
+                await asyncio.sleep(seconds / 4)
+                self.log.add(errors=1)
+                raise _api_error(kind)
+            roll -= rate
+
+        content = self.answer(messages, response_format)
+        prompt_tokens, completion_tokens = _prompt_tokens(messages), estimate_tokens(content)
+        done = lambda: self.log.add(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        if stream:
+            return _RawResponse(_stream(model, content, seconds, done))
+        await asyncio.sleep(seconds)
+        done()
+        return _RawResponse(_completion(model, content, prompt_tokens, completion_tokens))
+
+    def answer(self, messages, response_format=None):
+        """Synthetic response content for a request, shaped like the real answers to that prompt."""
+        system = str(messages[0].get('content', ''))
+        prompt = str(messages[-1].get('content', ''))
+        rng = random.Random(hashlib.sha256(json.dumps(messages, sort_keys=True, default=str).encode()).digest())
+
+        def sentence(words=12):
+            return ' '.join(rng.choice(_FILLER_WORDS) for _ in range(words)).capitalize()
+
+        if response_format is not None:
+            return json.dumps({'chains': [
+                {'id': int(number), 'steps': [f"Step {step}: {sentence()}." for step in range(1, rng.randint(3, 6))]}
+                for number, _ in _QUESTION_PATTERN.findall(prompt)
+            ]})
+        if 'generate key clinical questions' in system:
+            match = _LENS_PATTERN.search(prompt)
+            lens = match.group(1) if match else 'general'
+            topics = rng.sample(_QUESTION_TOPICS, min(self.questions_per_lens, len(_QUESTION_TOPICS)))
+            questions = [f"{number}. {rng.choice(phrasings)}" for number, phrasings in enumerate(topics, 1)]
+            return '\n'.join([f"Key clinical questions through the lens of {lens}:", "", *questions])
+        if 'validate reasoning chains' in system:
+            return '\n'.join([
+                f"Clinical Question: {sentence(10)}?",
+                f"Validation Points: {sentence(30)}.",
+                f"Validation Status: {rng.choice(['Validated', 'Validated', 'Needs Review', 'Rejected'])}",
+                f"Recommendation: {sentence(20)}.",
+            ])
+        if 'propositions' in system:
+            return '\n'.join(f"{number}. {sentence(15)}." for number in range(1, rng.randint(4, 8)))
+        return '\n'.join(f"Step {step}: {sentence()}." for step in range(1, rng.randint(4, 8)))
+
+class CassetteMissError(LookupError):
+    """Raised when a replayed run sends a request that was not recorded."""
+
+def request_key(kwargs):
+    """Cassette key of a request: a hash of everything but the streaming flag."""
+    request = {name: value for name, value in kwargs.items() if name != 'stream'}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+class CassetteClient:
+    """
+    Records the responses of another client (AsyncOpenAI or FakeAsyncOpenAI) to a JSONL
+    cassette, or replays a cassette without any network access.
+
+    Each line holds a request key, the response content, its token usage and latency. A
+    replayed request returns the recorded answers for its key in order (the last one again once
+    they run out) after the recorded latency times latency_scale; errors are not recorded.
+    """
+
+    def __init__(self, path, mode, inner=None, latency_scale=1.0):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown cassette mode {mode!r}")
+        if mode == 'record' and inner is None:
+            raise ValueError("Recording needs a client to record from")
+        self.path = path
+        self.mode = mode
+        self.inner = inner
+        self.latency_scale = latency_scale
+        self.log = RequestLog()
+        self.chat = _client_shape(self._create)
+        self._entries = defaultdict(deque)
+        self._last = {}
+        self._lock = threading.Lock()
+        if mode == 'replay':
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry['key']].append(entry)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _next_entry(self, key):
+        with self._lock:
+            if self._entries[key]:
+                self._last[key] = self._entries[key].popleft()
+            if key not in self._last:
+                raise CassetteMissError(f"Request {key[:12]} is not in cassette {self.path}")
+            return self._last[key]
+
+    def _record(self, entry):
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    async def _create(self, **kwargs):
+        key = request_key(kwargs)
+        model = kwargs.get('model')
+        self.log.add(calls=1)
+        if self.mode == 'replay':
+            entry = self._next_entry(key)
+            done = lambda: self.log.add(prompt_tokens=entry['prompt_tokens'], completion_tokens=entry['completion_tokens'])
+            seconds = entry['latency'] * self.latency_scale
+            if kwargs.get('stream'):
+                return _RawResponse(_stream(model, entry['content'], seconds, done))
+            await asyncio.sleep(seconds)
+            done()
+            return _RawResponse(_completion(model, entry['content'], entry['prompt_tokens'], entry['completion_tokens']))
+
+        started = time.perf_counter()
+        try:
+            raw = await self.inner.chat.completions.with_raw_response.create(**kwargs)
+        except Exception:
+            self.log.add(errors=1)
+            raise
+        if kwargs.get('stream'):
+            return _RawResponse(self._record_stream(key, model, kwargs, raw.parse(), started), raw.headers)
+        response = raw.parse()
+        content = response.choices[0].message.content or ''
+        usage = getattr(response, 'usage', None)
+        prompt_tokens = usage.prompt_tokens if usage else _prompt_tokens(kwargs.get('messages', ()))
+        completion_tokens = usage.completion_tokens if usage else estimate_tokens(content)
+        self._save(key, model, content, prompt_tokens, completion_tokens, time.perf_counter() - started)
+        return raw
+
+    async def _record_stream(self, key, model, kwargs, chunks, started):
+        pieces = []
+        async for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                pieces.append(chunk.choices[0].delta.content)
+            yield chunk
+        content = ''.join(pieces)
+        self._save(key, model, content, _prompt_tokens(kwargs.get('messages', ())), estimate_tokens(content),
+                   time.perf_counter() - started)
+
+    def _save(self, key, model, content, prompt_tokens, completion_tokens, latency):
+        self.log.add(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        self._record({
+            'key': key, 'model': model, 'content': content,
+            'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'latency': round(latency, 4)
+        })
+
+def build_synthetic_db(path, patients=200, seed=0):
+    """
+    Creates a readmission database with the tables and columns the app reads, filled with
+    patients of 1 to 40 encounters of random but plausible values.
+
+    Args:
+    path (str): SQLite file to create; an existing file is replaced.
+    patients (int): Number of patients.
+    seed (int): Seed of the generated data.
+
+    Returns:
+    int: Number of encounters written.
+    """
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.executescript("""
+            CREATE TABLE Scenario_Groups (group_id INTEGER PRIMARY KEY, group_name TEXT);
+            CREATE TABLE Scenarios (scenario_id INTEGER PRIMARY KEY, scenario_name TEXT, sql_query TEXT, group_id INTEGER);
+            CREATE TABLE Diabetic_Data (
+                encounter_id INTEGER, patient_nbr INTEGER, sequence_number INTEGER,
+                race TEXT, gender TEXT, age TEXT, admission_type_id INTEGER, discharge_disposition_id INTEGER,
+                admission_source_id INTEGER, time_in_hospital INTEGER, medical_specialty TEXT,
+                num_lab_procedures INTEGER, num_procedures INTEGER, num_medications INTEGER,
+                number_outpatient INTEGER, number_emergency INTEGER, number_inpatient INTEGER,
+                diag_1 TEXT, diag_2 TEXT, diag_3 TEXT, number_diagnoses INTEGER, max_glu_serum TEXT,
+                A1Cresult TEXT, metformin TEXT, insulin TEXT, change TEXT, diabetesMed TEXT, readmitted TEXT
+            );
+            INSERT INTO Scenario_Groups VALUES (1, 'Readmission Risk'), (2, 'Medication Management');
+            INSERT INTO Scenarios VALUES
+                (1, 'Frequent emergency visits', 'SELECT * FROM Diabetic_Data WHERE number_emergency > 1', 1),
+                (2, 'Readmitted within 30 days', 'SELECT * FROM Diabetic_Data WHERE readmitted = ''<30''', 1),
+                (3, 'Insulin dose changes', 'SELECT * FROM Diabetic_Data WHERE insulin IN (''Up'', ''Down'')', 2);
+        """)
+        rows = []
+        encounter_id = 100000
+        for patient in range(patients):
+            patient_nbr = 1000000 + patient * 37
+            race = rng.choice(['Caucasian', 'AfricanAmerican', 'Hispanic', 'Asian', 'Other', '?'])
+            gender = rng.choice(['Female', 'Male'])
+            age = rng.choice(['[40-50)', '[50-60)', '[60-70)', '[70-80)', '[80-90)'])
+            visits = min(40, max(1, int(rng.expovariate(1 / 4))))
+            for sequence_number in range(1, visits + 1):
+                encounter_id += rng.randint(1, 5000)
+                rows.append((
+                    encounter_id, patient_nbr, sequence_number, race, gender, age,
+                    rng.randint(1, 8), rng.randint(1, 25), rng.randint(1, 20), rng.randint(1, 14),
+                    rng.choice(['?', 'InternalMedicine', 'Cardiology', 'Family/GeneralPractice', 'Emergency/Trauma']),
+                    rng.randint(1, 90), rng.randint(0, 6), rng.randint(1, 40),
+                    rng.choice([0, 0, 0, 1, 2]), rng.choice([0, 0, 0, 1, 3]), rng.choice([0, 0, 1, 2, 4]),
+                    rng.choice(['250.83', '428', '414', '786', '486']), rng.choice(['250', '427', '276', '401']),
+                    rng.choice(['250', '403', '496', 'V45']), rng.randint(3, 16), rng.choice(['None', 'None', '>200', '>300', 'Norm']),
+                    rng.choice(['None', 'None', '>7', '>8', 'Norm']), rng.choice(['No', 'Steady', 'Up', 'Down']),
+                    rng.choice(['No', 'Steady', 'Up', 'Down']), rng.choice(['No', 'Ch']), rng.choice(['Yes', 'No']),
+                    rng.choice(['NO', '>30', '<30'])
+                ))
+        conn.executemany(f"INSERT INTO Diabetic_Data VALUES ({', '.join('?' * len(rows[0]))})", rows)
+        conn.commit()
+    finally:
+        conn.close()
+    return len(rows)
@@ -1,52 +1,531 @@
+import asyncio
+import concurrent.futures
 import functools
+import hashlib
+import inspect
 import json
 import os
 import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 from typing import Callable, Any
+from components.telemetry_utils import record
 from datetime import datetime, timedelta
+from config import (
+    DISK_CACHE_MAX_BYTES, DISK_CACHE_SWEEP_INTERVAL, CACHE_DB_PATH,
+    SINGLE_FLIGHT_LEASE_SECONDS, SINGLE_FLIGHT_POLL_INTERVAL
+)
 
-def flexible_cache(backend: str = 'memory', maxsize: int = 128, ttl: int = 3600):
+CACHE_DIR = os.path.join(os.path.dirname(__file__), '..', 'cache')
+
+# ttl of every cached namespace registered in this process, used by the background sweeper
+_disk_namespaces = {}
+_database_namespaces = {}
+_cache_sweeper = None
+_cache_sweeper_lock = threading.Lock()
+_database_local = threading.local()
+
+# namespace -> {'hits', 'misses'} of the lookups made through cached wrappers in this process
+_cache_stats = {}
+_cache_stats_lock = threading.Lock()
+
+# Futures of the cache misses currently being computed in this process, keyed by (namespace, cache_key)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Errors of a leader whose caller gave up (e.g. a cancelled prefetch); the entry is still wanted
+_CANCELLATIONS = (asyncio.CancelledError, concurrent.futures.CancelledError)
+
+class _FlightAbandoned(Exception):
+    """Set on a flight whose leader was cancelled, so that its followers compute the entry themselves."""
+
+def _canonicalize(value):
+    """Normalize a call argument so that equivalent calls produce identical cache keys."""
+    if isinstance(value, str):
+        return ' '.join(value.split())
+    if isinstance(value, dict):
+        return {str(key): _canonicalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonicalize(item) for item in value]
+    return value
+
+def make_cache_key(namespace: str, func: Callable, args: tuple, kwargs: dict, unordered_args: tuple = ()) -> str:
+    """
+    Build a stable, content-addressed cache key for a call.
+
+    Arguments are bound to the function signature (so positional and keyword calls agree),
+    strings have their whitespace normalized and the arguments named in unordered_args
+    (e.g. lenses) are sorted. The key is the SHA-256 of the canonical JSON, which, unlike
+    hash(), is identical across processes and restarts.
+    """
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = {}
+    for name, value in bound.arguments.items():
+        value = _canonicalize(value)
+        if name in unordered_args and isinstance(value, list):
+            value = sorted(value, key=lambda item: json.dumps(item, sort_keys=True, default=str))
+        arguments[name] = value
+    payload = json.dumps([namespace, arguments], sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _disk_cache_path(namespace: str, digest: str) -> str:
+    # Shard by the first two hex digits so no single directory grows too large
+    return os.path.join(CACHE_DIR, namespace, digest[:2], f"{digest}.pkl")
+
+def _disk_load(cache_file: str, ttl: int):
+    try:
+        with open(cache_file, 'rb') as f:
+            timestamp, result = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return False, None
+    if datetime.now() - timestamp >= timedelta(seconds=ttl):
+        return False, None
+    # Record the access in atime (mtime keeps the write time used for ttl) for LRU eviction
+    try:
+        os.utime(cache_file, (time.time(), os.stat(cache_file).st_mtime))
+    except OSError:
+        pass
+    return True, result
+
+def _disk_store(cache_file: str, result: Any):
+    # Write to a temporary file in the same directory and rename it into place, so readers
+    # in other threads or processes never see a partially written entry
+    shard_dir = os.path.dirname(cache_file)
+    os.makedirs(shard_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=shard_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((datetime.now(), result), f)
+        os.replace(tmp_path, cache_file)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def sweep_disk_cache(max_bytes: int = DISK_CACHE_MAX_BYTES):
+    """
+    Remove expired disk cache entries, then evict least recently used entries until the
+    cache directory fits in max_bytes.
+
+    Entries of namespaces not registered in this process are only subject to eviction.
+
+    :param max_bytes: Byte budget for the whole disk cache
+    :return: Number of entries removed
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return 0
+
+    now = time.time()
+    removed = 0
+    total_bytes = 0
+    entries = []
+    for namespace in os.listdir(CACHE_DIR):
+        namespace_dir = os.path.join(CACHE_DIR, namespace)
+        if not os.path.isdir(namespace_dir):
+            continue
+        ttl = _disk_namespaces.get(namespace)
+        for root, _, files in os.walk(namespace_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith('.tmp'):
+                    # Leftover from a writer that died before renaming
+                    expired = now - stat.st_mtime > 3600
+                else:
+                    expired = ttl is not None and now - stat.st_mtime >= ttl
+                if expired:
+                    removed += _remove_quietly(path)
+                    continue
+                if not name.endswith('.tmp'):
+                    entries.append((stat.st_atime, stat.st_size, path))
+                    total_bytes += stat.st_size
+
+    if total_bytes > max_bytes:
+        entries.sort()
+        for _, size, path in entries:
+            if total_bytes <= max_bytes:
+                break
+            removed += _remove_quietly(path)
+            total_bytes -= size
+    return removed
+
+def _remove_quietly(path: str) -> int:
+    try:
+        os.remove(path)
+        return 1
+    except OSError:
+        return 0
+
+def _get_database_connection() -> sqlite3.Connection:
+    """
+    Return this thread's connection to the cache database, creating the schema on first use.
+
+    Connections are never shared between threads or across a fork; concurrent writers in
+    other processes are serialized by SQLite in WAL mode, waiting up to the busy timeout.
+    """
+    conn = getattr(_database_local, 'conn', None)
+    if conn is not None and _database_local.pid == os.getpid() and _database_local.path == CACHE_DB_PATH:
+        return conn
+
+    os.makedirs(os.path.dirname(os.path.abspath(CACHE_DB_PATH)), exist_ok=True)
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=30000')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache_entries (
+            namespace TEXT NOT NULL,
+            cache_key TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (namespace, cache_key)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_entries_expires_at ON cache_entries (expires_at)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache_leases (
+            namespace TEXT NOT NULL,
+            cache_key TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (namespace, cache_key)
+        )
+    ''')
+    _database_local.conn = conn
+    _database_local.pid = os.getpid()
+    _database_local.path = CACHE_DB_PATH
+    return conn
+
+def _database_load(namespace: str, cache_key: str):
+    row = _get_database_connection().execute(
+        'SELECT payload FROM cache_entries WHERE namespace = ? AND cache_key = ? AND expires_at > ?',
+        (namespace, cache_key, time.time())
+    ).fetchone()
+    if row is None:
+        return False, None
+    return True, pickle.loads(zlib.decompress(row[0]))
+
+def _database_store(namespace: str, cache_key: str, result: Any, ttl: int):
+    now = time.time()
+    payload = zlib.compress(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    _get_database_connection().execute(
+        'INSERT OR REPLACE INTO cache_entries (namespace, cache_key, payload, created_at, expires_at) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (namespace, cache_key, sqlite3.Binary(payload), now, now + ttl)
+    )
+
+def purge_database_cache(expired_only: bool = True) -> int:
+    """
+    Delete database cache entries in a single statement.
+
+    :param expired_only: Only delete entries past their expiry (uses the expires_at index)
+    :return: Number of entries deleted
+    """
+    conn = _get_database_connection()
+    if expired_only:
+        cursor = conn.execute('DELETE FROM cache_entries WHERE expires_at <= ?', (time.time(),))
+    else:
+        cursor = conn.execute('DELETE FROM cache_entries')
+    return cursor.rowcount
+
+def _start_cache_sweeper():
+    global _cache_sweeper
+    with _cache_sweeper_lock:
+        if _cache_sweeper is not None:
+            return
+
+        def sweep_forever():
+            while True:
+                try:
+                    if _disk_namespaces:
+                        sweep_disk_cache()
+                    if _database_namespaces:
+                        purge_database_cache()
+                except Exception:
+                    pass
+                time.sleep(DISK_CACHE_SWEEP_INTERVAL)
+
+        _cache_sweeper = threading.Thread(target=sweep_forever, name="cache-sweeper", daemon=True)
+        _cache_sweeper.start()
+
+def _acquire_lease(namespace: str, cache_key: str, owner: str) -> bool:
+    """
+    Try to become the one process on this host computing a cache entry.
+    A lease left behind by a crashed process is taken over once it expires.
+    """
+    now = time.time()
+    try:
+        cursor = _get_database_connection().execute('''
+            INSERT INTO cache_leases (namespace, cache_key, owner, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (namespace, cache_key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE cache_leases.expires_at <= ?
+        ''', (namespace, cache_key, owner, now + SINGLE_FLIGHT_LEASE_SECONDS, now))
+    except sqlite3.Error:
+        # Without the lease table we can still compute, just without cross-process coalescing
+        return True
+    return cursor.rowcount == 1
+
+def _release_lease(namespace: str, cache_key: str, owner: str):
+    try:
+        _get_database_connection().execute(
+            'DELETE FROM cache_leases WHERE namespace = ? AND cache_key = ? AND owner = ?',
+            (namespace, cache_key, owner)
+        )
+    except sqlite3.Error:
+        pass
+
+def _join_flight(flight_key: tuple):
+    """Return (future, is_leader) for a cache miss, registering a new flight if none is in progress."""
+    with _inflight_lock:
+        future = _inflight.get(flight_key)
+        if future is not None:
+            return future, False
+        future = concurrent.futures.Future()
+        _inflight[flight_key] = future
+        return future, True
+
+def _finish_flight(flight_key: tuple, future: concurrent.futures.Future, result: Any = None, error: BaseException = None):
+    with _inflight_lock:
+        _inflight.pop(flight_key, None)
+    if isinstance(error, _CANCELLATIONS):
+        future.set_exception(_FlightAbandoned())
+    elif error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+def _compute_leased(namespace: str, cache_key: str, load: Callable, store: Callable, compute: Callable):
+    owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+    while True:
+        if _acquire_lease(namespace, cache_key, owner):
+            try:
+                # Another process may have stored the entry just before we took the lease
+                hit, result = load(cache_key)
+                if not hit:
+                    result = compute()
+                    store(cache_key, result)
+                return result
+            finally:
+                _release_lease(namespace, cache_key, owner)
+        # Another process is computing this entry; wait for it to land in the cache
+        time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        hit, result = load(cache_key)
+        if hit:
+            return result
+
+async def _compute_leased_async(namespace: str, cache_key: str, load: Callable, store: Callable, compute: Callable):
+    # Lease, load and store calls wait on the disk or the cache database, so they run off the
+    # event loop rather than stalling every other request on it
+    owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+    while True:
+        if await asyncio.to_thread(_acquire_lease, namespace, cache_key, owner):
+            try:
+                hit, result = await asyncio.to_thread(load, cache_key)
+                if not hit:
+                    result = await compute()
+                    await asyncio.to_thread(store, cache_key, result)
+                return result
+            finally:
+                await asyncio.to_thread(_release_lease, namespace, cache_key, owner)
+        await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        hit, result = await asyncio.to_thread(load, cache_key)
+        if hit:
+            return result
+
+def _record_lookup(namespace: str, hit: bool, seconds: float):
+    with _cache_stats_lock:
+        stats = _cache_stats.setdefault(namespace, {'hits': 0, 'misses': 0})
+        stats['hits' if hit else 'misses'] += 1
+    record('cache', namespace, seconds, hit=hit)
+
+def get_cache_stats() -> dict:
+    """
+    Return the cache lookups recorded in this process as {namespace: {'hits', 'misses'}}.
+    Callers that joined another caller's in-flight computation count as hits.
+    """
+    with _cache_stats_lock:
+        return {namespace: dict(stats) for namespace, stats in _cache_stats.items()}
+
+def reset_cache_stats():
+    with _cache_stats_lock:
+        _cache_stats.clear()
+
+def set_cache_dir(path: str):
+    """
+    Keep the disk cache and the cache database of this process under path instead of cache/,
+    e.g. to benchmark against an empty cache without touching the real one.
+    """
+    global CACHE_DIR, CACHE_DB_PATH
+    os.makedirs(path, exist_ok=True)
+    CACHE_DIR = path
+    CACHE_DB_PATH = os.path.join(path, 'cache.db')
+
+def _wrap_cached(func: Callable, namespace: str, cache_key_for: Callable, load: Callable, store: Callable,
+                 single_flight: bool = True) -> Callable:
+    """
+    Wrap a sync or coroutine function with a key -> load/store cache lookup.
+
+    With single_flight, concurrent misses on the same key are coalesced: within the process
+    later callers wait on the first caller's future, and across processes on this host only
+    the holder of the key's lease in the cache database computes while the others poll the cache.
+    If the first caller is cancelled, a waiting caller takes over the computation.
+    """
+    def timed_load(cache_key):
+        started = time.perf_counter()
+        hit, result = load(cache_key)
+        return hit, result, time.perf_counter() - started
+
+    def cache_get(*args, **kwargs):
+        hit, result, seconds = timed_load(cache_key_for(args, kwargs))
+        _record_lookup(namespace, hit, seconds)
+        return hit, result
+
+    def cache_set(result, *args, **kwargs):
+        store(cache_key_for(args, kwargs), result)
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            cache_key = cache_key_for(args, kwargs)
+            hit, result, seconds = timed_load(cache_key)
+            if hit:
+                _record_lookup(namespace, True, seconds)
+                return result
+            if not single_flight:
+                _record_lookup(namespace, False, seconds)
+                result = await func(*args, **kwargs)
+                store(cache_key, result)
+                return result
+
+            flight_key = (namespace, cache_key)
+            future, is_leader = _join_flight(flight_key)
+            _record_lookup(namespace, not is_leader, seconds)
+            while not is_leader:
+                try:
+                    # Shielded, so a caller giving up does not cancel the flight for the others
+                    return await asyncio.shield(asyncio.wrap_future(future))
+                except _FlightAbandoned:
+                    future, is_leader = _join_flight(flight_key)
+            try:
+                result = await _compute_leased_async(namespace, cache_key, load, store, lambda: func(*args, **kwargs))
+            except BaseException as error:
+                _finish_flight(flight_key, future, error=error)
+                raise
+            _finish_flight(flight_key, future, result=result)
+            return result
+        async_wrapper.cache_get = cache_get
+        async_wrapper.cache_set = cache_set
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache_key = cache_key_for(args, kwargs)
+        hit, result, seconds = timed_load(cache_key)
+        if hit:
+            _record_lookup(namespace, True, seconds)
+            return result
+        if not single_flight:
+            _record_lookup(namespace, False, seconds)
+            result = func(*args, **kwargs)
+            store(cache_key, result)
+            return result
+
+        flight_key = (namespace, cache_key)
+        future, is_leader = _join_flight(flight_key)
+        _record_lookup(namespace, not is_leader, seconds)
+        while not is_leader:
+            try:
+                return future.result()
+            except _FlightAbandoned:
+                future, is_leader = _join_flight(flight_key)
+        try:
+            result = _compute_leased(namespace, cache_key, load, store, lambda: func(*args, **kwargs))
+        except BaseException as error:
+            _finish_flight(flight_key, future, error=error)
+            raise
+        _finish_flight(flight_key, future, result=result)
+        return result
+    wrapper.cache_get = cache_get
+    wrapper.cache_set = cache_set
+    return wrapper
+
+def flexible_cache(backend: str = 'memory', maxsize: int = 128, ttl: int = 3600, namespace: str = None,
+                   unordered_args: tuple = (), single_flight: bool = True):
     """
     A flexible caching decorator that supports different backend storage options.
+    Coroutine functions are supported by the disk and database backends; the wrapper is then
+    itself a coroutine function. Disk- and database-cached wrappers also expose
+    cache_get(*args, **kwargs) -> (hit, result) and cache_set(result, *args, **kwargs)
+    for callers that produce a result without going through the wrapper (e.g. streaming).
+
+    Disk entries are keyed by make_cache_key, stored under cache/<namespace>/<xx>/<digest>.pkl
+    and written atomically. A background sweeper expires entries past their ttl and keeps
+    the directory within config.DISK_CACHE_MAX_BYTES by evicting least recently used entries.
+
+    Database entries use the same keys and are stored as zlib-compressed pickles in the
+    SQLite file config.CACHE_DB_PATH (WAL mode), which can be shared by several processes;
+    the background sweeper purges expired rows.
     
     :param backend: The caching backend to use ('memory', 'disk', or 'database')
     :param maxsize: Maximum size of the cache (for memory backend)
     :param ttl: Time to live for cache entries in seconds (default 1 hour)
+    :param namespace: Name used in cache keys (defaults to the function name), so that
+                      sync and async variants of the same call can share entries
+    :param unordered_args: Names of list/tuple arguments whose order does not matter (e.g. 'lenses')
+    :param single_flight: Coalesce concurrent misses on the same key, in this process and
+                          across processes on this host (disk and database backends)
     """
     def decorator(func: Callable) -> Callable:
+        is_coroutine = asyncio.iscoroutinefunction(func)
+        key_name = namespace or func.__name__
+
+        def cache_key_for(args, kwargs):
+            return make_cache_key(key_name, func, args, kwargs, unordered_args)
+
         if backend == 'memory':
+            if is_coroutine:
+                raise ValueError("The memory cache backend does not support coroutine functions")
             @functools.lru_cache(maxsize=maxsize)
             def wrapper(*args, **kwargs):
                 return func(*args, **kwargs)
             return wrapper
         
         elif backend == 'disk':
-            cache_dir = os.path.join(os.path.dirname(__file__), '..', 'cache')
-            os.makedirs(cache_dir, exist_ok=True)
-            
-            def wrapper(*args, **kwargs):
-                cache_key = json.dumps((func.__name__, args, kwargs), sort_keys=True)
-                cache_file = os.path.join(cache_dir, f"{hash(cache_key)}.pkl")
-                
-                if os.path.exists(cache_file):
-                    with open(cache_file, 'rb') as f:
-                        timestamp, result = pickle.load(f)
-                    if datetime.now() - timestamp < timedelta(seconds=ttl):
-                        return result
-                
-                result = func(*args, **kwargs)
-                with open(cache_file, 'wb') as f:
-                    pickle.dump((datetime.now(), result), f)
-                return result
-            return wrapper
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            _disk_namespaces[key_name] = ttl
+            _start_cache_sweeper()
+
+            def load(cache_key):
+                return _disk_load(_disk_cache_path(key_name, cache_key), ttl)
+
+            def store(cache_key, result):
+                _disk_store(_disk_cache_path(key_name, cache_key), result)
+
+            return _wrap_cached(func, key_name, cache_key_for, load, store, single_flight)
         
         elif backend == 'database':
-            # Implement database caching logic here
-            # This is a placeholder and should be implemented based on your database setup
-            def wrapper(*args, **kwargs):
-                # Placeholder for database caching logic
-                return func(*args, **kwargs)
-            return wrapper
+            _database_namespaces[key_name] = ttl
+            _start_cache_sweeper()
+
+            def load(cache_key):
+                return _database_load(key_name, cache_key)
+
+            def store(cache_key, result):
+                _database_store(key_name, cache_key, result, ttl)
+
+            return _wrap_cached(func, key_name, cache_key_for, load, store, single_flight)
         
         else:
             raise ValueError(f"Unsupported cache backend: {backend}")
@@ -68,18 +547,20 @@ def clear_cache(backend: str = 'all'):
     
     if backend in ['disk', 'all']:
         # Clear disk cache
-        cache_dir = os.path.join(os.path.dirname(__file__), '..', 'cache')
-        if os.path.exists(cache_dir):
-            for file in os.listdir(cache_dir):
-                os.remove(os.path.join(cache_dir, file))
+        # Only namespace directories; the database backend's files live alongside them
+        if os.path.exists(CACHE_DIR):
+            for entry in os.listdir(CACHE_DIR):
+                path = os.path.join(CACHE_DIR, entry)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
     
     if backend in ['database', 'all']:
         # Clear database cache
-        # Implement database cache clearing logic here
-        pass
+        if os.path.exists(CACHE_DB_PATH):
+            purge_database_cache(expired_only=False)
 
 # Example usage:
 # @flexible_cache(backend='disk', ttl=3600)
 # def expensive_function(arg1, arg2):
 #     # Expensive computation here
-#     return result
\ No newline at end of file
+#     return result
@@ -1,41 +1,363 @@
+import os
+import pathlib
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 import pandas as pd
+from components.cache_utils import flexible_cache
+from components.telemetry_utils import record
+from config import (
+    DB_PATH, DB_POOL_SIZE, DB_STATEMENT_CACHE_SIZE, DB_PRAGMAS,
+    QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_SPILL_TO_DISK, QUERY_CACHE_TTL
+)
 
-def get_db_connection():
-    return sqlite3.connect('Readmissionv2.db')
+_visit_counts_ready = False
 
-def execute_query(conn, query):
-    cursor = conn.cursor()
-    cursor.execute(query)
-    return cursor.fetchall()
+# Idle pooled connections, separately for read-only and writable connections
+_pools = {True: [], False: []}
+_pool_lock = threading.Lock()
 
-def load_scenario_groups():
-    conn = get_db_connection()
+# (scope, query) -> {'count', 'total_seconds', 'max_seconds'}
+_query_stats = {}
+_query_stats_lock = threading.Lock()
+_query_scope = threading.local()
+
+# (query, params, database version) -> compacted result frame, least recently used first
+_query_results = OrderedDict()
+_query_results_lock = threading.Lock()
+
+def _record_query(query, elapsed, executed=True):
+    key = (getattr(_query_scope, 'name', None) or 'Other', ' '.join(query.split()))
+    with _query_stats_lock:
+        stats = _query_stats.setdefault(key, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        if executed:
+            stats['count'] += 1
+        stats['total_seconds'] += elapsed
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+    # Row fetching adds to the query's total time but is not a separate observation
+    record('db', key[1], elapsed, observed=executed)
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records the time spent executing a query and fetching its rows."""
+    _query = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._query = sql
+            _record_query(sql, time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        if self._query is not None:
+            _record_query(self._query, time.perf_counter() - start, executed=False)
+        return rows
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        if self._query is not None:
+            _record_query(self._query, time.perf_counter() - start, executed=False)
+        return rows
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3 connection whose close() returns it to the pool instead of closing it, so the
+    existing get_db_connection()/close() call sites reuse tuned connections and their
+    prepared-statement caches.
+    """
+    read_only = False
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        with _pool_lock:
+            pool = _pools[self.read_only]
+            if len(pool) < DB_POOL_SIZE:
+                pool.append(self)
+                return
+        self.dispose()
+
+    def dispose(self):
+        super().close()
+
+def _open_connection(read_only):
+    if read_only:
+        database = pathlib.Path(os.path.abspath(DB_PATH)).as_uri() + '?mode=ro'
+    else:
+        database = DB_PATH
+    conn = sqlite3.connect(
+        database, uri=read_only, factory=PooledConnection,
+        cached_statements=DB_STATEMENT_CACHE_SIZE, check_same_thread=False
+    )
+    conn.read_only = read_only
+    for pragma, value in DB_PRAGMAS.items():
+        # The journal mode is a property of the database file and can only be set by a writer
+        if read_only and pragma == 'journal_mode':
+            continue
+        try:
+            # Bypass TimedCursor so connection setup does not show up in the query timings
+            sqlite3.Connection.execute(conn, f'PRAGMA {pragma} = {value}').fetchall()
+        except sqlite3.OperationalError:
+            # Tuning is best effort, e.g. WAL cannot be enabled on a read-only file
+            pass
+    return conn
+
+def get_db_connection(read_only=False):
+    """
+    Returns a pooled connection to the readmission database.
+    
+    Each connection is used by one thread at a time (the caller) and goes back to the pool on
+    close(), so Streamlit reruns, which run on fresh threads, still reuse connections.
+    Connections are tuned with config.DB_PRAGMAS and cache up to config.DB_STATEMENT_CACHE_SIZE
+    prepared statements.
+    
+    Args:
+    read_only (bool): Open the database in read-only mode; use for queries.
+    """
+    with _pool_lock:
+        pool = _pools[read_only]
+        if pool:
+            return pool.pop()
+    return _open_connection(read_only)
+
+def set_db_path(path):
+    """
+    Points this process at another readmission database than config.DB_PATH, e.g. the synthetic
+    one of benchmark.py. Idle pooled connections to the previous database are closed; call it
+    before any connection is taken.
+    """
+    global DB_PATH, _visit_counts_ready
+    with _pool_lock:
+        idle = _pools[True] + _pools[False]
+        _pools[True].clear()
+        _pools[False].clear()
+    for conn in idle:
+        conn.dispose()
+    DB_PATH = path
+    _visit_counts_ready = False
+
+def get_db_path():
+    """Returns the path of the readmission database this process uses (see set_db_path)."""
+    return DB_PATH
+
+@contextmanager
+def db_query_scope(name):
+    """Attributes the queries run in this thread inside the block to name (e.g. a stage)."""
+    previous = getattr(_query_scope, 'name', None)
+    _query_scope.name = name
     try:
-        groups = pd.read_sql('SELECT group_id, group_name FROM Scenario_Groups', conn)
+        yield
     finally:
-        conn.close()
-    return groups
+        _query_scope.name = previous
 
-def load_scenarios(group_ids):
+def get_query_stats():
+    """
+    Returns the recorded query timings, slowest first.
+    
+    Returns:
+    pd.DataFrame: One row per scope and query with count, total_seconds and max_seconds.
+    """
+    with _query_stats_lock:
+        rows = [
+            {'scope': scope, 'query': query, **stats}
+            for (scope, query), stats in _query_stats.items()
+        ]
+    stats = pd.DataFrame(rows, columns=['scope', 'query', 'count', 'total_seconds', 'max_seconds'])
+    return stats.sort_values('total_seconds', ascending=False).reset_index(drop=True)
+
+def reset_query_stats():
+    with _query_stats_lock:
+        _query_stats.clear()
+
+def ensure_patient_visit_counts():
+    """
+    Creates the materialized Patient_Visit_Counts table (patient_nbr -> visit_count) if needed.
+    
+    The table is built once from Diabetic_Data and then kept current by triggers, so every
+    encounter inserted, deleted or moved to another patient updates its patient's count
+    incrementally instead of requiring a GROUP BY over the whole table.
+    
+    Returns:
+    bool: False if the table does not exist and could not be created (e.g. a read-only database).
+    """
+    global _visit_counts_ready
+    if _visit_counts_ready:
+        return True
     conn = get_db_connection()
     try:
-        placeholders = ', '.join('?' for _ in group_ids)
-        query = f'''
-            SELECT s.scenario_id, s.scenario_name, s.sql_query, sg.group_name 
-            FROM Scenarios s
-            JOIN Scenario_Groups sg ON s.group_id = sg.group_id
-            WHERE s.group_id IN ({placeholders})
-        '''
-        scenarios = pd.read_sql(query, conn, params=group_ids)
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Patient_Visit_Counts'"
+        ).fetchone()
+        if not exists:
+            # One write transaction, so no encounter can land between the initial count and the triggers
+            conn.executescript('''
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS Patient_Visit_Counts (
+                    patient_nbr PRIMARY KEY,
+                    visit_count INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_patient_visit_counts_visit_count
+                    ON Patient_Visit_Counts (visit_count, patient_nbr);
+                DELETE FROM Patient_Visit_Counts;
+                INSERT INTO Patient_Visit_Counts (patient_nbr, visit_count)
+                    SELECT patient_nbr, COUNT(*) FROM Diabetic_Data GROUP BY patient_nbr;
+                CREATE TRIGGER IF NOT EXISTS trg_diabetic_data_visit_count_insert
+                AFTER INSERT ON Diabetic_Data
+                BEGIN
+                    INSERT INTO Patient_Visit_Counts (patient_nbr, visit_count) VALUES (NEW.patient_nbr, 1)
+                    ON CONFLICT (patient_nbr) DO UPDATE SET visit_count = visit_count + 1;
+                END;
+                CREATE TRIGGER IF NOT EXISTS trg_diabetic_data_visit_count_delete
+                AFTER DELETE ON Diabetic_Data
+                BEGIN
+                    UPDATE Patient_Visit_Counts SET visit_count = visit_count - 1 WHERE patient_nbr = OLD.patient_nbr;
+                    DELETE FROM Patient_Visit_Counts WHERE patient_nbr = OLD.patient_nbr AND visit_count <= 0;
+                END;
+                CREATE TRIGGER IF NOT EXISTS trg_diabetic_data_visit_count_update
+                AFTER UPDATE OF patient_nbr ON Diabetic_Data
+                WHEN OLD.patient_nbr IS NOT NEW.patient_nbr
+                BEGIN
+                    UPDATE Patient_Visit_Counts SET visit_count = visit_count - 1 WHERE patient_nbr = OLD.patient_nbr;
+                    DELETE FROM Patient_Visit_Counts WHERE patient_nbr = OLD.patient_nbr AND visit_count <= 0;
+                    INSERT INTO Patient_Visit_Counts (patient_nbr, visit_count) VALUES (NEW.patient_nbr, 1)
+                    ON CONFLICT (patient_nbr) DO UPDATE SET visit_count = visit_count + 1;
+                END;
+                COMMIT;
+            ''')
+    except sqlite3.OperationalError:
+        return False
     finally:
         conn.close()
-    return scenarios
+    _visit_counts_ready = True
+    return True
 
-def load_patient_data(scenario_sql_query):
-    conn = get_db_connection()
+def load_patients_by_visit_count(conn, min_visits, max_visits=None):
+    """
+    Returns patient_nbr and visit_count for patients with min_visits <= visit_count <= max_visits
+    (no upper bound if max_visits is None), ordered by visit count descending.
+    This is an index range scan over Patient_Visit_Counts.
+    """
+    upper = max_visits if max_visits is not None else 2 ** 62
+    if ensure_patient_visit_counts():
+        query = '''
+            SELECT patient_nbr, visit_count
+            FROM Patient_Visit_Counts
+            WHERE visit_count BETWEEN ? AND ?
+            ORDER BY visit_count DESC
+        '''
+    else:
+        # Without the materialized table, fall back to aggregating Diabetic_Data
+        query = '''
+            SELECT patient_nbr, COUNT(*) as visit_count
+            FROM Diabetic_Data
+            GROUP BY patient_nbr
+            HAVING visit_count BETWEEN ? AND ?
+            ORDER BY visit_count DESC
+        '''
+    return pd.read_sql(query, conn, params=[min_visits, upper])
+
+def database_version():
+    """
+    Returns a token that changes whenever the database is written: the modification time and
+    size of the database file and its WAL file. Unlike PRAGMA data_version, it is comparable
+    across connections and processes, and reading it does not touch SQLite.
+    """
+    parts = []
+    for path in (DB_PATH, DB_PATH + '-wal'):
+        try:
+            stat = os.stat(path)
+            parts.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+        except FileNotFoundError:
+            parts.append('-')
+    return '|'.join(parts)
+
+def _compact_frame(frame):
+    # Repetitive text columns (group names, diagnoses, categorical encounter fields) as categoricals
+    for column in frame.columns:
+        values = frame[column]
+        is_text = pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)
+        if is_text and len(frame) > 1 and values.nunique(dropna=False) <= len(frame) // 2:
+            frame[column] = values.astype('category')
+    return frame
+
+def _read_query(query, params, version):
+    # version is unused here but part of the cache key, so a database change invalidates the entry
+    conn = get_db_connection(read_only=True)
     try:
-        patient_data = pd.read_sql(scenario_sql_query, conn)
+        return _compact_frame(pd.read_sql(query, conn, params=params))
     finally:
         conn.close()
-    return patient_data
+
+_read_query_spilled = flexible_cache(backend='disk', ttl=QUERY_CACHE_TTL, namespace='query_results')(_read_query)
+
+def cached_read_sql(query, params=None):
+    """
+    pd.read_sql on a read-only connection, cached by query text, parameters and database_version().
+    
+    Results are kept in memory (config.QUERY_CACHE_MAX_ENTRIES, least recently used evicted) with
+    repetitive text columns stored as categoricals, and optionally spilled to the disk cache so
+    other processes and restarts can reuse them. Treat the returned frame as read-only.
+    """
+    params = list(params) if params is not None else []
+    version = database_version()
+    key = (' '.join(query.split()), tuple(params), version)
+
+    with _query_results_lock:
+        result = _query_results.get(key)
+        if result is not None:
+            _query_results.move_to_end(key)
+            return result.copy(deep=False)
+
+    read = _read_query_spilled if QUERY_CACHE_SPILL_TO_DISK else _read_query
+    result = read(query, params, version)
+
+    with _query_results_lock:
+        # Entries for older database versions can never be hit again
+        for stale_key in [k for k in _query_results if k[2] != version]:
+            del _query_results[stale_key]
+        _query_results[key] = result
+        while len(_query_results) > QUERY_CACHE_MAX_ENTRIES:
+            _query_results.popitem(last=False)
+    return result.copy(deep=False)
+
+def execute_query(conn, query):
+    cursor = conn.cursor()
+    cursor.execute(query)
+    return cursor.fetchall()
+
+def load_scenario_groups():
+    return cached_read_sql('SELECT group_id, group_name FROM Scenario_Groups')
+
+def load_scenarios(group_ids):
+    placeholders = ', '.join('?' for _ in group_ids)
+    query = f'''
+        SELECT s.scenario_id, s.scenario_name, s.sql_query, sg.group_name 
+        FROM Scenarios s
+        JOIN Scenario_Groups sg ON s.group_id = sg.group_id
+        WHERE s.group_id IN ({placeholders})
+    '''
+    return cached_read_sql(query, params=group_ids)
+
+def load_scenario(scenario_id):
+    query = '''
+        SELECT s.scenario_id, s.scenario_name, s.sql_query, sg.group_name 
+        FROM Scenarios s
+        JOIN Scenario_Groups sg ON s.group_id = sg.group_id
+        WHERE s.scenario_id = ?
+    '''
+    return cached_read_sql(query, params=[scenario_id])
+
+def load_patient_data(scenario_sql_query):
+    return cached_read_sql(scenario_sql_query)
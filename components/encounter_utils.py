@@ -0,0 +1,79 @@
+import json
+import pandas as pd
+
+
+class PatientEncounters:
+    """
+    Columnar container for one patient's encounters, shared by every stage through
+    st.session_state['patient_json_data'].
+
+    Numeric columns are NumPy arrays and text columns are categoricals, so a patient with many
+    encounters costs a fraction of the equivalent list of dicts. Chunks are row slices of the
+    same frame rather than copies, and dicts or JSON are only built when a caller asks for them.
+    """
+
+    def __init__(self, frame, chunk_size=5):
+        self._frame = frame
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_frame(cls, frame, chunk_size=5):
+        """
+        Builds a container from a DataFrame of encounters (one row per encounter, in visit order).
+        """
+        frame = frame.reset_index(drop=True)
+        for column in frame.columns:
+            values = frame[column]
+            if pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+                frame[column] = values.astype('category')
+        return cls(frame, chunk_size)
+
+    @classmethod
+    def from_chunks(cls, chunked_data, chunk_size=5):
+        """
+        Builds a container from the legacy list of chunks of encounter dictionaries.
+        """
+        return cls.from_frame(pd.DataFrame([item for sublist in chunked_data for item in sublist]), chunk_size)
+
+    def __len__(self):
+        """Number of encounters."""
+        return len(self._frame)
+
+    def __repr__(self):
+        return f"PatientEncounters({len(self)} encounters, {self.num_chunks} chunks)"
+
+    @property
+    def num_chunks(self):
+        return -(-len(self._frame) // self.chunk_size)
+
+    def chunk(self, index):
+        """Returns chunk index (0-based) as a PatientEncounters view over the same data."""
+        start = index * self.chunk_size
+        return PatientEncounters(self._frame.iloc[start:start + self.chunk_size], self.chunk_size)
+
+    def chunks(self):
+        """Yields every chunk as a PatientEncounters view."""
+        for index in range(self.num_chunks):
+            yield self.chunk(index)
+
+    def column(self, name):
+        """Returns one column as a Series (categorical for text columns)."""
+        return self._frame[name]
+
+    def first(self, name):
+        return self._frame[name].iloc[0]
+
+    def last(self, name):
+        return self._frame[name].iloc[-1]
+
+    def to_frame(self):
+        """Returns the underlying DataFrame; treat it as read-only."""
+        return self._frame
+
+    def records(self):
+        """Returns the encounters as a list of dictionaries, built on demand."""
+        return self._frame.astype(object).where(self._frame.notna(), None).to_dict('records')
+
+    def to_json(self, indent=2):
+        """Returns the encounters as a JSON array, built on demand for display."""
+        return json.dumps(self.records(), indent=indent, default=str)
@@ -0,0 +1,230 @@
+import os
+import pickle
+from concurrent.futures import CancelledError
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from config import JOB_DB_PATH, JOB_HEARTBEAT_SECONDS, JOB_RETENTION_SECONDS
+
+_job_local = threading.local()
+
+# Process id of the process that dropped the jobs past JOB_RETENTION_SECONDS (a forked child drops them again)
+_retention_pid = None
+_retention_lock = threading.Lock()
+
+# Identifies the claims of this process; a running job whose heartbeat stops (e.g. Streamlit
+# restarted) is resumed by the next process or thread asking for it
+_OWNER = uuid.uuid4().hex
+
+def _get_job_connection():
+    """Return this thread's connection to the job database, creating the schema on first use."""
+    conn = getattr(_job_local, 'conn', None)
+    if conn is not None and _job_local.pid == os.getpid():
+        return conn
+
+    os.makedirs(os.path.dirname(os.path.abspath(JOB_DB_PATH)), exist_ok=True)
+    conn = sqlite3.connect(JOB_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=30000')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            owner TEXT,
+            heartbeat_at REAL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            result BLOB,
+            error TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS job_checkpoints (
+            job_id TEXT NOT NULL,
+            item_key TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            payload BLOB NOT NULL,
+            PRIMARY KEY (job_id, item_key)
+        )
+    ''')
+    _drop_expired_jobs(conn)
+    _job_local.conn, _job_local.pid = conn, os.getpid()
+    return conn
+
+def _drop_expired_jobs(conn):
+    # Old jobs and their checkpoints are dropped once per process, not by every thread (heartbeats,
+    # pipeline workers) opening its connection, so the deletes do not keep taking the write lock
+    global _retention_pid
+    with _retention_lock:
+        if _retention_pid == os.getpid():
+            return
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        conn.execute('DELETE FROM job_checkpoints WHERE job_id IN (SELECT job_id FROM jobs WHERE updated_at < ?)', (cutoff,))
+        conn.execute('DELETE FROM jobs WHERE updated_at < ?', (cutoff,))
+        _retention_pid = os.getpid()
+
+def _dumps(value):
+    return sqlite3.Binary(zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+
+def _loads(payload):
+    return pickle.loads(zlib.decompress(payload))
+
+def get_checkpoints(job_id, after_seq=0):
+    """
+    Returns the items checkpointed for a job, in the order they completed.
+
+    Args:
+    job_id (str): The job.
+    after_seq (int): Only items checkpointed after this sequence number.
+
+    Returns:
+    list: (seq, item_key, value) tuples.
+    """
+    rows = _get_job_connection().execute(
+        'SELECT seq, item_key, payload FROM job_checkpoints WHERE job_id = ? AND seq > ? ORDER BY seq',
+        (job_id, after_seq)
+    ).fetchall()
+    return [(seq, item_key, _loads(payload)) for seq, item_key, payload in rows]
+
+def save_checkpoint(job_id, item_key, value):
+    """Durably records a completed item of a job; saving an item again replaces it."""
+    conn = _get_job_connection()
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(
+            'INSERT OR IGNORE INTO jobs (job_id, status, created_at, updated_at) VALUES (?, ?, ?, ?)',
+            (job_id, 'running', now, now)
+        )
+        conn.execute(
+            'INSERT OR REPLACE INTO job_checkpoints (job_id, item_key, seq, payload) '
+            'VALUES (?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM job_checkpoints WHERE job_id = ?), ?)',
+            (job_id, item_key, job_id, _dumps(value))
+        )
+        conn.execute('UPDATE jobs SET updated_at = ? WHERE job_id = ?', (now, job_id))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+def get_job_progress(job_id):
+    """
+    Returns {'status', 'checkpoints', 'updated_at', 'elsewhere'} for a job, or None if it was never
+    started; elsewhere is whether another process is running it.
+    """
+    conn = _get_job_connection()
+    row = conn.execute('SELECT status, updated_at, owner FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+    if row is None:
+        return None
+    count = conn.execute('SELECT COUNT(*) FROM job_checkpoints WHERE job_id = ?', (job_id,)).fetchone()[0]
+    return {'status': row[0], 'checkpoints': count, 'updated_at': row[1], 'elsewhere': row[0] == 'running' and row[2] != _OWNER}
+
+class Checkpoint:
+    """
+    The items a job completed so far (completed, by item key) and save() to add to them. A job
+    whose result holds placeholders (e.g. degraded LLM answers) sets partial, so the next run
+    resumes it instead of reusing the result. reported holds the keys of the completed items
+    already passed to run_job's on_checkpoint while the job ran elsewhere, which should not be
+    reported again.
+    """
+
+    def __init__(self, job_id, completed, reported=()):
+        self.job_id = job_id
+        self.completed = completed
+        self.reported = set(reported)
+        self.partial = False
+
+    def save(self, item_key, value):
+        save_checkpoint(self.job_id, item_key, value)
+        self.completed[item_key] = value
+
+def _claim(job_id):
+    # Returns ('done', result) for a finished job, ('wait', None) while another live claimant runs
+    # it, or ('run', None) once this thread has claimed it
+    conn = _get_job_connection()
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute('SELECT status, heartbeat_at, result FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        if row is not None and row[0] == 'done':
+            conn.execute('COMMIT')
+            return 'done', _loads(row[2])
+        if row is not None and row[0] == 'running' and row[1] is not None and now - row[1] < 3 * JOB_HEARTBEAT_SECONDS:
+            conn.execute('COMMIT')
+            return 'wait', None
+        conn.execute(
+            'INSERT INTO jobs (job_id, status, owner, heartbeat_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (job_id) DO UPDATE SET status = excluded.status, owner = excluded.owner, '
+            'heartbeat_at = excluded.heartbeat_at, updated_at = excluded.updated_at, error = NULL',
+            (job_id, 'running', _OWNER, now, now, now)
+        )
+        conn.execute('COMMIT')
+        return 'run', None
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+def _finish(job_id, status, result=None, error=None):
+    _get_job_connection().execute(
+        'UPDATE jobs SET status = ?, result = ?, error = ?, heartbeat_at = NULL, updated_at = ? WHERE job_id = ?',
+        (status, None if result is None else _dumps(result), None if error is None else repr(error), time.time(), job_id)
+    )
+
+def _heartbeat(job_id, stopped):
+    # Runs on its own thread (and connection) while the job computes
+    while not stopped.wait(JOB_HEARTBEAT_SECONDS):
+        _get_job_connection().execute(
+            'UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND owner = ?', (time.time(), job_id, _OWNER)
+        )
+
+def run_job(job_id, compute, on_checkpoint=None, poll_seconds=0.5, cancelled=None):
+    """
+    Runs compute as the persistent job job_id and returns its result. A finished job's stored
+    result is returned without running it again; a job interrupted earlier (failed, or its
+    process stopped) is resumed with the items it had checkpointed; a job running elsewhere is
+    waited for.
+
+    Args:
+    job_id (str): Identifies the job, e.g. its stage and input fingerprint.
+    compute (callable): Called with a Checkpoint; should skip the items in checkpoint.completed
+        and save each item as soon as it completes.
+    on_checkpoint (callable, optional): Called with (item_key, value) for each item checkpointed
+        by a job running elsewhere while it is waited for.
+    poll_seconds (float): How often a job running elsewhere is checked.
+    cancelled (threading.Event, optional): Once set, stops waiting for a job running elsewhere
+        (raising CancelledError) and keeps a job not started yet from starting.
+
+    Returns:
+    The job's result.
+    """
+    last_seq = 0
+    reported = set()
+    while True:
+        if cancelled is not None and cancelled.is_set():
+            raise CancelledError()
+        state, result = _claim(job_id)
+        if state == 'done':
+            return result
+        if state == 'run':
+            break
+        for last_seq, item_key, value in get_checkpoints(job_id, after_seq=last_seq):
+            if on_checkpoint is not None and item_key not in reported:
+                on_checkpoint(item_key, value)
+                reported.add(item_key)
+        time.sleep(poll_seconds)
+
+    checkpoint = Checkpoint(job_id, {item_key: value for _, item_key, value in get_checkpoints(job_id)}, reported)
+    stopped = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, stopped), name="job-heartbeat", daemon=True).start()
+    try:
+        result = compute(checkpoint)
+    except BaseException as error:
+        _finish(job_id, 'failed', error=error)
+        raise
+    finally:
+        stopped.set()
+    _finish(job_id, 'partial' if checkpoint.partial else 'done', result=result)
+    return result
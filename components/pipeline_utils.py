@@ -0,0 +1,333 @@
+import hashlib
+import importlib
+import inspect
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
+import pandas as pd
+import streamlit as st
+from config import STAGE_GRAPH, PIPELINE_MAX_WORKERS, SPECULATIVE_PREFETCH, SPECULATIVE_PREFETCH_TOKENS_PER_MINUTE
+from components.api_utils import cancellation_scope
+from components.db_utils import db_query_scope
+from components.job_utils import get_job_progress, run_job
+from components.scheduler_utils import TokenBucket
+from components.telemetry_utils import telemetry_scope, timed
+
+# Stage producing each value of the graph
+_PRODUCERS = {output: stage for stage, spec in STAGE_GRAPH.items() for output in spec['outputs']}
+
+# How the values produced by the interactive stages are read from the session state, where they differ
+# from the value's name
+_SESSION_VALUES = {
+    'patient_id': lambda state: state.get('summary', {}).get('Patient ID') if state.get('patient_selected') else None,
+    'encounters': lambda state: state.get('patient_json_data'),
+    'lenses': lambda state: tuple(state.get('summary', {}).get('Lenses') or ()) or None,
+}
+
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS, thread_name_prefix="stage-pipeline")
+
+def stage_module(stage):
+    return importlib.import_module(f"stages.{STAGE_GRAPH[stage]['module']}")
+
+def stage_view(stage):
+    """Returns the function rendering stage, wrapped in stage_template if the graph asks for it."""
+    from components.stage_template import stage_template
+    view = stage_module(stage).run
+    return stage_template(view) if STAGE_GRAPH[stage].get('template') else view
+
+def _compute_function(stage):
+    return getattr(stage_module(stage), 'compute', None)
+
+def upstream_stages(stage):
+    """Returns every stage whose outputs stage reads, directly or transitively."""
+    found, frontier = set(), [stage]
+    while frontier:
+        for name in STAGE_GRAPH[frontier.pop()]['inputs']:
+            producer = _PRODUCERS.get(name)
+            if producer is not None and producer not in found:
+                found.add(producer)
+                frontier.append(producer)
+    return found
+
+def _job_id(stage, fingerprint):
+    # Keyed on the inputs, so a new session or server picks up the same job and its checkpoints
+    return f"{stage}:{fingerprint}"
+
+def _fingerprint_default(value):
+    # PatientEncounters and other frame-backed values are hashed by content rather than listed row by row
+    if hasattr(value, 'to_frame'):
+        value = value.to_frame()
+    if isinstance(value, pd.DataFrame):
+        rows = pd.util.hash_pandas_object(value.astype(str), index=False).to_numpy().tobytes()
+        return {'columns': [str(column) for column in value.columns], 'rows': hashlib.sha256(rows).hexdigest()}
+    if isinstance(value, (set, frozenset)):
+        return sorted(map(str, value))
+    return str(value)
+
+def stage_fingerprint(inputs):
+    """Returns a digest of a stage's inputs that changes whenever any of them does."""
+    canonical = json.dumps(inputs, sort_keys=True, default=_fingerprint_default)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class _Job:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.future = None
+        # Partial results the computation reported so far, replayed to views waiting on it
+        self.updates = []
+        # Set when the result is no longer wanted; a running computation stops its LLM requests
+        self.cancelled = threading.Event()
+
+    def succeeded(self):
+        return self.future.done() and not self.future.cancelled() and self.future.exception() is None
+
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+class StagePipeline:
+    """
+    Computes the stages of one session that define compute() outside the UI, keyed on their
+    inputs. A background stage starts as soon as its inputs are ready and runs concurrently with
+    the other ready stages, so a pipeline takes as long as its critical path; a change upstream
+    restarts only the stages reading the changed values, and an unchanged rerun reuses the results.
+    """
+
+    def __init__(self, session_id=None):
+        self.session_id = session_id
+        self._session_values = {}
+        self._jobs = {}
+        # stage -> fingerprint of the inputs for which the user skipped it
+        self._skipped = {}
+        # stage -> (fingerprint of its prefetch values, future of its speculative work)
+        self._prefetches = {}
+        self._prefetch_budget = TokenBucket(SPECULATIVE_PREFETCH_TOKENS_PER_MINUTE)
+        # Set by cancel_all: the pipeline is being discarded and starts nothing more
+        self._closed = False
+        self._lock = threading.RLock()
+
+    def update(self, session_values):
+        """Takes the current values of the interactive stages and starts the background stages they make ready."""
+        with self._lock:
+            self._session_values = dict(session_values)
+            self._schedule()
+
+    def _value(self, name):
+        producer = _PRODUCERS.get(name)
+        if producer is None or _compute_function(producer) is None:
+            return self._session_values.get(name)
+        job = self._jobs.get(producer)
+        return job.future.result()[name] if job is not None and job.succeeded() else None
+
+    def _inputs(self, stage):
+        values = {name: self._value(name) for name in STAGE_GRAPH[stage]['inputs']}
+        return None if any(value is None for value in values.values()) else values
+
+    def _schedule(self):
+        if self._closed:
+            return
+        # Graph order is a topological order, so upstream jobs are current before their readers are checked
+        for stage, spec in STAGE_GRAPH.items():
+            if spec.get('background') and _compute_function(stage) is not None:
+                inputs = self._inputs(stage)
+                if inputs is not None and self._skipped.get(stage) != stage_fingerprint(list(inputs.values())):
+                    self._start(stage, inputs)
+        self._speculate()
+
+    def _speculate(self):
+        # Starts the speculative work of the stages with a 'prefetch' entry once its values are ready,
+        # and cancels it when they change (e.g. another patient was selected)
+        for stage, spec in STAGE_GRAPH.items():
+            if not spec.get('prefetch'):
+                continue
+            values = {name: self._value(name) for name in spec['prefetch']}
+            ready = SPECULATIVE_PREFETCH and all(value is not None for value in values.values())
+            fingerprint = stage_fingerprint(list(values.values())) if ready else None
+            current = self._prefetches.get(stage)
+            if current is not None and current[0] == fingerprint:
+                continue
+            if current is not None:
+                current[1].cancel()
+                del self._prefetches[stage]
+            if ready:
+                with telemetry_scope(self.session_id, f"{stage} (prefetch)"):
+                    future = stage_module(stage).prefetch(**values, budget=self._prefetch_budget)
+                self._prefetches[stage] = (fingerprint, future)
+
+    def _start(self, stage, inputs, retry_failed=False):
+        fingerprint = stage_fingerprint(list(inputs.values()))
+        job = self._jobs.get(stage)
+        if job is not None and job.fingerprint == fingerprint:
+            if not (retry_failed and job.future.done() and not job.succeeded()):
+                return job
+        if job is not None:
+            job.cancel()
+        self._skipped.pop(stage, None)
+        job = self._jobs[stage] = _Job(fingerprint)
+        job.future = _executor.submit(self._run, stage, inputs, job)
+        job.future.add_done_callback(lambda _: self._on_done())
+        return job
+
+    def _on_done(self):
+        with self._lock:
+            self._schedule()
+
+    def _run(self, stage, inputs, job):
+        compute = _compute_function(stage)
+        parameters = inspect.signature(compute).parameters
+        arguments = dict(inputs)
+        if 'on_update' in parameters:
+            arguments['on_update'] = job.updates.append
+        with db_query_scope(stage), telemetry_scope(self.session_id, stage), timed('stage', 'background'), \
+                cancellation_scope(job.cancelled):
+            if not STAGE_GRAPH[stage].get('persistent'):
+                return compute(**arguments)
+            return run_job(
+                _job_id(stage, job.fingerprint),
+                lambda checkpoint: compute(**arguments, checkpoint=checkpoint) if 'checkpoint' in parameters else compute(**arguments),
+                on_checkpoint=lambda item_key, value: job.updates.append(value),
+                cancelled=job.cancelled
+            )
+
+    def restart(self, stage):
+        """Discards the result of stage, so it is computed again; readers restart only if it changes."""
+        with self._lock:
+            job = self._jobs.pop(stage, None)
+            if job is not None:
+                job.cancel()
+            self._schedule()
+
+    def skip(self, stage):
+        """
+        Stops computing stage, including a computation already running, and does not start it
+        again in the background until its inputs change or its result is asked for.
+        """
+        with self._lock:
+            job = self._jobs.pop(stage, None)
+            if job is not None:
+                job.cancel()
+            inputs = self._inputs(stage)
+            if inputs is not None:
+                self._skipped[stage] = stage_fingerprint(list(inputs.values()))
+            self._schedule()
+
+    def cancel_all(self):
+        """
+        Cancels the running stages and speculative prefetches, e.g. before the pipeline is discarded,
+        so they stop making LLM calls; the pipeline starts nothing afterwards.
+        """
+        with self._lock:
+            self._closed = True
+            for job in self._jobs.values():
+                job.cancel()
+            for _, future in self._prefetches.values():
+                future.cancel()
+            self._prefetches.clear()
+
+    def export_results(self):
+        """Returns (fingerprint, outputs) by stage for the stages computed successfully."""
+        with self._lock:
+            return {stage: (job.fingerprint, job.future.result()) for stage, job in self._jobs.items() if job.succeeded()}
+
+    def import_results(self, results):
+        """
+        Takes results returned by export_results as computed, so a stage whose inputs still have
+        the same fingerprint is not computed again.
+        """
+        with self._lock:
+            for stage, (fingerprint, outputs) in results.items():
+                job = self._jobs[stage] = _Job(fingerprint)
+                job.future = Future()
+                job.future.set_result(outputs)
+            self._schedule()
+
+    def status(self, stage):
+        """Returns 'running', 'done' or 'failed' for a stage that has been started, else None."""
+        with self._lock:
+            job = self._jobs.get(stage)
+        if job is None or job.future.cancelled():
+            return None
+        if not job.future.done():
+            return 'running'
+        return 'done' if job.succeeded() else 'failed'
+
+    def job_progress(self, stage):
+        """Returns job_utils.get_job_progress for the persistent job of stage's current inputs, or None."""
+        if not STAGE_GRAPH[stage].get('persistent'):
+            return None
+        with self._lock:
+            job = self._jobs.get(stage)
+        return get_job_progress(_job_id(stage, job.fingerprint)) if job is not None else None
+
+    def result(self, stage, on_update=None, poll_seconds=0.25):
+        """
+        Returns the outputs of stage for the current inputs, waiting for the stages upstream of it
+        and for its own computation, which is started here if it is not a background stage.
+
+        Args:
+        stage (str): A stage of STAGE_GRAPH that defines compute().
+        on_update (callable, optional): Called on this thread with each partial result the
+            computation reports, including those reported before the call.
+        poll_seconds (float): How often partial results are relayed while waiting.
+
+        Returns:
+        dict: The stage's outputs by name, or None if its inputs cannot become ready.
+        """
+        while True:
+            with self._lock:
+                inputs = self._inputs(stage)
+                if inputs is not None:
+                    job = self._start(stage, inputs, retry_failed=True)
+                    break
+                upstream_jobs = [self._jobs[upstream] for upstream in upstream_stages(stage) if upstream in self._jobs]
+            for upstream_job in upstream_jobs:
+                if upstream_job.future.done() and not upstream_job.future.cancelled() and not upstream_job.succeeded():
+                    raise upstream_job.future.exception()
+            pending = [upstream_job.future for upstream_job in upstream_jobs if not upstream_job.future.done()]
+            if not pending:
+                return None
+            wait(pending, return_when=FIRST_COMPLETED)
+
+        relayed = 0
+        while True:
+            try:
+                outputs = job.future.result(timeout=poll_seconds)
+                finished = True
+            except FutureTimeoutError:
+                finished = False
+            if on_update is not None:
+                for update in job.updates[relayed:]:
+                    on_update(update)
+                    relayed += 1
+            if finished:
+                return outputs
+
+def session_values():
+    """Returns the values produced by the interactive stages, as found in the session state."""
+    state = st.session_state
+    return {
+        name: _SESSION_VALUES[name](state) if name in _SESSION_VALUES else state.get(name)
+        for name, producer in _PRODUCERS.items()
+        if _compute_function(producer) is None
+    }
+
+def get_pipeline():
+    """Returns this session's StagePipeline, updated with the current session state."""
+    if 'pipeline' not in st.session_state:
+        st.session_state.pipeline = StagePipeline(st.session_state.get('session_id'))
+    pipeline = st.session_state.pipeline
+    pipeline.update(session_values())
+    return pipeline
+
+def restart_stage(stage):
+    get_pipeline().restart(stage)
+
+def skip_stage(stage):
+    get_pipeline().skip(stage)
+
+def stage_result(stage, on_update=None):
+    """
+    Returns the outputs of stage for this session's current inputs: immediately if already
+    computed for them, otherwise once computed. See StagePipeline.result.
+    """
+    return get_pipeline().result(stage, on_update=on_update)
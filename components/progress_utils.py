@@ -0,0 +1,447 @@
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from components.db_utils import get_db_connection, get_db_path
+from config import PROGRESS_DB_PATH
+
+_progress_local = threading.local()
+
+# Metrics tracked across a patient's visits, with their unit and which direction counts as improvement
+PROGRESS_COLUMNS = {
+    'time_in_hospital': {'unit': 'days', 'improvement': 'decrease'},
+    'num_lab_procedures': {'unit': 'count', 'improvement': 'context_dependent'},
+    'num_procedures': {'unit': 'count', 'improvement': 'context_dependent'},
+    'num_medications': {'unit': 'count', 'improvement': 'decrease'},
+    'number_outpatient': {'unit': 'days', 'improvement': 'context_dependent'},
+    'number_emergency': {'unit': 'days', 'improvement': 'decrease'},
+    'number_inpatient': {'unit': 'days', 'improvement': 'decrease'},
+    'diabetesMed': {'unit': 'N/A', 'improvement': 'context_dependent'},
+    'A1Cresult': {'unit': '%', 'improvement': 'decrease'}
+}
+
+# Missing value pandas keeps in a text column that also holds strings (None before pandas 3, NaN since)
+_MIXED_TEXT_MISSING = pd.Series(['', None]).iloc[1]
+
+
+def _visit_lists(positions, flags, starts):
+    """
+    Splits the 1-based visit numbers of flagged rows into one "Visit i, Visit j" string per group
+    ('None' for groups without flagged rows).
+    """
+    flagged = np.flatnonzero(flags)
+    per_group = np.split(positions[flagged], np.searchsorted(flagged, starts[1:]))
+    return [", ".join(f"Visit {visit}" for visit in visits.tolist()) if len(visits) else 'None' for visits in per_group]
+
+
+def _numeric_metric(values, info, starts, ends, group_index, positions):
+    """Per-group statistics and summary strings for a numeric metric."""
+    unit = info['unit']
+    floats = values.to_numpy(dtype=float, na_value=np.nan)
+    valid = ~np.isnan(floats)
+
+    initial = floats[starts]
+    final = floats[ends]
+    maxima = np.fmax.reduceat(floats, starts)
+    totals = np.add.reduceat(np.where(valid, floats, 0.0), starts)
+    counts = np.add.reduceat(valid.astype(np.int64), starts)
+    averages = np.divide(totals, counts, out=np.full(len(starts), np.nan), where=counts > 0)
+    all_zero = np.logical_and.reduceat(floats == 0, starts)
+
+    trends = np.full(len(starts), 'Stable', dtype=object)
+    trends[final < initial] = 'Decreasing'
+    trends[final > initial] = 'Increasing'
+    trends[all_zero] = 'Zero'
+    if info['improvement'] == 'decrease':
+        interpretations = np.where(all_zero, 'Optimal', trends)
+    elif info['improvement'] == 'increase':
+        interpretations = np.where(all_zero, 'Concern', trends)
+    else:
+        interpretations = trends
+
+    significant = _visit_lists(positions, floats > 0.5 * averages[group_index], starts)
+    if pd.api.types.is_integer_dtype(values):
+        # Like a per-patient DataFrame, a patient with a missing value gets float values
+        atomic = values.astype(object).to_numpy(copy=True)
+        has_missing = np.logical_or.reduceat(~valid, starts)[group_index]
+        atomic[has_missing] = floats[has_missing]
+        atomic = atomic.tolist()
+    else:
+        atomic = floats.tolist()
+
+    results = []
+    for g, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        initial_value, final_value, max_value = initial[g].item(), final[g].item(), maxima[g].item()
+        interpretation = interpretations[g]
+        if significant[g] != 'None':
+            insight = (f"{interpretation}. Significant: {significant[g]}. "
+                       f"Initial: {initial_value}, Final: {final_value}, Max: {max_value}.")
+        else:
+            insight = f"{interpretation}. Initial: {initial_value}, Final: {final_value}, Max: {max_value}."
+        results.append(({
+            'Initial Value': f"{initial_value} {unit}",
+            'Max Value': f"{max_value} {unit}",
+            'Interpretation': interpretation,
+            'Significant Visits': significant[g],
+            'Average per Visit': f"{averages[g].item():.1f} {unit}",
+            'Total Across Visits': f"{totals[g].item():.0f} {unit}",
+            'Atomic Data': ', '.join(map(str, atomic[start:end + 1]))
+        }, insight))
+    return results
+
+
+def _categorical_metric(values, info, starts, ends, group_index, positions):
+    """Per-group change points and summary strings for a non-numeric metric."""
+    unit = info['unit']
+    changes = (values != values.shift()).to_numpy(dtype=bool, na_value=True, copy=True)
+    # The first visit of every patient is compared with nothing, so it always counts as a change
+    changes[starts] = True
+    change_points = _visit_lists(positions, changes, starts)
+    distinct = values.groupby(group_index).nunique(dropna=False).to_numpy()
+    # Render missing values the way a per-patient DataFrame of the records would: None when the
+    # patient has no values at all, otherwise whatever pandas infers for text mixed with None
+    missing = values.isna().to_numpy()
+    all_missing = np.logical_and.reduceat(missing, starts)[group_index]
+    atomic = values.astype(object).to_numpy(copy=True)
+    atomic[missing & all_missing] = None
+    atomic[missing & ~all_missing] = _MIXED_TEXT_MISSING
+    atomic = atomic.tolist()
+
+    results = []
+    for g, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        initial_value = str(atomic[start])
+        interpretation = 'Changed' if distinct[g] > 1 else 'Stable'
+        results.append(({
+            'Initial Value': f"{initial_value} {unit}",
+            'Max Value': 'N/A',
+            'Interpretation': interpretation,
+            'Significant Visits': change_points[g],
+            'Average per Visit': 'N/A',
+            'Total Across Visits': 'N/A',
+            'Atomic Data': ', '.join(map(str, atomic[start:end + 1]))
+        }, f"{interpretation}. Initial: {initial_value}, Final: {atomic[end]}."))
+    return results
+
+
+def summarize_progress(df, by='patient_nbr'):
+    """
+    Computes the per-metric progress summary for every patient in one grouped pass.
+
+    Each metric in PROGRESS_COLUMNS is reduced over all patients at once with NumPy segment
+    reductions, so a whole cohort takes roughly as long as a handful of single patients did.
+    Values are rendered as a per-patient DataFrame of the same records would render them, so
+    an integer column with NULLs should use a nullable integer dtype (see load_cohort_progress_summaries).
+
+    Args:
+    df (DataFrame): Encounters with the PROGRESS_COLUMNS, encounter_id and, unless by is None, the patient column.
+    by (str, optional): Column identifying the patient; None treats df as a single patient.
+
+    Returns:
+    dict: Maps each patient (None when by is None) to (summary, total_visits, key_insights), in the
+    format returned by generate_patient_progress_summary.
+    """
+    df = df.sort_values([by, 'encounter_id'] if by else 'encounter_id')
+    if df.empty:
+        return {}
+
+    row_count = len(df)
+    if by:
+        keys = df[by].to_numpy()
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    else:
+        keys = np.array([None], dtype=object)
+        starts = np.array([0])
+    ends = np.r_[starts[1:], row_count] - 1
+    group_index = np.repeat(np.arange(len(starts)), ends - starts + 1)
+    positions = np.arange(row_count) - starts[group_index] + 1
+
+    metrics = {}
+    for column, info in PROGRESS_COLUMNS.items():
+        values = df[column].reset_index(drop=True)
+        if not pd.api.types.is_numeric_dtype(values):
+            metrics[column] = _categorical_metric(values, info, starts, ends, group_index, positions)
+            continue
+        per_group = _numeric_metric(values, info, starts, ends, group_index, positions)
+        all_missing = np.logical_and.reduceat(values.isna().to_numpy(), starts)
+        if all_missing.any():
+            # A patient with no values at all would have had an object column, summarized as text
+            as_text = _categorical_metric(values, info, starts, ends, group_index, positions)
+            per_group = [as_text[g] if all_missing[g] else per_group[g] for g in range(len(starts))]
+        metrics[column] = per_group
+
+    results = {}
+    for g, start in enumerate(starts.tolist()):
+        summary = {}
+        key_insights = []
+        for column, per_group in metrics.items():
+            summary[column], insight = per_group[g]
+            key_insights.append(f"{column}: {insight}")
+        key = keys[start] if by else None
+        results[key.item() if isinstance(key, np.generic) else key] = (summary, int(ends[g] - start + 1), key_insights)
+    return results
+
+
+def load_cohort_progress_summaries(conn, patient_ids=None):
+    """
+    Computes progress summaries for every patient in Diabetic_Data, or only the given ones.
+
+    Args:
+    conn: Database connection.
+    patient_ids (iterable, optional): patient_nbrs to keep; None keeps every patient.
+
+    Returns:
+    dict: Maps patient_nbr (as a string) to (summary, total_visits, key_insights).
+    """
+    columns = ', '.join(['patient_nbr', 'encounter_id', *PROGRESS_COLUMNS])
+    # Nullable dtypes keep integer columns with NULLs distinguishable from real-valued ones
+    df = pd.read_sql(f"SELECT {columns} FROM Diabetic_Data", conn, dtype_backend='numpy_nullable')
+    df['patient_nbr'] = df['patient_nbr'].astype(str)
+    if patient_ids is not None:
+        df = df[df['patient_nbr'].isin({str(patient_id) for patient_id in patient_ids})]
+    return summarize_progress(df)
+
+
+class ProgressAggregator:
+    """
+    Running progress-summary state for one patient, updated one encounter at a time.
+
+    Each metric keeps its visit values (for the atomic data and significant visits) together with
+    running counters: valid count, sum, max, a zero-only flag, the last value, the visits where the
+    value changed and the distinct values seen. Appending an encounter is O(1) per metric, and
+    summary() returns exactly what summarize_progress returns for the same encounters.
+    """
+
+    def __init__(self):
+        self.last_encounter_id = None
+        self.metrics = {column: {
+            'values': [],
+            'count': 0,
+            'sum': 0,
+            'max': None,
+            'all_zero': True,
+            'has_float': False,
+            'has_missing': False,
+            'has_text': False,
+            'changes': [],
+            'distinct': []
+        } for column in PROGRESS_COLUMNS}
+
+    @property
+    def total_visits(self):
+        return len(self.metrics['time_in_hospital']['values'])
+
+    def append(self, encounter):
+        """
+        Adds the next encounter (a mapping with encounter_id and the PROGRESS_COLUMNS); encounters
+        must arrive in increasing encounter_id order.
+        """
+        encounter_id = encounter['encounter_id']
+        if self.last_encounter_id is not None and encounter_id <= self.last_encounter_id:
+            raise ValueError(f"Encounter {encounter_id} arrived after encounter {self.last_encounter_id}")
+        self.last_encounter_id = encounter_id
+
+        for column, state in self.metrics.items():
+            value = encounter[column]
+            if isinstance(value, float) and np.isnan(value):
+                value = None
+            values = state['values']
+            values.append(value)
+
+            # Missing values never compare equal, so they always count as a change
+            if value is None or len(values) == 1 or values[-2] is None or values[-2] != value:
+                state['changes'].append(len(values))
+            if value is None:
+                state['has_missing'] = True
+                state['all_zero'] = False
+                continue
+            if isinstance(value, str):
+                state['has_text'] = True
+                if value not in state['distinct']:
+                    state['distinct'].append(value)
+                continue
+            state['has_float'] = state['has_float'] or isinstance(value, float)
+            state['count'] += 1
+            state['sum'] += value
+            state['max'] = value if state['max'] is None else max(state['max'], value)
+            state['all_zero'] = state['all_zero'] and value == 0
+
+    def _numeric_summary(self, state, info):
+        unit = info['unit']
+        values = state['values']
+        as_float = state['has_float'] or state['has_missing']
+        initial_value = float('nan') if values[0] is None else float(values[0])
+        final_value = float('nan') if values[-1] is None else float(values[-1])
+        max_value = float(state['max'])
+        average_per_visit = state['sum'] / state['count']
+        total_across_visits = float(state['sum'])
+
+        threshold = 0.5 * average_per_visit
+        significant_visits = [i + 1 for i, value in enumerate(values) if value is not None and value > threshold]
+
+        if state['all_zero']:
+            trend = 'Zero'
+        elif final_value > initial_value:
+            trend = 'Increasing'
+        elif final_value < initial_value:
+            trend = 'Decreasing'
+        else:
+            trend = 'Stable'
+        if info['improvement'] == 'decrease':
+            interpretation = 'Optimal' if trend == 'Zero' else trend
+        elif info['improvement'] == 'increase':
+            interpretation = 'Concern' if trend == 'Zero' else trend
+        else:
+            interpretation = trend
+
+        milestone_visit = ", ".join(f"Visit {visit}" for visit in significant_visits) if significant_visits else 'None'
+        if significant_visits:
+            insight = (f"{interpretation}. Significant: {milestone_visit}. "
+                       f"Initial: {initial_value}, Final: {final_value}, Max: {max_value}.")
+        else:
+            insight = f"{interpretation}. Initial: {initial_value}, Final: {final_value}, Max: {max_value}."
+        rendered = [float('nan') if value is None else float(value) if as_float else value for value in values]
+        return {
+            'Initial Value': f"{initial_value} {unit}",
+            'Max Value': f"{max_value} {unit}",
+            'Interpretation': interpretation,
+            'Significant Visits': milestone_visit,
+            'Average per Visit': f"{average_per_visit:.1f} {unit}",
+            'Total Across Visits': f"{total_across_visits:.0f} {unit}",
+            'Atomic Data': ', '.join(map(str, rendered))
+        }, insight
+
+    def _categorical_summary(self, state, info):
+        unit = info['unit']
+        missing = None if state['count'] == 0 and not state['has_text'] else _MIXED_TEXT_MISSING
+        rendered = [missing if value is None else value for value in state['values']]
+        initial_value = str(rendered[0])
+        interpretation = 'Changed' if len(state['distinct']) + state['has_missing'] > 1 else 'Stable'
+        return {
+            'Initial Value': f"{initial_value} {unit}",
+            'Max Value': 'N/A',
+            'Interpretation': interpretation,
+            'Significant Visits': ", ".join(f"Visit {visit}" for visit in state['changes']),
+            'Average per Visit': 'N/A',
+            'Total Across Visits': 'N/A',
+            'Atomic Data': ', '.join(map(str, rendered))
+        }, f"{interpretation}. Initial: {initial_value}, Final: {rendered[-1]}."
+
+    def summary(self):
+        """
+        Returns:
+        tuple: (summary, total_visits, key_insights), as generate_patient_progress_summary.
+        """
+        summary = {}
+        key_insights = []
+        for column, info in PROGRESS_COLUMNS.items():
+            state = self.metrics[column]
+            if state['count'] and not state['has_text']:
+                summary[column], insight = self._numeric_summary(state, info)
+            else:
+                summary[column], insight = self._categorical_summary(state, info)
+            key_insights.append(f"{column}: {insight}")
+        return summary, self.total_visits, key_insights
+
+    def to_state(self):
+        """Returns the aggregator state as a JSON-serializable dictionary."""
+        return {'last_encounter_id': self.last_encounter_id, 'metrics': self.metrics}
+
+    @classmethod
+    def from_state(cls, state):
+        aggregator = cls()
+        aggregator.last_encounter_id = state['last_encounter_id']
+        aggregator.metrics = state['metrics']
+        return aggregator
+
+
+def _get_progress_connection():
+    """Return this thread's connection to the progress state database, creating the schema on first use."""
+    conn = getattr(_progress_local, 'conn', None)
+    if conn is not None and _progress_local.pid == os.getpid():
+        return conn
+
+    os.makedirs(os.path.dirname(os.path.abspath(PROGRESS_DB_PATH)), exist_ok=True)
+    conn = sqlite3.connect(PROGRESS_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patient_progress_state (
+            database TEXT NOT NULL,
+            patient_nbr TEXT NOT NULL,
+            last_encounter_id INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (database, patient_nbr)
+        )
+    ''')
+    _progress_local.conn, _progress_local.pid = conn, os.getpid()
+    return conn
+
+
+def get_patient_progress_summary(patient_id):
+    """
+    Returns a patient's progress summary from the persisted aggregator state, folding in only the
+    encounters added since it was last read.
+
+    The state is kept in its own database (config.PROGRESS_DB_PATH), so reading a summary never
+    writes to the readmission database. Appended encounters are found by comparing the patient's
+    MAX(encounter_id) and encounter count with the state; a history rewritten in any other way
+    (an encounter deleted, or inserted before the last one read) rebuilds the state.
+
+    Args:
+    patient_id (str): The patient_nbr of the patient.
+
+    Returns:
+    tuple: (summary, total_visits, key_insights), or None if the patient has no encounters or the
+    state database cannot be used (e.g. a read-only cache directory).
+    """
+    patient_id = str(patient_id)
+    database = os.path.abspath(get_db_path())
+    columns = ['encounter_id', *PROGRESS_COLUMNS]
+    try:
+        state_conn = _get_progress_connection()
+        row = state_conn.execute(
+            "SELECT state FROM patient_progress_state WHERE database = ? AND patient_nbr = ?", (database, patient_id)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    aggregator = ProgressAggregator.from_state(json.loads(row[0])) if row else ProgressAggregator()
+
+    conn = get_db_connection(read_only=True)
+    try:
+        last_encounter_id, total_visits = conn.execute(
+            "SELECT MAX(encounter_id), COUNT(*) FROM Diabetic_Data WHERE patient_nbr = ?", (patient_id,)
+        ).fetchone()
+        current = last_encounter_id == aggregator.last_encounter_id and total_visits == aggregator.total_visits
+        new_encounters = []
+        if not current:
+            new_encounters = conn.execute(
+                f"SELECT {', '.join(columns)} FROM Diabetic_Data WHERE patient_nbr = ? AND encounter_id > ? ORDER BY encounter_id",
+                (patient_id, -1 if aggregator.last_encounter_id is None else aggregator.last_encounter_id)
+            ).fetchall()
+            if aggregator.total_visits + len(new_encounters) != total_visits:
+                aggregator = ProgressAggregator()
+                new_encounters = conn.execute(
+                    f"SELECT {', '.join(columns)} FROM Diabetic_Data WHERE patient_nbr = ? ORDER BY encounter_id",
+                    (patient_id,)
+                ).fetchall()
+    finally:
+        conn.close()
+
+    for encounter in new_encounters:
+        aggregator.append(dict(zip(columns, encounter)))
+    if not aggregator.total_visits:
+        return None
+    if not current:
+        try:
+            state_conn.execute(
+                "INSERT INTO patient_progress_state (database, patient_nbr, last_encounter_id, state) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (database, patient_nbr) DO UPDATE SET "
+                "last_encounter_id = excluded.last_encounter_id, state = excluded.state",
+                (database, patient_id, aggregator.last_encounter_id, json.dumps(aggregator.to_state()))
+            )
+        except sqlite3.OperationalError:
+            # The summary is still correct; the state is only rebuilt again next time
+            pass
+    return aggregator.summary()
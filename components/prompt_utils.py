@@ -0,0 +1,117 @@
+import re
+import threading
+import pandas as pd
+
+# Word pieces and single punctuation marks, roughly how BPE tokenizers split clinical text
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# 'Atomic Data' entries in dict reprs, JSON and JSON encoded inside JSON strings
+_ATOMIC_DATA_PATTERN = re.compile(r""",?\s*\\?["']Atomic Data\\?["']:\s*\\?["'][^"'\\]*\\?["']""")
+
+# prompt name -> {'calls', 'tokens', 'saved_tokens', 'over_budget'}
+_prompt_stats = {}
+_prompt_stats_lock = threading.Lock()
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens in text without a tokenizer.
+
+    Each word counts one token per four characters (rounded up) and each punctuation mark one
+    token, which slightly overestimates GPT tokenizers on English and numeric text.
+
+    Args:
+    text (str): The text to measure.
+
+    Returns:
+    int: Estimated token count.
+    """
+    return sum((len(piece) + 3) // 4 for piece in _TOKEN_PATTERN.findall(text))
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cuts text to at most max_tokens estimated tokens, preferring a line boundary, and notes the cut.
+
+    Returns:
+    str: text itself if it already fits, otherwise its longest fitting prefix with a truncation marker.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    marker = "\n[... truncated]"
+    allowed = max_tokens - estimate_tokens(marker)
+    if allowed <= 0:
+        return ""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= allowed:
+            low = middle
+        else:
+            high = middle - 1
+    cut = text.rfind('\n', 0, low)
+    return text[:cut if cut > low // 2 else low] + marker
+
+def drop_atomic_data(text):
+    """Removes the per-visit 'Atomic Data' entries from a rendered progress summary."""
+    return _ATOMIC_DATA_PATTERN.sub('', text)
+
+def compile_prompt(name, sections, budget):
+    """
+    Assembles a prompt from sections so that it fits a token budget.
+
+    Sections are joined with newlines. While the prompt is over budget, sections are shrunk in
+    order of increasing priority: first each of their compact variants in turn, then truncation.
+    Sections without a priority are never shrunk.
+
+    Args:
+    name (str): Prompt name used in the statistics reported by get_prompt_stats.
+    sections (list): Dicts with 'text', optional 'priority' (higher is kept longer) and
+        optional 'compact' (progressively shorter alternatives to 'text').
+    budget (int): Maximum estimated tokens for the assembled prompt.
+
+    Returns:
+    str: The assembled prompt.
+    """
+    texts = [section['text'] for section in sections]
+    sizes = [estimate_tokens(text) for text in texts]
+    original = sum(sizes)
+    shrinkable = sorted(
+        (index for index, section in enumerate(sections) if section.get('priority') is not None),
+        key=lambda index: sections[index]['priority']
+    )
+    for index in shrinkable:
+        if sum(sizes) <= budget:
+            break
+        for variant in sections[index].get('compact', ()):
+            texts[index], sizes[index] = variant, estimate_tokens(variant)
+            if sum(sizes) <= budget:
+                break
+        else:
+            texts[index] = truncate_to_tokens(texts[index], max(0, sizes[index] - (sum(sizes) - budget)))
+            sizes[index] = estimate_tokens(texts[index])
+
+    prompt = "\n".join(text for text in texts if text)
+    tokens = sum(sizes)
+    with _prompt_stats_lock:
+        stats = _prompt_stats.setdefault(name, {'calls': 0, 'tokens': 0, 'saved_tokens': 0, 'over_budget': 0})
+        stats['calls'] += 1
+        stats['tokens'] += tokens
+        stats['saved_tokens'] += original - tokens
+        stats['over_budget'] += tokens > budget
+    return prompt
+
+def get_prompt_stats():
+    """
+    Returns the prompt sizes recorded by compile_prompt, largest savings first.
+
+    Returns:
+    pd.DataFrame: One row per prompt name with calls, tokens, saved_tokens and over_budget
+    (calls whose unshrinkable sections alone exceeded the budget).
+    """
+    with _prompt_stats_lock:
+        rows = [{'prompt': name, **stats} for name, stats in _prompt_stats.items()]
+    stats = pd.DataFrame(rows, columns=['prompt', 'calls', 'tokens', 'saved_tokens', 'over_budget'])
+    return stats.sort_values('saved_tokens', ascending=False).reset_index(drop=True)
+
+def reset_prompt_stats():
+    with _prompt_stats_lock:
+        _prompt_stats.clear()
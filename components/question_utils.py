@@ -0,0 +1,154 @@
+import math
+import re
+from collections import Counter
+from config import QUESTION_SIMILARITY_THRESHOLD
+
+# List markers and numbering the model puts before a question: "1.", "2)", "Q3:", "-", "*", "#", bold markers
+_LEADING_MARKERS = re.compile(r'^(?:\s*(?:[-*•#>]+|\(?\d+[.):]|\(?[a-z][.)]|q(?:uestion)?\s*\d+\s*[.):-]?)\s*)+', re.I)
+
+# Openings of a question that the model may not end with a question mark
+_INTERROGATIVES = (
+    'what', 'which', 'who', 'whom', 'whose', 'when', 'where', 'why', 'how', 'is', 'are', 'was', 'were', 'do',
+    'does', 'did', 'has', 'have', 'had', 'can', 'could', 'should', 'would', 'will', 'may', 'might', 'to what',
+)
+
+# Words ignored when comparing questions
+_STOPWORDS = frozenset('''
+    a an and are as at be been being by can could did do does for from had has have how i if in into is it its
+    may might of on or should so than that the their there these this those to was were what when where which
+    who whom whose why will with would patient time times
+'''.split())
+
+# Interchangeable phrasing words, by the word each one is compared as; clinical terms are never
+# listed, so questions about different findings or treatments stay apart
+_PHRASINGS = {
+    'many': ('often', 'multiple', 'frequently', 'repeatedly'),
+    'given': ('receive', 'provide', 'offer'),
+    'before': ('precede', 'prior'),
+    'without': ('no', 'lack'),
+}
+
+_WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+# Suffixes dropped so inflections compare equal, e.g. "changed" and "change", "adherent" and "adhere"
+_SUFFIXES = ('ence', 'ing', 'ent', 'ed', 'es', 's', 'e')
+
+def normalize_question(line):
+    """
+    Returns a line of a clinical questions response as a bare question: list markers, numbering,
+    markdown emphasis and surrounding whitespace removed. Returns None for a line that is not a
+    question, e.g. a blank line or a header such as "Here are the questions:".
+    """
+    text = _LEADING_MARKERS.sub('', line.replace('**', '').replace('__', '')).strip().strip('"').strip()
+    if not text or text.endswith(':'):
+        return None
+    if text.endswith('?'):
+        return text
+    lowered = text.lower()
+    return text if any(lowered.startswith(word + ' ') for word in _INTERROGATIVES) else None
+
+def clean_questions(lines):
+    """Returns the questions among lines (see normalize_question), without repeats, in order."""
+    return list(dict.fromkeys(question for question in map(normalize_question, lines) if question is not None))
+
+def _stem(word):
+    for suffix in _SUFFIXES:
+        if len(word) > len(suffix) + 3 and word.endswith(suffix) and not word.endswith('ss'):
+            return word[:-len(suffix)]
+    return word
+
+_CANONICAL = {_stem(word): _stem(canonical) for canonical, words in _PHRASINGS.items() for word in words}
+
+def _terms(question):
+    # Stemmed content words, with phrasing words replaced by the word they are compared as
+    words = (word.replace("'s", '') for word in _WORD.findall(question.lower()))
+    stems = (_stem(word) for word in words if word not in _STOPWORDS)
+    return Counter(_CANONICAL.get(stem, stem) for stem in stems)
+
+def _cosine(a, b):
+    dot = sum(count * b[term] for term, count in a.items() if term in b)
+    norms = math.sqrt(sum(count * count for count in a.values())) * math.sqrt(sum(count * count for count in b.values()))
+    return dot / norms if norms else 0.0
+
+class QuestionClusters:
+    """
+    Groups near-duplicate questions (e.g. the same question asked through two lenses) as they
+    arrive. A question joins the first cluster whose representative, its first question, has a
+    term cosine similarity of at least threshold with it and differs from it only by added terms,
+    not substituted ones; otherwise it starts a new cluster. Cosine alone would merge questions
+    that share their framing but ask about different things:
+
+    >>> clusters = QuestionClusters()
+    >>> [clusters.add(question)[0] for question in (
+    ...     "How has the patient's HbA1c changed across visits?",
+    ...     "How has the patient's insulin dose changed across visits?",
+    ...     "Has the number of emergency visits increased?",
+    ...     "Has the number of inpatient visits increased?",
+    ...     "How many times has the patient been readmitted within 30 days?",
+    ...     "How often was the patient readmitted within 30 days?",
+    ...     "What is the trend of the patient's HbA1c levels?",
+    ...     "How have HbA1c levels trended over recent visits?",
+    ... )]
+    [0, 1, 2, 3, 4, 4, 5, 5]
+    """
+
+    def __init__(self, threshold=QUESTION_SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self.representatives = []
+        self.members = []
+        self._terms = []
+
+    def add(self, question, label=None):
+        """
+        Adds a question, with an optional label such as the lens that asked it.
+
+        Returns:
+        tuple: (cluster index, whether the question started the cluster).
+        """
+        terms = _terms(question)
+        for index, representative_terms in enumerate(self._terms):
+            substituted = terms - representative_terms and representative_terms - terms
+            if not substituted and _cosine(terms, representative_terms) >= self.threshold:
+                self.members[index].append((question, label))
+                return index, False
+        self.representatives.append(question)
+        self.members.append([(question, label)])
+        self._terms.append(terms)
+        return len(self.representatives) - 1, True
+
+    def _asked_members(self, questions):
+        # The members of each cluster that are among questions, in their order there, by cluster
+        # index in the order of each cluster's first one, so not in the order they were added in
+        position = {question: index for index, question in reversed(list(enumerate(questions)))}
+        asked = {}
+        for index, members in enumerate(self.members):
+            members = sorted((member for member in members if member[0] in position), key=lambda member: position[member[0]])
+            if members:
+                asked[index] = members
+        return dict(sorted(asked.items(), key=lambda item: position[item[1][0][0]]))
+
+    def asked(self, questions):
+        """Returns the indices of the clusters with a member among questions, in the order of their first one there."""
+        return list(self._asked_members(questions))
+
+    def cluster_chains(self, chains_by_question, questions, labels=()):
+        """
+        Returns the reasoning chain of each cluster asked in questions (see asked), looked up by its
+        representative, with the lenses (labels) and the other questions of the cluster it answers
+        added. Both are listed in the order of labels and questions, so the result is the same
+        whichever order the questions arrived in and whichever of them a chain was generated for.
+        """
+        label_order = {label: index for index, label in enumerate(labels)}
+        return [
+            {
+                **chains_by_question[self.representatives[index]],
+                'lenses': sorted(
+                    dict.fromkeys(label for _, label in members if label is not None),
+                    key=lambda label: label_order.get(label, len(label_order))
+                ),
+                'similar_questions': list(dict.fromkeys(
+                    question for question, _ in members if question != self.representatives[index]
+                )),
+            }
+            for index, members in self._asked_members(questions).items()
+        ]
@@ -0,0 +1,100 @@
+import asyncio
+import time
+from collections import deque
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a backend that has been failing consistently."""
+
+class LatencyTracker:
+    """Recent successful call latencies of one function, for percentile-based hedging."""
+
+    def __init__(self, window=200):
+        self._latencies = deque(maxlen=window)
+        self.calls = 0
+        self.hedges = 0
+
+    def record(self, seconds):
+        self._latencies.append(seconds)
+
+    def percentile(self, fraction, min_samples):
+        """Returns the given latency percentile in seconds, or None with fewer than min_samples samples."""
+        if len(self._latencies) < min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures, so calls fail fast with CircuitOpenError
+    for reset_seconds. After that a single probe call is let through: success closes the
+    circuit again, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return 'open'
+        return 'half-open'
+
+    def before_call(self):
+        state = self.state
+        if state == 'open' or (state == 'half-open' and self._probing):
+            raise CircuitOpenError(f"LLM backend unavailable after {self.failures} consecutive failures")
+        self._probing = state == 'half-open'
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def cancel_probe(self):
+        """Ends a call that neither succeeded nor failed because of the backend (e.g. cancelled)."""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+async def hedged(make_call, hedge_after):
+    """
+    Awaits make_call(); if it has not finished after hedge_after seconds, starts a second
+    identical call and returns whichever finishes first successfully. The other is cancelled.
+
+    Args:
+    make_call (callable): Returns a new coroutine for the call on each invocation.
+    hedge_after (float): Seconds before the duplicate is started; None disables hedging.
+
+    Returns:
+    tuple: (result, hedged), where hedged tells whether a duplicate call was started.
+    """
+    if hedge_after is None:
+        return await make_call(), False
+    tasks = [asyncio.ensure_future(make_call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if done:
+            return tasks[0].result(), False
+        tasks.append(asyncio.ensure_future(make_call()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), True
+        # Both calls failed: report the primary's error
+        return tasks[0].result(), True
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
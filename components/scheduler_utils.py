@@ -0,0 +1,167 @@
+import asyncio
+import random
+import re
+import time
+from collections import deque
+
+# Priority lanes, highest priority first: a request in a lane is only started when every lane
+# before it has nothing waiting
+LANES = ('interactive', 'bulk')
+
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_SECONDS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def parse_duration(text):
+    """
+    Parses a rate-limit reset duration such as '120ms', '1s' or '6m0s' into seconds.
+
+    Returns:
+    float: The duration in seconds, or None if text is empty or not a duration.
+    """
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    parts = _DURATION_PATTERN.findall(text)
+    if not parts:
+        return None
+    return sum(float(value) * _DURATION_SECONDS[unit] for value, unit in parts)
+
+def backoff_delay(attempt, base, maximum, retry_after=None):
+    """
+    Full-jitter exponential backoff: a random delay up to base * 2**attempt (capped at maximum),
+    but never shorter than a server-provided retry_after.
+    """
+    delay = random.uniform(0, min(maximum, base * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+class TokenBucket:
+    """Token bucket refilled continuously at limit_per_minute, holding at most one minute's worth."""
+
+    def __init__(self, limit_per_minute):
+        self.capacity = float(limit_per_minute)
+        self.available = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount (capped at capacity) is available."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing * 60 / self.capacity)
+
+    def take(self, amount):
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+    def adjust(self, amount):
+        """Returns (positive) or charges (negative) tokens after the real cost of a request is known."""
+        self._refill()
+        self.available = min(self.capacity, self.available + amount)
+
+    def set_limit(self, limit_per_minute=None, remaining=None):
+        self._refill()
+        if limit_per_minute:
+            self.capacity = float(limit_per_minute)
+        if remaining is not None:
+            self.available = min(self.available, float(remaining))
+        self.available = min(self.available, self.capacity)
+
+class RequestScheduler:
+    """
+    Admits LLM requests under concurrency, requests-per-minute and tokens-per-minute limits,
+    in strict lane priority and first-come order within a lane.
+
+    Lives on the api_utils event loop; acquire() must be awaited on that loop, and release(),
+    pause() and update_limits() called from it. share is the fraction of the account limits
+    this process may use, when several processes share one API key.
+    """
+
+    def __init__(self, max_concurrency, requests_per_minute, tokens_per_minute, share=1.0):
+        self.max_concurrency = max_concurrency
+        self.share = share
+        self.in_flight = 0
+        self.requests = TokenBucket(requests_per_minute * share)
+        self.tokens = TokenBucket(tokens_per_minute * share)
+        self._waiters = {lane: deque() for lane in LANES}
+        self._paused_until = 0.0
+        self._timer = None
+
+    async def acquire(self, tokens, lane):
+        """
+        Waits until a request estimated at tokens may start in the given lane. Every successful
+        acquire must be followed by exactly one release().
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiter = (tokens, future)
+        self._waiters[lane].append(waiter)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just as the caller was cancelled: give the slot back
+                self.release(tokens)
+            elif waiter in self._waiters[lane]:
+                self._waiters[lane].remove(waiter)
+            raise
+
+    def release(self, reserved_tokens, used_tokens=None):
+        """Frees a request slot; used_tokens, when known, corrects the tokens reserved for it."""
+        self.in_flight -= 1
+        if used_tokens is not None:
+            self.tokens.adjust(reserved_tokens - used_tokens)
+        self._dispatch()
+
+    def pause(self, seconds):
+        """Starts no request in any lane for the next seconds, e.g. after a 429."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.requests.set_limit(remaining=0)
+
+    def update_limits(self, headers):
+        """Adopts the limits and remaining budget reported in x-ratelimit-* response headers."""
+        def number(name, share=1.0):
+            try:
+                return float(headers.get(name)) * share
+            except (TypeError, ValueError):
+                return None
+        self.requests.set_limit(number('x-ratelimit-limit-requests', self.share), number('x-ratelimit-remaining-requests'))
+        self.tokens.set_limit(number('x-ratelimit-limit-tokens', self.share), number('x-ratelimit-remaining-tokens'))
+
+    def _next_waiter(self):
+        for lane in LANES:
+            waiters = self._waiters[lane]
+            while waiters and waiters[0][1].done():
+                waiters.popleft()
+            if waiters:
+                return waiters
+        return None
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self.in_flight < self.max_concurrency:
+            waiters = self._next_waiter()
+            if waiters is None:
+                return
+            tokens, future = waiters[0]
+            wait = max(
+                self._paused_until - time.monotonic(),
+                self.requests.wait_time(1),
+                self.tokens.wait_time(tokens)
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            waiters.popleft()
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.in_flight += 1
+            future.set_result(None)
@@ -1,7 +1,13 @@
+import uuid
 import streamlit as st
 from config import stages  # Ensure config imports stages list
+from components.telemetry_utils import get_telemetry
+from components.snapshot_utils import save_session_snapshot, restore_session_snapshot, list_snapshots, delete_snapshot
 
 def initialize_session_state():
+    if 'session_id' not in st.session_state:
+        # Attributes this browser session's stages, LLM calls, cache lookups and queries in the telemetry
+        st.session_state.session_id = uuid.uuid4().hex[:12]
     if 'stage_index' not in st.session_state:
         st.session_state.stage_index = 0
     if 'stage_completed' not in st.session_state:
@@ -38,6 +44,9 @@ def display_session_state():
         st.sidebar.write(f"**{key}:** {value}")
 
 def reset_session_state():
+    # The discarded pipeline's background stages would otherwise keep running and making LLM calls
+    if 'pipeline' in st.session_state:
+        st.session_state.pipeline.cancel_all()
     for key in list(st.session_state.keys()):
         del st.session_state[key]
     initialize_session_state()
@@ -58,13 +67,61 @@ def mark_stage_as_completed():
 def is_current_stage_completed():
     return st.session_state.stage_completed[st.session_state.stage_index]
 
-def display_stage_navigation_with_progress(stages):
-    """Display the combined stage navigation and progress in the sidebar."""
+def display_stage_navigation_with_progress(stages, background_status=None, job_progress=None):
+    """
+    Display the combined stage navigation and progress in the sidebar.
+    background_status, if given, returns 'running', 'done', 'failed' or None for a stage computed in the background.
+    job_progress, if given, returns job_utils.get_job_progress for the persistent job of a stage, or None.
+    """
     st.sidebar.markdown("### Stage Navigation")
+    markers = {'running': " ⏳", 'done': " ⚡", 'failed': " ⚠️"}
     for i, stage in enumerate(stages):
+        marker = markers.get(background_status(stage), "") if background_status else ""
+        progress = job_progress(stage) if job_progress else None
+        if progress is not None and progress['status'] != 'done' and (progress['checkpoints'] or progress['elsewhere']):
+            marker += f" ({progress['checkpoints']} saved{', running in another process' if progress['elsewhere'] else ''})"
         if i < st.session_state.stage_index:
-            st.sidebar.write(f"✅ {stage}")
+            st.sidebar.write(f"✅ {stage}{marker}")
         elif i == st.session_state.stage_index:
-            st.sidebar.write(f"🔴 **{stage}**")  # Highlight current stage
+            st.sidebar.write(f"🔴 **{stage}**{marker}")  # Highlight current stage
         else:
-            st.sidebar.write(f"⬜ {stage}")
+            st.sidebar.write(f"⬜ {stage}{marker}")
+
+def display_snapshot_controls():
+    """Display controls in the sidebar to save this session as a named snapshot and to restore or delete one."""
+    with st.sidebar.expander("Session Snapshots"):
+        name = st.text_input("Snapshot name")
+        if st.button("Save Snapshot") and name:
+            manifest = save_session_snapshot(name)
+            st.success(f"Saved '{name}' ({manifest['written']} of {len(manifest['sections'])} sections changed).")
+        names = [manifest['name'] for manifest in list_snapshots()]
+        if not names:
+            return
+        selected = st.selectbox("Saved snapshots", names)
+        col1, col2 = st.columns([1, 1])
+        with col1:
+            if st.button("Restore"):
+                restore_session_snapshot(selected)
+                st.experimental_rerun()
+        with col2:
+            if st.button("Delete"):
+                delete_snapshot(selected)
+                st.experimental_rerun()
+
+def display_session_telemetry(container=None):
+    """Display where this session's time went (stages, LLM calls, cache lookups, queries) in the sidebar."""
+    container = container or st.sidebar
+    with container.expander("Session Telemetry"):
+        telemetry = get_telemetry(st.session_state.session_id)
+        if telemetry.empty:
+            st.write("Nothing recorded yet.")
+            return
+        llm = telemetry[telemetry['kind'] == 'llm']
+        cache = telemetry[telemetry['kind'] == 'cache']
+        lookups = cache['count'].sum()
+        st.write(f"**LLM calls:** {llm['count'].sum()} ({llm['errors'].sum()} failed), "
+                 f"{llm['tokens_in'].sum()} tokens in / {llm['tokens_out'].sum()} out")
+        if lookups:
+            st.write(f"**Cache hit rate:** {(cache['hit_rate'] * cache['count']).sum() / lookups:.0%} of {lookups} lookups")
+        st.dataframe(telemetry.groupby(['stage', 'kind'])[['count', 'total_seconds']].sum().sort_values('total_seconds', ascending=False))
+        st.dataframe(telemetry[['stage', 'kind', 'name', 'model', 'count', 'total_seconds', 'p95_seconds', 'tokens_in', 'tokens_out', 'hit_rate']].head(15))
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import tempfile
+import time
+import zlib
+import streamlit as st
+from config import SNAPSHOT_DIR, SNAPSHOT_SESSION_KEYS
+from components.pipeline_utils import StagePipeline, get_pipeline
+
+def _manifest_path(name):
+    return os.path.join(SNAPSHOT_DIR, re.sub(r'[^A-Za-z0-9_.-]+', '_', name) + '.json')
+
+def _object_path(digest):
+    return os.path.join(SNAPSHOT_DIR, 'objects', digest[:2], f"{digest}.bin")
+
+def _write_atomically(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+def _store_section(value):
+    # Sections are content-addressed, so one unchanged since an earlier snapshot is not written again
+    payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    digest = hashlib.sha256(payload).hexdigest()
+    path = _object_path(digest)
+    written = not os.path.exists(path)
+    if written:
+        _write_atomically(path, zlib.compress(payload, 1))
+    return digest, written
+
+def _load_section(digest):
+    with open(_object_path(digest), 'rb') as f:
+        return pickle.loads(zlib.decompress(f.read()))
+
+def save_snapshot(name, sections):
+    """
+    Saves named sections (e.g. session state keys) as the snapshot name, replacing any snapshot
+    of that name. Each section is stored once as a zlib-compressed pickle named by its hash.
+
+    Args:
+    name (str): Snapshot name.
+    sections (dict): Section name -> picklable value.
+
+    Returns:
+    dict: The snapshot's manifest, with the number of sections actually written.
+    """
+    manifest = {'name': name, 'saved_at': time.time(), 'sections': {}, 'written': 0}
+    for section, value in sections.items():
+        digest, written = _store_section(value)
+        manifest['sections'][section] = digest
+        manifest['written'] += written
+    _write_atomically(_manifest_path(name), json.dumps(manifest, indent=2).encode('utf-8'))
+    return manifest
+
+def load_snapshot(name):
+    """Returns the sections of the snapshot name, by section name."""
+    with open(_manifest_path(name), encoding='utf-8') as f:
+        manifest = json.load(f)
+    return {section: _load_section(digest) for section, digest in manifest['sections'].items()}
+
+def list_snapshots():
+    """Returns the manifests of the saved snapshots, most recent first."""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    manifests = []
+    for entry in os.listdir(SNAPSHOT_DIR):
+        if entry.endswith('.json'):
+            try:
+                with open(os.path.join(SNAPSHOT_DIR, entry), encoding='utf-8') as f:
+                    manifests.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return sorted(manifests, key=lambda manifest: manifest['saved_at'], reverse=True)
+
+def delete_snapshot(name):
+    """Deletes the snapshot name and the sections no other snapshot refers to."""
+    path = _manifest_path(name)
+    if os.path.exists(path):
+        os.remove(path)
+    referenced = {digest for manifest in list_snapshots() for digest in manifest['sections'].values()}
+    objects_dir = os.path.join(SNAPSHOT_DIR, 'objects')
+    for root, _, files in os.walk(objects_dir):
+        for file_name in files:
+            if file_name.endswith('.bin') and file_name[:-len('.bin')] not in referenced:
+                os.remove(os.path.join(root, file_name))
+
+def save_session_snapshot(name):
+    """
+    Snapshots this session: the SNAPSHOT_SESSION_KEYS of the session state, including the stage
+    progress, plus the results of the stages its pipeline computed.
+
+    Returns:
+    dict: The snapshot's manifest.
+    """
+    sections = {f"state:{key}": st.session_state[key] for key in SNAPSHOT_SESSION_KEYS if key in st.session_state}
+    for stage, result in get_pipeline().export_results().items():
+        sections[f"stage:{stage}"] = result
+    return save_snapshot(name, sections)
+
+def restore_session_snapshot(name):
+    """Replaces this session's state and stage results with those of the snapshot name."""
+    sections = load_snapshot(name)
+    # The replaced pipeline's background stages would otherwise keep running and making LLM calls
+    if 'pipeline' in st.session_state:
+        st.session_state.pipeline.cancel_all()
+    for key in SNAPSHOT_SESSION_KEYS:
+        st.session_state.pop(key, None)
+    for section, value in sections.items():
+        if section.startswith('state:'):
+            st.session_state[section[len('state:'):]] = value
+    pipeline = StagePipeline(st.session_state.get('session_id'))
+    pipeline.import_results({
+        section[len('stage:'):]: value for section, value in sections.items() if section.startswith('stage:')
+    })
+    st.session_state.pipeline = pipeline
@@ -0,0 +1,251 @@
+import bisect
+import contextvars
+from concurrent.futures import CancelledError
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import pandas as pd
+from config import TELEMETRY_LATENCY_BUCKETS, TELEMETRY_MAX_SESSIONS, TELEMETRY_EXPORT_PATH, TELEMETRY_EXPORT_INTERVAL
+
+# Kinds of recorded operations
+KINDS = ('stage', 'llm', 'cache', 'db')
+
+# Session and stage the operations of the current context are attributed to (see telemetry_scope)
+_session = contextvars.ContextVar('telemetry_session', default=None)
+_stage = contextvars.ContextVar('telemetry_stage', default=None)
+
+# session -> {(stage, kind, name, model) -> series}, least recently active session first
+_sessions = OrderedDict()
+_telemetry_lock = threading.Lock()
+_exporter = None
+
+@contextmanager
+def telemetry_scope(session=None, stage=None):
+    """
+    Attributes the operations recorded in this context inside the block to a session and stage.
+    Coroutines passed to api_utils.run_async from the block inherit the attribution.
+    """
+    tokens = [(var, var.set(value)) for var, value in ((_session, session), (_stage, stage)) if value is not None]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+def _new_series():
+    return {
+        'count': 0, 'errors': 0, 'hits': 0, 'misses': 0, 'tokens_in': 0, 'tokens_out': 0,
+        'total_seconds': 0.0, 'max_seconds': 0.0, 'buckets': [0] * (len(TELEMETRY_LATENCY_BUCKETS) + 1)
+    }
+
+def record(kind, name, seconds, model=None, tokens_in=0, tokens_out=0, hit=None, error=False, observed=True):
+    """
+    Records one operation in the current session and stage.
+
+    Args:
+    kind (str): One of KINDS.
+    name (str): What ran: the stage, api_utils function, cache namespace or query.
+    seconds (float): Its latency.
+    model (str, optional): LLM model.
+    tokens_in, tokens_out (int): LLM prompt and completion tokens.
+    hit (bool, optional): Cache hit or miss.
+    error (bool): Whether the operation failed.
+    observed (bool): False to add seconds to the series total without counting an operation,
+        e.g. the time spent fetching the rows of a query already counted.
+    """
+    session = _session.get() or 'unattributed'
+    key = (_stage.get() or 'Other', kind, name, model or '')
+    with _telemetry_lock:
+        series_by_key = _sessions.get(session)
+        if series_by_key is None:
+            series_by_key = _sessions[session] = {}
+            while len(_sessions) > TELEMETRY_MAX_SESSIONS:
+                _sessions.popitem(last=False)
+        else:
+            _sessions.move_to_end(session)
+        series = series_by_key.get(key)
+        if series is None:
+            series = series_by_key[key] = _new_series()
+        series['total_seconds'] += seconds
+        if observed:
+            series['count'] += 1
+            series['errors'] += bool(error)
+            series['max_seconds'] = max(series['max_seconds'], seconds)
+            series['buckets'][bisect.bisect_left(TELEMETRY_LATENCY_BUCKETS, seconds)] += 1
+        if hit is not None:
+            series['hits' if hit else 'misses'] += 1
+        series['tokens_in'] += tokens_in
+        series['tokens_out'] += tokens_out
+    if TELEMETRY_EXPORT_PATH and _exporter is None:
+        _start_exporter()
+
+@contextmanager
+def timed(kind, name, model=None):
+    """
+    Records the block as one operation. The yielded dict can be updated with the keyword
+    arguments of record (e.g. tokens_in); an exception leaving the block counts as an error
+    (control flow such as cancellation or a Streamlit rerun does not).
+    """
+    fields = {'model': model}
+    started = time.perf_counter()
+    try:
+        yield fields
+    except CancelledError:
+        raise
+    except Exception:
+        fields['error'] = True
+        raise
+    finally:
+        record(kind, name, time.perf_counter() - started, **fields)
+
+def _quantile(buckets, count, fraction):
+    # Upper bound of the bucket holding the given quantile (the largest finite bound if beyond)
+    if not count:
+        return None
+    target, seen = fraction * count, 0
+    for bound, bucket_count in zip(TELEMETRY_LATENCY_BUCKETS, buckets):
+        seen += bucket_count
+        if seen >= target:
+            return bound
+    return TELEMETRY_LATENCY_BUCKETS[-1]
+
+def _snapshot(session=None):
+    with _telemetry_lock:
+        sessions = [session] if session is not None else list(_sessions)
+        return [
+            (name, key, dict(series, buckets=list(series['buckets'])))
+            for name in sessions
+            for key, series in _sessions.get(name, {}).items()
+        ]
+
+def get_telemetry(session=None):
+    """
+    Returns the recorded telemetry, slowest series first.
+
+    Args:
+    session (str, optional): Only this session's operations.
+
+    Returns:
+    pd.DataFrame: One row per session, stage, kind, name and model with count, errors,
+    total_seconds, mean_seconds, p95_seconds (histogram bucket bound), max_seconds, tokens_in,
+    tokens_out and, for cache lookups, hit_rate.
+    """
+    rows = []
+    for name, (stage, kind, operation, model), series in _snapshot(session):
+        lookups = series['hits'] + series['misses']
+        rows.append({
+            'session': name, 'stage': stage, 'kind': kind, 'name': operation, 'model': model,
+            'count': series['count'], 'errors': series['errors'], 'total_seconds': series['total_seconds'],
+            'mean_seconds': series['total_seconds'] / series['count'] if series['count'] else None,
+            'p95_seconds': _quantile(series['buckets'], series['count'], 0.95),
+            'max_seconds': series['max_seconds'], 'tokens_in': series['tokens_in'], 'tokens_out': series['tokens_out'],
+            'hit_rate': series['hits'] / lookups if lookups else None,
+        })
+    columns = ['session', 'stage', 'kind', 'name', 'model', 'count', 'errors', 'total_seconds', 'mean_seconds',
+               'p95_seconds', 'max_seconds', 'tokens_in', 'tokens_out', 'hit_rate']
+    telemetry = pd.DataFrame(rows, columns=columns)
+    return telemetry.sort_values('total_seconds', ascending=False).reset_index(drop=True)
+
+def reset_telemetry(session=None):
+    with _telemetry_lock:
+        if session is None:
+            _sessions.clear()
+        else:
+            _sessions.pop(session, None)
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def format_prometheus():
+    """
+    Returns the telemetry in the Prometheus text exposition format: an operation latency
+    histogram plus error, token and cache lookup counters, labelled by session, stage, kind,
+    name and model.
+    """
+    metrics = {
+        'readmission_operation_seconds': ('histogram', "Latency of stages, LLM calls, cache lookups and database queries", []),
+        'readmission_operation_errors_total': ('counter', "Failed operations", []),
+        'readmission_llm_tokens_total': ('counter', "LLM tokens by direction", []),
+        'readmission_cache_lookups_total': ('counter', "Cache lookups by result", []),
+    }
+    for session, (stage, kind, name, model), series in _snapshot():
+        labels = ','.join(
+            f'{label}="{_label_value(value)}"'
+            for label, value in (('session', session), ('stage', stage), ('kind', kind), ('name', name), ('model', model))
+        )
+        histogram = metrics['readmission_operation_seconds'][2]
+        cumulative = 0
+        for bound, bucket_count in zip(TELEMETRY_LATENCY_BUCKETS, series['buckets']):
+            cumulative += bucket_count
+            histogram.append(f'readmission_operation_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        histogram.append(f'readmission_operation_seconds_bucket{{{labels},le="+Inf"}} {series["count"]}')
+        histogram.append(f'readmission_operation_seconds_sum{{{labels}}} {series["total_seconds"]}')
+        histogram.append(f'readmission_operation_seconds_count{{{labels}}} {series["count"]}')
+        metrics['readmission_operation_errors_total'][2].append(f'readmission_operation_errors_total{{{labels}}} {series["errors"]}')
+        if kind == 'llm':
+            for direction in ('in', 'out'):
+                metrics['readmission_llm_tokens_total'][2].append(
+                    f'readmission_llm_tokens_total{{{labels},direction="{direction}"}} {series["tokens_" + direction]}'
+                )
+        if kind == 'cache':
+            for result, field in (('hit', 'hits'), ('miss', 'misses')):
+                metrics['readmission_cache_lookups_total'][2].append(
+                    f'readmission_cache_lookups_total{{{labels},result="{result}"}} {series[field]}'
+                )
+    lines = []
+    for metric, (metric_type, help_text, samples) in metrics.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {metric_type}", *samples]
+    return '\n'.join(lines) + '\n'
+
+def export_prometheus(path):
+    """Atomically replaces path with format_prometheus(), for node_exporter's textfile collector."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(format_prometheus())
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+def export_jsonl(path):
+    """Appends one JSON line per series (its labels, counters and histogram) stamped with the export time."""
+    exported_at = time.time()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        for session, (stage, kind, name, model), series in _snapshot():
+            f.write(json.dumps({
+                'exported_at': exported_at, 'session': session, 'stage': stage, 'kind': kind, 'name': name, 'model': model,
+                **{field: value for field, value in series.items() if field != 'buckets'},
+                'buckets': dict(zip([*map(str, TELEMETRY_LATENCY_BUCKETS), '+Inf'], series['buckets'])),
+            }) + '\n')
+
+def export_telemetry(path):
+    """Exports to path as a Prometheus text file if it ends in .prom, otherwise as JSONL."""
+    if path.endswith('.prom'):
+        export_prometheus(path)
+    else:
+        export_jsonl(path)
+
+def _start_exporter():
+    global _exporter
+    with _telemetry_lock:
+        if _exporter is not None:
+            return
+
+        def export_forever():
+            while True:
+                time.sleep(TELEMETRY_EXPORT_INTERVAL)
+                try:
+                    export_telemetry(TELEMETRY_EXPORT_PATH)
+                except Exception:
+                    pass
+
+        _exporter = threading.Thread(target=export_forever, name="telemetry-exporter", daemon=True)
+        _exporter.start()
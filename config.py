@@ -1,13 +1,207 @@
 # config.py
+import os
 
-stages = [
-    "Select Scenario",
-    "Select Patient",
-    "Generate JSON",
-    "Choose Lens",
-    "Patient Summary",
-    "Generate Reasoning Chains",
-    "Generate Propositions",  # Add this new stage
-    "Validate Reasoning Chains",
-    "Brainstorm"
+# The app's stages in display order. 'module' is the stage's module in stages/, 'inputs' are the
+# values it reads and 'outputs' the values it produces; a stage depends on the stages producing its
+# inputs. Stages whose module defines compute() are run by pipeline_utils outside the UI, and those
+# marked 'background' start as soon as their inputs are ready, concurrently with the other ready
+# stages. Once the values listed in 'prefetch' are ready, the module's prefetch() is started
+# speculatively, before the stage's other inputs exist. 'template' wraps the stage in
+# stage_template's generic navigation. Stages marked 'persistent' run as jobs in job_utils' queue and
+# checkpoint each completed item, so a closed tab or restarted server does not lose their work
+STAGE_GRAPH = {
+    "Select Scenario": {'module': 'stage_select_scenario', 'inputs': [], 'outputs': ['scenario_group', 'scenario', 'scenario_sql_query']},
+    "Select Patient": {'module': 'stage_select_patient', 'inputs': ['scenario_sql_query'], 'outputs': ['patient_id']},
+    "Generate JSON": {'module': 'stage_generate_json', 'inputs': ['patient_id'], 'outputs': ['encounters']},
+    "Choose Lens": {'module': 'stage_choose_lens', 'inputs': ['encounters'], 'outputs': ['lenses']},
+    "Patient Summary": {
+        'module': 'stage_patient_summary', 'background': True,
+        'inputs': ['patient_id', 'encounters'],
+        'outputs': ['patient_summary', 'progress_summary', 'total_visits', 'key_insights']
+    },
+    "Generate Reasoning Chains": {
+        'module': 'stage_generate_reasoning_chains', 'background': True, 'persistent': True,
+        'inputs': ['patient_summary', 'progress_summary', 'lenses'],
+        'prefetch': ['patient_summary', 'progress_summary'],
+        'outputs': ['clinical_questions', 'reasoning_chains']
+    },
+    "Generate Propositions": {
+        'module': 'stage_generate_propositions', 'background': True, 'persistent': True, 'template': True,
+        'inputs': ['scenario_group', 'scenario', 'encounters', 'lenses'],
+        'outputs': ['propositions']
+    },
+    "Validate Propositions": {
+        'module': 'stage_validate_propositions', 'background': True, 'template': True,
+        'inputs': ['propositions', 'patient_summary', 'progress_summary'],
+        'outputs': ['proposition_validation']
+    },
+    "Proposition-Driven Reasoning Chains": {
+        'module': 'stage_proposition_driven_reasoning_chains', 'background': True, 'persistent': True, 'template': True,
+        'inputs': ['propositions', 'patient_summary', 'progress_summary', 'lenses'],
+        'outputs': ['proposition_driven_chains']
+    },
+    "Validate Reasoning Chains": {
+        'module': 'stage_validate',
+        'inputs': ['reasoning_chains', 'patient_summary', 'progress_summary', 'lenses'],
+        'outputs': ['chain_validation']
+    },
+    "Brainstorm": {'module': 'stage_brainstorm', 'inputs': ['encounters', 'lenses'], 'outputs': []},
+}
+
+stages = list(STAGE_GRAPH)
+
+# Maximum number of stages computed in the background at once, across all sessions
+PIPELINE_MAX_WORKERS = 16
+
+# SQLite file holding the jobs of the STAGE_GRAPH stages marked 'persistent' and the items they
+# checkpointed, so an interrupted stage resumes where it stopped
+JOB_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'jobs.db')
+
+# Seconds between heartbeats of a running job; one missing three heartbeats is resumed by the next claimant
+JOB_HEARTBEAT_SECONDS = 5
+
+# Seconds a job and its checkpoints are kept after their last update
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+
+# Directory of the named session snapshots (see snapshot_utils); kept outside cache/, whose
+# entries the cache sweeper may evict
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots')
+
+# Session state saved in a snapshot along with the results of the pipeline stages
+SNAPSHOT_SESSION_KEYS = [
+    'stage_index', 'stage_completed', 'selected_scenario', 'scenario_sql_query', 'scenario_group', 'scenario',
+    'patient_selected', 'summary', 'patient_json_data', 'lens', 'patient_summary', 'progress_summary',
+    'reasoning_chains', 'chain_to_validate', 'propositions', 'propositions_json', 'proposition_driven_chains',
+    'validation_results',
 ]
+
+# Start the speculative work of the STAGE_GRAPH 'prefetch' entries (e.g. the clinical questions of
+# every lens while the user is still choosing lenses)
+SPECULATIVE_PREFETCH = True
+
+# Estimated LLM tokens per minute one session may spend on speculative requests
+SPECULATIVE_PREFETCH_TOKENS_PER_MINUTE = 15000
+
+# Maximum number of LLM requests allowed in flight at once for the async api_utils functions
+LLM_MAX_CONCURRENCY = 8
+
+# Stream clinical questions and start each reasoning chain as soon as its question is complete
+PIPELINED_CHAIN_GENERATION = True
+
+# Term cosine similarity at or above which clinical questions (e.g. asked through different lenses)
+# share one reasoning chain, if neither has a term the other lacks (see question_utils); 0.7 lets the
+# longer question add about as many terms as the two share, 1 merges only questions with the same terms
+QUESTION_SIMILARITY_THRESHOLD = 0.7
+
+# Byte budget of the flexible_cache disk backend; least recently used entries are evicted beyond it
+DISK_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Seconds between background sweeps that expire and evict disk cache entries
+DISK_CACHE_SWEEP_INTERVAL = 300
+
+# SQLite file used by the flexible_cache database backend, shareable by several processes on one host
+CACHE_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'cache.db')
+
+# SQLite file holding each patient's progress-summary state (see progress_utils), kept apart from the
+# readmission database so reading a summary never writes to it or changes its database_version
+PROGRESS_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'progress.db')
+
+# Backend used by the cached LLM calls in api_utils ('disk' or 'database')
+LLM_CACHE_BACKEND = 'disk'
+
+# Concurrent cache misses on the same key are computed once; other processes wait on the
+# holder's lease, which expires after this many seconds if the holder dies
+SINGLE_FLIGHT_LEASE_SECONDS = 600
+
+# Seconds between cache checks while another process computes the same entry
+SINGLE_FLIGHT_POLL_INTERVAL = 0.25
+
+# SQLite database with the Diabetic_Data and scenario tables
+DB_PATH = 'Readmissionv2.db'
+
+# Idle connections kept per pool (read-only and writable) by db_utils.get_db_connection
+DB_POOL_SIZE = 8
+
+# Prepared statements cached per pooled connection
+DB_STATEMENT_CACHE_SIZE = 256
+
+# Pragmas applied to every pooled connection (journal_mode only to writable ones)
+DB_PRAGMAS = {
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'journal_mode': 'WAL',
+    'temp_store': 'MEMORY',
+}
+
+# Scenario query results kept in memory by db_utils.cached_read_sql
+QUERY_CACHE_MAX_ENTRIES = 64
+
+# Also keep scenario query results in the disk cache, shared across processes and restarts
+QUERY_CACHE_SPILL_TO_DISK = True
+
+# Seconds a spilled query result is kept; the database version in its key invalidates it sooner
+QUERY_CACHE_TTL = 86400
+
+# Estimated token budget for the user prompt of each LLM call in api_utils; lower-priority
+# prompt sections are compacted, then truncated, to fit (see prompt_utils.compile_prompt)
+PROMPT_TOKEN_BUDGETS = {
+    'clinical_questions': 3000,
+    'reasoning_chain': 2000,
+    'validation': 4000,
+    'propositions': 4000,
+    'reasoning_chain_batch': 6000,
+}
+
+# Clinical questions answered per reasoning-chain request (1 sends each question on its own)
+REASONING_CHAIN_BATCH_SIZE = 5
+
+# Batched requests tried for questions missing from a response before asking for them one at a time
+REASONING_CHAIN_BATCH_ATTEMPTS = 2
+
+# Account rate limits for the LLM API; the scheduler starts here and follows x-ratelimit-* headers
+LLM_REQUESTS_PER_MINUTE = 500
+LLM_TOKENS_PER_MINUTE = 200000
+
+# Completion tokens reserved per request when it does not set max_tokens
+LLM_EXPECTED_COMPLETION_TOKENS = 600
+
+# Retries of rate-limited, failed or timed-out LLM requests, with jittered exponential backoff
+LLM_MAX_RETRIES = 6
+LLM_BACKOFF_BASE_SECONDS = 1.0
+LLM_BACKOFF_MAX_SECONDS = 60.0
+
+# Per api_utils function call policies, on top of 'default': timeout is the deadline in seconds
+# for a whole call including retries, hedge sends a duplicate request once a call runs past the
+# hedge_percentile of its recent latencies, and degrade returns a placeholder answer instead of
+# raising when the LLM backend times out or the circuit breaker is open
+LLM_CALL_POLICIES = {
+    'default': {'timeout': 120, 'hedge': False, 'hedge_percentile': 0.95, 'degrade': False},
+    'generate_reasoning_chain': {'timeout': 60, 'hedge': True, 'degrade': True},
+    'generate_reasoning_chains_batched': {'timeout': 120},
+    'validate_reasoning_chain': {'timeout': 60, 'hedge': True, 'degrade': True},
+    'generate_propositions': {'timeout': 180},
+}
+
+# Successful calls of a function needed before its latency percentile is trusted for hedging
+LLM_HEDGE_MIN_SAMPLES = 20
+
+# Maximum fraction of a function's calls that may send a hedged duplicate request
+LLM_HEDGE_MAX_FRACTION = 0.1
+
+# Consecutive LLM failures (timeouts, connection errors, exhausted retries) that open the circuit
+LLM_CIRCUIT_FAILURE_THRESHOLD = 5
+
+# Seconds calls fail fast once the circuit is open, before a single probe call is let through
+LLM_CIRCUIT_RESET_SECONDS = 30
+
+# Upper bounds in seconds of the telemetry latency histogram buckets
+TELEMETRY_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Sessions whose telemetry is kept in memory; the least recently active ones are dropped beyond it
+TELEMETRY_MAX_SESSIONS = 200
+
+# File the aggregated telemetry is exported to every TELEMETRY_EXPORT_INTERVAL seconds (None to
+# disable): a Prometheus text file (e.g. for node_exporter's textfile collector) if the name ends
+# in .prom, otherwise one JSON line per series and export is appended
+TELEMETRY_EXPORT_PATH = None
+TELEMETRY_EXPORT_INTERVAL = 30
@@ -2,15 +2,18 @@ import streamlit as st
 import random
 from components.session_utils import mark_stage_as_completed
 
+# Lenses a clinician can choose to focus the clinical questions and propositions
+LENSES = ["Reducing Cost of Readmissions", "Improving Patient Satisfaction", "Enhancing Care Efficiency"]
+
 def run():
     st.title("Choose Lens")
 
     if 'patient_json_data' in st.session_state:
-        chunked_data = st.session_state['patient_json_data']
-        st.write(f"Patient data loaded: {len(chunked_data)} chunks")
+        encounters = st.session_state['patient_json_data']
+        st.write(f"Patient data loaded: {encounters.num_chunks} chunks")
 
         # Define lenses options
-        lenses = ["Reducing Cost of Readmissions", "Improving Patient Satisfaction", "Enhancing Care Efficiency"]
+        lenses = LENSES
         
         # Auto-selection explanation and button
         st.markdown("### Auto-Selection Mode")
@@ -1,7 +1,10 @@
 import streamlit as st
 import json
-from components.api_utils import generate_propositions
+from components.api_utils import generate_propositions_streaming
 from components.session_utils import mark_stage_as_completed
+from components.pipeline_utils import stage_result, restart_stage
+from components.prompt_utils import compile_prompt
+from config import PROMPT_TOKEN_BUDGETS
 
 def generate_propositions_prompt(scenario_group, scenario, patient_data, lens):
     """
@@ -10,49 +13,56 @@ def generate_propositions_prompt(scenario_group, scenario, patient_data, lens):
     Parameters:
     scenario_group (str): The broader scenario group selected (e.g., Medication Management, Emergency Care).
     scenario (str): The specific scenario selected within the group.
-    patient_data (list): A list of lists containing patient encounter data.
+    patient_data (PatientEncounters): The patient's encounters.
     lens (list): A list of lenses selected for the reasoning chain (e.g., reducing costs, improving satisfaction).
     
     Returns:
-    str: A dynamically generated prompt for generating concise, actionable propositions.
+    str: A dynamically generated prompt for generating concise, actionable propositions, within the propositions token budget.
     """
     
     # Start with the scenario group, scenario, and lens
-    prompt = f"Generate concise, actionable propositions for the scenario group '{scenario_group}' and scenario '{scenario}' considering the following lens: {', '.join(lens)}.\n\n"
+    sections = [{'text': (
+        f"Generate concise, actionable propositions for the scenario group '{scenario_group}' and scenario '{scenario}' considering the following lens: {', '.join(lens)}.\n\n"
+        "Patient Data Summary:"
+    )}]
     
-    prompt += "Patient Data Summary:\n"
-    
-    # Loop through each chunk of encounters
-    for chunk_index, chunk in enumerate(patient_data, start=1):
-        prompt += f"\nPatient Encounters - Chunk {chunk_index}:\n"
+    # One section per chunk of encounters; the oldest chunks are the first to go over budget
+    for chunk_index, chunk in enumerate(patient_data.chunks(), start=1):
+        lines = [f"\nPatient Encounters - Chunk {chunk_index}:"]
         
         # Loop through each encounter within the chunk
-        for encounter_index, encounter in enumerate(chunk, start=1):
-            prompt += f"  Encounter {encounter_index}:\n"
+        for encounter_index, encounter in enumerate(chunk.records(), start=1):
+            lines.append(f"  Encounter {encounter_index}:")
             
             # Add relevant information if present in the encounter
             if 'medication_adherence' in encounter:
                 adherence_status = 'Adherent' if encounter['medication_adherence'] == 1 else 'Non-Adherent'
-                prompt += f"    - Medication Adherence: {adherence_status}\n"
+                lines.append(f"    - Medication Adherence: {adherence_status}")
                 
             if 'hospital_visits' in encounter:
                 emergency_visits = encounter['hospital_visits'].get('emergency_visits', 'N/A')
                 inpatient_visits = encounter['hospital_visits'].get('inpatient_visits', 'N/A')
-                prompt += f"    - Emergency Visits: {emergency_visits}\n"
-                prompt += f"    - Inpatient Visits: {inpatient_visits}\n"
+                lines.append(f"    - Emergency Visits: {emergency_visits}")
+                lines.append(f"    - Inpatient Visits: {inpatient_visits}")
                 
             if 'lab_results' in encounter:
                 glucose_level = 'High' if encounter['lab_results'].get('high_glucose') == 1 else 'Normal'
-                prompt += f"    - Glucose Levels: {glucose_level}\n"
+                lines.append(f"    - Glucose Levels: {glucose_level}")
                 
             if 'readmitted' in encounter:
                 readmission_status = 'Yes' if '<30' in encounter['readmitted'] else 'No'
-                prompt += f"    - Readmitted within 30 days: {readmission_status}\n"
+                lines.append(f"    - Readmitted within 30 days: {readmission_status}")
+        
+        sections.append({
+            'text': "\n".join(lines),
+            'priority': chunk_index,
+            'compact': [f"\nPatient Encounters - Chunk {chunk_index}: omitted for length"]
+        })
 
     # End the prompt with a clear call-to-action for generating propositions
-    prompt += "\nBased on the summarized data, generate concise propositions for managing the patient's care with a focus on the selected lens.\n"
+    sections.append({'text': "\nBased on the summarized data, generate concise propositions for managing the patient's care with a focus on the selected lens.\n"})
     
-    return prompt
+    return compile_prompt('propositions_prompt', sections, PROMPT_TOKEN_BUDGETS['propositions'])
 
 
 
@@ -69,41 +79,38 @@ def display_propositions(propositions):
         st.write(f"{i}. {proposition}")
 
 
+def compute(scenario_group, scenario, encounters, lenses, on_update=None):
+    """
+    Computes the stage's outputs (see config.STAGE_GRAPH) without the UI; on_update is called with
+    the text received so far as the propositions stream in.
+    """
+    prompt = generate_propositions_prompt(scenario_group, scenario, encounters, lenses)
+    return {"propositions": generate_propositions_streaming(prompt, on_text=on_update or (lambda text: None))}
+
 def run():
     st.title("Generate Propositions")
 
-    if 'patient_json_data' in st.session_state and 'scenario_group' in st.session_state and 'scenario' in st.session_state and 'lens' in st.session_state:
-        patient_data = st.session_state['patient_json_data']
-        scenario_group = st.session_state['scenario_group']
-        scenario = st.session_state['scenario']
-        lens = st.session_state['lens']
+    # Show the propositions as they stream in, then the cleaned-up list
+    live_propositions = st.empty()
+    with st.spinner("Generating propositions based on patient data..."):
+        result = stage_result("Generate Propositions", on_update=live_propositions.markdown)
+    live_propositions.empty()
 
-        st.write(f"Scenario Group: {scenario_group}")
-        st.write(f"Scenario: {scenario}")
-        st.write(f"Selected Lens: {', '.join(lens)}")
+    if result is not None:
+        st.write(f"Scenario Group: {st.session_state['scenario_group']}")
+        st.write(f"Scenario: {st.session_state['scenario']}")
+        st.write(f"Selected Lens: {', '.join(st.session_state['lens'])}")
 
-        if 'propositions_json' not in st.session_state or not st.session_state['propositions_json']:
-            if st.button("Generate Propositions"):
-                st.info("Generating propositions based on patient data...")
-                
-                prompt = generate_propositions_prompt(scenario_group, scenario, patient_data, lens)
-                propositions = generate_propositions(prompt)
-                
-                # Store propositions as JSON in session state
-                propositions_json = json.dumps([{"id": i, "text": prop} for i, prop in enumerate(propositions)])
-                st.session_state['propositions_json'] = propositions_json
-                
-                st.success("Propositions generated. Displaying results:")
-                display_propositions(propositions)
-                mark_stage_as_completed()
-        else:
-            st.success("Propositions already generated. Displaying results:")
-            propositions = [prop["text"] for prop in json.loads(st.session_state['propositions_json'])]
-            display_propositions(propositions)
-            mark_stage_as_completed()
+        propositions = result['propositions']
+        # Store propositions as JSON in session state
+        st.session_state['propositions_json'] = json.dumps([{"id": i, "text": prop} for i, prop in enumerate(propositions)])
+
+        st.success("Propositions generated. Displaying results:")
+        display_propositions(propositions)
+        mark_stage_as_completed()
 
         if st.button("Regenerate Propositions"):
-            st.session_state.pop('propositions_json', None)
+            restart_stage("Generate Propositions")
             st.experimental_rerun()
 
     else:
@@ -1,7 +1,11 @@
 import streamlit as st
-from components.api_utils import generate_clinical_questions, generate_reasoning_chain
+from components.api_utils import prefetch_clinical_questions, submit_async, generate_clinical_questions_async, generate_reasoning_chain_async, generate_reasoning_chains_batched_async, generate_reasoning_chains_pipelined, gather_in_order, run_async_with_updates
 from components.session_utils import mark_stage_as_completed, go_to_next_stage
+from components.pipeline_utils import stage_result, skip_stage
 from components.data_utils import get_relevant_patient_data, get_clinical_guidelines
+from components.question_utils import QuestionClusters
+from stages.stage_choose_lens import LENSES
+from config import PIPELINED_CHAIN_GENERATION, REASONING_CHAIN_BATCH_SIZE
 import json
 
 def display_reasoning_chains(reasoning_chains):
@@ -12,59 +16,154 @@ def display_reasoning_chains(reasoning_chains):
     for i, chain in enumerate(reasoning_chains, 1):
         st.subheader(f"Reasoning Chain {i}")
         st.write(f"Clinical Question: {chain['question']}")
+        if chain.get('lenses'):
+            st.write(f"Lenses: {', '.join(chain['lenses'])}")
+        if chain.get('similar_questions'):
+            st.write(f"Also answers: {'; '.join(chain['similar_questions'])}")
         for step in chain['steps']:
             st.write(f"- {step}")
         st.markdown("---")
 
-def run():
-    st.title("Generate Reasoning Chains")
+def combine_summaries(patient_summary, progress_summary):
+    """Returns the combined summary JSON the clinical questions are generated (and cached) from."""
+    combined_summary = {
+        "Patient Summary": patient_summary,
+        "Progress Summary": progress_summary
+    }
+    return json.dumps(combined_summary)
+
+async def generate_questions_and_chains(patient_summary, progress_summary, selected_lenses, on_chain=None, completed_chains=None):
+    """
+    Generates the clinical questions for the selected lenses and a reasoning chain for each cluster of
+    similar questions (see question_utils.QuestionClusters), so a question several lenses ask is answered once.
+    
+    Args:
+    patient_summary (dict): Output of create_patient_summary.
+    progress_summary (dict): Output of generate_patient_progress_summary.
+    selected_lenses (list): The selected lenses.
+    on_chain (callable, optional): Called with each reasoning chain as soon as it completes.
+    completed_chains (dict, optional): Chains already generated, by question (e.g. checkpointed by an
+        interrupted run); they are reported through on_chain and answer the questions similar to theirs.
+    
+    Returns:
+    tuple: (clinical_questions, reasoning_chains), in lens and question order; each chain lists the
+    lenses and similar questions it answers.
+    """
+    lenses = tuple(selected_lenses)
+    combined_summary_json = combine_summaries(patient_summary, progress_summary)
+    
+    def chain_inputs(question):
+        relevant_data = get_relevant_patient_data(patient_summary, progress_summary, question)
+        guidelines = get_clinical_guidelines(question, lenses)
+        return relevant_data, guidelines
+    
+    completed_chains = completed_chains or {}
+    if PIPELINED_CHAIN_GENERATION and not completed_chains:
+        # Chains start while the questions for other lenses are still streaming in
+        return await generate_reasoning_chains_pipelined(combined_summary_json, lenses, chain_inputs, on_chain=on_chain)
+    
+    # Questions for every lens (cached per lens as each one completes), then the chains for every
+    # cluster of questions not completed yet, are requested concurrently
+    questions_per_lens = await gather_in_order(
+        [generate_clinical_questions_async(combined_summary_json, (lens,)) for lens in lenses]
+    )
+    # The questions of the completed chains come first, so a question joins the cluster whose chain an
+    # earlier run completed, whichever question (e.g. the first to stream in) that run clustered around
+    clusters = QuestionClusters()
+    for question in completed_chains:
+        clusters.add(question)
+    for lens, questions in zip(lenses, questions_per_lens):
+        for question in questions:
+            clusters.add(question, lens)
+    clinical_questions = [question for questions in questions_per_lens for question in questions]
+    
+    representatives = [clusters.representatives[index] for index in clusters.asked(clinical_questions)]
+    pending_questions = [question for question in representatives if question not in completed_chains]
+    if on_chain is not None:
+        for question in representatives:
+            if question in completed_chains:
+                on_chain(completed_chains[question])
+    
+    chain_items = [(question, *chain_inputs(question)) for question in pending_questions]
+    if REASONING_CHAIN_BATCH_SIZE > 1:
+        new_chains = await generate_reasoning_chains_batched_async(chain_items, lenses, on_chain=on_chain)
+    else:
+        new_chains = await gather_in_order(
+            [generate_reasoning_chain_async(*item, lenses) for item in chain_items], on_result=on_chain
+        )
+    chains_by_question = {**completed_chains, **dict(zip(pending_questions, new_chains))}
+    return clinical_questions, clusters.cluster_chains(chains_by_question, clinical_questions, lenses)
 
-    if 'patient_summary' in st.session_state and 'progress_summary' in st.session_state:
-        patient_summary = st.session_state['patient_summary']
-        progress_summary = st.session_state['progress_summary']
-        selected_lenses = st.session_state.summary.get('Lenses', [])
+def compute(patient_summary, progress_summary, lenses, on_update=None, checkpoint=None):
+    """
+    Computes the stage's outputs (see config.STAGE_GRAPH) without the UI; on_update is called with
+    each chain as it completes. Each chain is saved to checkpoint (a job_utils.Checkpoint) as soon as
+    it completes, and the chains it already holds are not generated again.
+    """
+    completed = checkpoint.completed if checkpoint is not None else {}
+    # Chains already shown while the job was running elsewhere are not shown again
+    reported = checkpoint.reported if checkpoint is not None else set()
+    completed_chains = {key[len('chain:'):]: chain for key, chain in completed.items() if key.startswith('chain:')}
 
-        st.write(f"Selected lenses: {', '.join(selected_lenses)}")
+    def relay(chain):
+        key = f"chain:{chain['question']}"
+        if checkpoint is not None:
+            if chain.get('degraded'):
+                checkpoint.partial = True
+            elif key not in completed:
+                checkpoint.save(key, chain)
+        if on_update is not None and key not in reported:
+            on_update(chain)
 
-        col1, col2 = st.columns(2)
+    clinical_questions, reasoning_chains = run_async_with_updates(
+        lambda emit: generate_questions_and_chains(
+            patient_summary, progress_summary, lenses, on_chain=emit, completed_chains=completed_chains
+        ),
+        relay
+    )
+    return {"clinical_questions": clinical_questions, "reasoning_chains": reasoning_chains}
 
-        with col1:
-            if st.button("Generate Reasoning Chains"):
-                st.info("Generating clinical questions and reasoning chains...")
-                
-                combined_summary = {
-                    "Patient Summary": patient_summary,
-                    "Progress Summary": progress_summary
-                }
-                
-                combined_summary_json = json.dumps(combined_summary)
-                
-                clinical_questions = generate_clinical_questions(combined_summary_json, tuple(selected_lenses))
-                
-                reasoning_chains = []
-                for question in clinical_questions:
-                    relevant_data = get_relevant_patient_data(patient_summary, progress_summary, question)
-                    guidelines = get_clinical_guidelines(question, tuple(selected_lenses))
-                    chain = generate_reasoning_chain(question, relevant_data, guidelines, tuple(selected_lenses))
-                    reasoning_chains.append(chain)
-                
-                st.session_state['reasoning_chains'] = reasoning_chains
-                st.success("Reasoning chains generated. Displaying results:")
-                
-                mark_stage_as_completed()
-                
-                display_reasoning_chains(reasoning_chains)
+def prefetch(patient_summary, progress_summary, budget):
+    """
+    Speculatively generates the clinical questions of every lens while the lenses are still being
+    chosen (see config.STAGE_GRAPH), so this stage mostly finds them in the cache.
 
-        with col2:
-            if st.button("Skip Reasoning Chains"):
-                st.warning("Skipping reasoning chain generation.")
-                st.session_state['reasoning_chains'] = []
-                mark_stage_as_completed()
-                go_to_next_stage()
+    Returns:
+    concurrent.futures.Future: Cancelling it cancels the outstanding requests.
+    """
+    return submit_async(prefetch_clinical_questions(combine_summaries(patient_summary, progress_summary), LENSES, budget))
 
-        if 'reasoning_chains' in st.session_state and st.session_state['reasoning_chains']:
-            st.success("Reasoning chains already generated. Displaying results:")
-            display_reasoning_chains(st.session_state['reasoning_chains'])
+def run():
+    st.title("Generate Reasoning Chains")
 
+    selected_lenses = st.session_state.summary.get('Lenses', [])
+    st.write(f"Selected lenses: {', '.join(selected_lenses)}")
+
+    if st.button("Skip Reasoning Chains"):
+        st.warning("Skipping reasoning chain generation.")
+        skip_stage("Generate Reasoning Chains")
+        st.session_state['reasoning_chains'] = []
+        mark_stage_as_completed()
+        go_to_next_stage()
     else:
-        st.error("No patient summary available. Please go back and complete the Patient Summary step.")
\ No newline at end of file
+        # The chains started in the background once the patient summary and lenses were ready;
+        # show each one as soon as it completes, in completion order
+        live_chains = st.empty()
+        completed_chains = []
+        
+        def show_completed_chain(chain):
+            completed_chains.append(chain)
+            with live_chains.container():
+                st.write(f"{len(completed_chains)} reasoning chains ready...")
+                display_reasoning_chains(completed_chains)
+        
+        result = stage_result("Generate Reasoning Chains", on_update=show_completed_chain)
+        live_chains.empty()
+
+        if result is not None:
+            st.session_state['reasoning_chains'] = result['reasoning_chains']
+            st.success("Reasoning chains generated. Displaying results:")
+            display_reasoning_chains(result['reasoning_chains'])
+            mark_stage_as_completed()
+        else:
+            st.error("No patient summary available. Please go back and complete the Patient Summary step.")
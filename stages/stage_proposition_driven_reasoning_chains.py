@@ -1,29 +1,67 @@
 import streamlit as st
-import json
-from components.api_utils import generate_reasoning_chain
+from components.api_utils import generate_reasoning_chain_async, gather_in_order, run_async_with_updates
 from components.session_utils import mark_stage_as_completed
+from components.pipeline_utils import stage_result
+from components.data_utils import get_relevant_patient_data, get_clinical_guidelines
+
+def compute(propositions, patient_summary, progress_summary, lenses, on_update=None, checkpoint=None):
+    """
+    Computes the stage's outputs (see config.STAGE_GRAPH) without the UI; on_update is called with
+    each chain as it completes. Each chain is saved to checkpoint (a job_utils.Checkpoint) as soon as
+    it completes, and the chains it already holds are not generated again.
+    """
+    completed = checkpoint.completed if checkpoint is not None else {}
+    # Chains already shown while the job was running elsewhere are not shown again
+    reported = checkpoint.reported if checkpoint is not None else set()
+
+    async def chain_for(proposition):
+        key = f"chain:{proposition}"
+        if key in completed:
+            return completed[key]
+        chain = await generate_reasoning_chain_async(
+            proposition,
+            get_relevant_patient_data(patient_summary, progress_summary, proposition),
+            get_clinical_guidelines(proposition, lenses),
+            lenses
+        )
+        return {"proposition": proposition, "chain": chain}
+
+    def relay(item):
+        key = f"chain:{item['proposition']}"
+        if checkpoint is not None:
+            if item['chain'].get('degraded'):
+                checkpoint.partial = True
+            elif key not in completed:
+                checkpoint.save(key, item)
+        if on_update is not None and key not in reported:
+            on_update(item)
+
+    proposition_driven_chains = run_async_with_updates(
+        lambda emit: gather_in_order([chain_for(proposition) for proposition in propositions], on_result=emit),
+        relay
+    )
+    return {"proposition_driven_chains": proposition_driven_chains}
 
 def run():
     st.title("Proposition-Driven Reasoning Chains")
 
-    if 'propositions_json' in st.session_state and st.session_state['propositions_json']:
-        propositions = json.loads(st.session_state['propositions_json'])
-        patient_summary = st.session_state.get('patient_summary', {})
-        progress_summary = st.session_state.get('progress_summary', {})
+    # Progress of the job, which resumes from its checkpoints if an earlier run was interrupted
+    progress = st.empty()
+    completed_chains = []
 
-        st.write("Generated Propositions:")
-        for prop in propositions:
-            st.write(f"{prop['id'] + 1}. {prop['text']}")
+    def show_progress(item):
+        completed_chains.append(item)
+        progress.info(f"{len(completed_chains)} reasoning chains ready...")
 
-        st.write("\nGenerating reasoning chains based on these propositions...")
+    result = stage_result("Proposition-Driven Reasoning Chains", on_update=show_progress)
+    progress.empty()
 
-        proposition_driven_chains = []
+    if result is not None:
+        proposition_driven_chains = result['proposition_driven_chains']
 
-        for prop in propositions:
-            # Combine patient_summary and progress_summary for a complete patient data set
-            patient_data = {**patient_summary, **progress_summary}
-            chain = generate_reasoning_chain(prop['text'], patient_data)
-            proposition_driven_chains.append({"proposition": prop['text'], "chain": chain})
+        st.write("Generated Propositions:")
+        for i, item in enumerate(proposition_driven_chains, 1):
+            st.write(f"{i}. {item['proposition']}")
 
         st.session_state['proposition_driven_chains'] = proposition_driven_chains
 
@@ -39,4 +77,4 @@ def run():
         st.error("No propositions found. Please complete the 'Generate Propositions' stage first.")
 
     # Display the current state of stage completion
-    st.write(f"Stage completed: {st.session_state.stage_completed[st.session_state.stage_index]}")
\ No newline at end of file
+    st.write(f"Stage completed: {st.session_state.stage_completed[st.session_state.stage_index]}")
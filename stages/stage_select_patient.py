@@ -1,39 +1,31 @@
 import streamlit as st
 import pandas as pd
-from components.db_utils import get_db_connection, load_patient_data
+from components.db_utils import get_db_connection, load_patient_data, load_patients_by_visit_count
 from components.session_utils import (
     initialize_session_state, update_session_state_and_rerun, 
     display_session_state, reset_session_state, mark_stage_as_completed
 )
 from config import stages
 
+# Visit count filter options and their inclusive (min, max) visit counts; None means no upper bound
+VISIT_RANGES = {
+    "0-5 visits": (0, 5),
+    "6-10 visits": (6, 10),
+    "11-20 visits": (11, 20),
+    ">20 visits": (21, None),
+}
+
 def run():
     st.title("Select Patient")
 
-    conn = get_db_connection()
+    conn = get_db_connection(read_only=True)
     try:
-        # Query to get patient IDs and visit counts, ordered by visit count descending
-        query = """
-            SELECT patient_nbr, COUNT(*) as visit_count
-            FROM Diabetic_Data
-            GROUP BY patient_nbr
-            ORDER BY visit_count DESC
-        """
-        patient_data = pd.read_sql(query, conn)
-
         # Create visit count range filter
-        visit_ranges = ["0-5 visits", "6-10 visits", "11-20 visits", ">20 visits"]
-        selected_range = st.selectbox("Filter by visit count:", visit_ranges)
+        selected_range = st.selectbox("Filter by visit count:", list(VISIT_RANGES))
 
-        # Filter patient data based on selected range
-        if selected_range == "0-5 visits":
-            filtered_data = patient_data[(patient_data['visit_count'] >= 0) & (patient_data['visit_count'] <= 5)]
-        elif selected_range == "6-10 visits":
-            filtered_data = patient_data[(patient_data['visit_count'] >= 6) & (patient_data['visit_count'] <= 10)]
-        elif selected_range == "11-20 visits":
-            filtered_data = patient_data[(patient_data['visit_count'] >= 11) & (patient_data['visit_count'] <= 20)]
-        else:  # >20 visits
-            filtered_data = patient_data[patient_data['visit_count'] > 20]
+        # Patient IDs and visit counts in the selected range, ordered by visit count descending
+        min_visits, max_visits = VISIT_RANGES[selected_range]
+        filtered_data = load_patients_by_visit_count(conn, min_visits, max_visits)
 
         # Create options for dropdown
         options = [f"{row['patient_nbr']} ({row['visit_count']} visits)" for _, row in filtered_data.iterrows()]
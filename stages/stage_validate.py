@@ -1,7 +1,9 @@
 import streamlit as st
-from components.api_utils import validate_reasoning_chain
+from components.api_utils import validate_reasoning_chain_streaming
 from components.session_utils import go_to_previous_stage, go_to_next_stage
 from components.data_utils import get_relevant_patient_data, get_clinical_guidelines
+from components.job_utils import get_checkpoints, save_checkpoint
+from components.pipeline_utils import stage_fingerprint
 import json
 import plotly.graph_objs as go
 import pandas as pd
@@ -73,6 +75,31 @@ def display_reasoning_chain_with_data(chain, patient_summary, progress_summary):
     else:
         st.error(f"Unexpected chain format: {type(chain)}")
 
+def prepare_chain_for_validation(chain, patient_summary, progress_summary, selected_lenses):
+    """
+    Builds the validate_reasoning_chain arguments for a reasoning chain.
+    
+    Returns:
+    tuple: (formatted_chain, relevant_data, guidelines), each JSON-encoded.
+    """
+    if isinstance(chain, dict):
+        question = chain.get('question', '')
+        reasoning = "\n".join(chain.get('steps', []))
+    elif isinstance(chain, str):
+        question = "Not provided"
+        reasoning = chain
+    else:
+        question = "Not provided"
+        reasoning = str(chain)
+    
+    relevant_data = get_relevant_patient_data(patient_summary, progress_summary, question)
+    guidelines = get_clinical_guidelines(question, selected_lenses)
+    
+    # Format the chain for validation
+    formatted_chain = f"Question: {question}\n\nReasoning Chain:\n\n{reasoning}\n\n{{{{source patient data used for validation: include col name , csv values}}}}"
+    
+    return json.dumps(formatted_chain), json.dumps(relevant_data), json.dumps(guidelines)
+
 def display_validation_results(validation_results):
     for i, result in enumerate(validation_results, 1):
         st.subheader(f"Validation Result for Chain {i}")
@@ -117,10 +144,13 @@ def run():
         patient_summary = st.session_state.get('patient_summary', {})
         progress_summary = st.session_state.get('progress_summary', {})
         selected_lenses = st.session_state.summary.get('Lenses', [])
+        reasoning_chains = st.session_state['reasoning_chains']
 
-        validation_results = []
+        # Validations are checkpointed as they complete, so they survive reruns and restarts
+        job_id = f"Validate Reasoning Chains:{stage_fingerprint([reasoning_chains, patient_summary, progress_summary, tuple(selected_lenses)])}"
+        validations = {item_key: value for _, item_key, value in get_checkpoints(job_id)}
 
-        for i, chain in enumerate(st.session_state['reasoning_chains'], 1):
+        for i, chain in enumerate(reasoning_chains, 1):
             st.subheader(f"Reasoning Chain {i}")
             
             display_reasoning_chain_with_data(chain, patient_summary, progress_summary)
@@ -130,31 +160,30 @@ def run():
                                          ("Yes", "No", "Needs Review"), key=f"confirm_{i}")
             
             if st.button(f"Validate Chain {i}", key=f"validate_{i}"):
-                if isinstance(chain, dict):
-                    question = chain.get('question', '')
-                    reasoning = "\n".join(chain.get('steps', []))
-                elif isinstance(chain, str):
-                    question = "Not provided"
-                    reasoning = chain
-                else:
-                    question = "Not provided"
-                    reasoning = str(chain)
-                
-                relevant_data = get_relevant_patient_data(patient_summary, progress_summary, question)
-                guidelines = get_clinical_guidelines(question, selected_lenses)
-                
-                # Format the chain for validation
-                formatted_chain = f"Question: {question}\n\nReasoning Chain:\n\n{reasoning}\n\n{{{{source patient data used for validation: include col name , csv values}}}}"
+                formatted_chain, relevant_data, guidelines = prepare_chain_for_validation(
+                    chain, patient_summary, progress_summary, selected_lenses
+                )
                 
-                validation_result = validate_reasoning_chain(json.dumps(formatted_chain), json.dumps(relevant_data), json.dumps(guidelines))
+                # Show the validation text as it streams in; the parsed result is displayed below
+                live_validation = st.empty()
+                validation_result = validate_reasoning_chain_streaming(
+                    formatted_chain, relevant_data, guidelines,
+                    on_text=live_validation.markdown
+                )
+                live_validation.empty()
                 
                 # Add user confirmation to validation result
                 validation_result['user_confirmation'] = user_confirmation
                 
-                validation_results.append(validation_result)
+                if not validation_result.get('degraded'):
+                    save_checkpoint(job_id, f"validation:{i}", validation_result)
+                validations[f"validation:{i}"] = validation_result
 
             st.markdown("---")
 
+        validation_results = [
+            validations[f"validation:{i}"] for i in range(1, len(reasoning_chains) + 1) if f"validation:{i}" in validations
+        ]
         if validation_results:
             display_validation_results(validation_results)
 
@@ -1,6 +1,12 @@
 import streamlit as st
-import json
 from components.session_utils import mark_stage_as_completed
+from components.pipeline_utils import stage_result
+
+# For this example, we'll use a simple clinical guideline. In a real scenario, this would be more comprehensive.
+CLINICAL_GUIDELINES = {
+    "adjust insulin": True,
+    "adherence program": True
+}
 
 class PropositionValidationModule:
     def __init__(self, patient_data, clinical_guidelines, feedback_system=None):
@@ -53,28 +59,20 @@ class PropositionValidationModule:
             })
         return validation_results
 
+def compute(propositions, patient_summary, progress_summary):
+    """Computes the stage's outputs (see config.STAGE_GRAPH) without the UI."""
+    # Combine patient_summary and progress_summary for a complete patient data set
+    validator = PropositionValidationModule({**patient_summary, **progress_summary}, CLINICAL_GUIDELINES)
+    return {"proposition_validation": validator.validate_all_propositions(propositions)}
+
 def run():
     st.title("Validate Propositions")
 
-    if 'propositions_json' in st.session_state and st.session_state['propositions_json']:
-        propositions = json.loads(st.session_state['propositions_json'])
-        patient_summary = st.session_state.get('patient_summary', {})
-        progress_summary = st.session_state.get('progress_summary', {})
-
-        # Combine patient_summary and progress_summary for a complete patient data set
-        patient_data = {**patient_summary, **progress_summary}
-
-        # For this example, we'll use a simple clinical guideline. In a real scenario, this would be more comprehensive.
-        clinical_guidelines = {
-            "adjust insulin": True,
-            "adherence program": True
-        }
-
-        # Initialize the PropositionValidationModule
-        validator = PropositionValidationModule(patient_data, clinical_guidelines)
+    with st.spinner("Validating propositions..."):
+        outputs = stage_result("Validate Propositions")
 
-        # Validate all propositions
-        validation_results = validator.validate_all_propositions([prop['text'] for prop in propositions])
+    if outputs is not None:
+        validation_results = outputs['proposition_validation']
 
         st.subheader("Validation Results")
         for result in validation_results:
@@ -90,4 +88,4 @@ def run():
     else:
         st.error("No propositions found. Please complete the 'Generate Propositions' stage first.")
 
-    st.write(f"Stage completed: {st.session_state.stage_completed[st.session_state.stage_index]}")
\ No newline at end of file
+    st.write(f"Stage completed: {st.session_state.stage_completed[st.session_state.stage_index]}")